@@ -1,129 +1,316 @@
-import subprocess
-import os
-import base64
-from agent.CleanOutput import cleanOutput
+import asyncio
+import inspect
+import weakref
+import itertools
+import threading
+import concurrent.futures
 
 from agent.Config import ModelConfig
+from agent.Ollama import getOllamaClient, getAsyncOllamaClient, OllamaError
+from agent.OpenAIClient import getOpenAIClient, getAsyncOpenAIClient
+from agent.ToolExecutor import ToolExecutor, _toolName
+from agent.ToolSelector import ToolSelector
+from agent.Cache import getResponseCache, cacheKey, GuardrailCache
+from agent.Images import ImageCache
+from agent.Batch import Batch
+from agent.RateLimit import RateLimiter
+from agent.Transcript import countTokens
+from agent.Structured import toSchema, schemaName, parseStructured, repairPrompt, build
+from agent.Prompt import PromptTemplate, PromptCacheStats
 
 class AgentRegistry:
-    _agents = []
+    """Agents by name. Only weak references are kept, so agents that aren't used anymore get removed."""
+
+    _agents = {}
+    _lock = threading.RLock()
+    _count = itertools.count()
+
+    lookups = 0
+    misses = 0
 
     @classmethod
     def register(cls, agent):
-        cls._agents.append(agent)
+        def remove(ref, name=agent.name):
+            with cls._lock:
+                refs = cls._agents.get(name)
+                if refs is None:
+                    return
+                refs[:] = [entry for entry in refs if entry[1] is not ref]
+                if not refs:
+                    del cls._agents[name]
+
+        with cls._lock:
+            # With duplicate names the first registered agent that is still alive is used
+            cls._agents.setdefault(agent.name, []).append((next(cls._count), weakref.ref(agent, remove)))
+
+    @classmethod
+    def unregister(cls, agent):
+        with cls._lock:
+            refs = cls._agents.get(agent.name)
+            if refs is None:
+                return
+            refs[:] = [entry for entry in refs if entry[1]() is not agent]
+            if not refs:
+                del cls._agents[agent.name]
 
     @classmethod
     def get_agent(cls, name):
-        return next((agent for agent in cls._agents if agent.name == name), None)
+        with cls._lock:
+            cls.lookups += 1
+
+            for _, ref in cls._agents.get(name, []):
+                agent = ref()
+                if agent is not None:
+                    return agent
+
+            cls.misses += 1
+            return None
 
     @classmethod
     def list_agents(cls):
-        return cls._agents
+        with cls._lock:
+            entries = sorted(entry for refs in cls._agents.values() for entry in refs)
+        return [agent for agent in (ref() for _, ref in entries) if agent is not None]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._agents = {}
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {
+                "agents": sum(len(refs) for refs in cls._agents.values()),
+                "names": len(cls._agents),
+                "duplicateNames": sum(1 for refs in cls._agents.values() if len(refs) > 1),
+                "lookups": cls.lookups,
+                "misses": cls.misses,
+            }
+
+
+
+# The instructions come first and the prompt or response last, so calls of the same agent share a prefix
+_inputGuardrailsTemplate = PromptTemplate(
+    prefix="""
+        You are now an AI safety compliance agent.
+
+        - Your task: Evaluate if the provided prompt violates the established guardrails.
+        - Guardrails: {guardrails}
+
+        Instructions:
+        1. If the prompt violates any of the guardrails, respond strictly with: 'triggered'.
+        2. If the prompt does NOT violate any of the guardrails, respond strictly with: 'ok'.
+        3. You are not permitted to generate, interpret, or elaborate on the prompt in any way other than specified above.
+
+        Adhere to these instructions precisely.
+    """,
+    suffix="""
+        Input Prompt: {prompt}
+    """,
+)
+
+_outputGuardrailsTemplate = PromptTemplate(
+    prefix="""
+        You are now an AI safety compliance agent.
+
+        - Your task: Evaluate if the provided output violates the established guardrails.
+        - Guardrails: {guardrails}
+
+        Instructions:
+        1. If the output violates any of the guardrails, respond strictly with: 'triggered'.
+        2. If the output does NOT violate any of the guardrails, respond strictly with: 'ok'.
+        3. You are not permitted to generate, interpret, or elaborate on the output in any way other than specified above.
+
+        Adhere to these instructions precisely.
+    """,
+    suffix="""
+        Output: {response}
+    """,
+)
+
+_handoffsTemplate = PromptTemplate(
+    prefix="""
+        You are now an AI agent.
+
+        Agent information:
+        - Agent name: {name}
+        - Agent instruction: {instruction}
+        - Agent handoffs: {handoffs}
+
+        The agent information defines you. You can't make any other info up.
+
+        **Formatting Rules:**
+        - You have to select a handoff from your list fitting the task and prompt. It can only be from your list, don't make anything up.
+        - Only respond with the name of the agent, nothing else.
+
+        Example input:
+            - Agent handoffs: [spanishAgent, englishAgent]
+
+        Example output:
+        spanishAgent
+    """,
+    suffix="""
+        Prompt: {prompt}
+    """,
+)
+
+_normalTemplate = PromptTemplate(
+    prefix="""
+        You are now an AI agent.
+
+        Agent information:
+            - Agent name: {name}
+            - Agent instruction: {instruction}
+
+        The agent information defines you. You can't make any other info up.
+
+        Follow these instructions precisely.
+    """,
+    suffix="""
+        Extra info: {response}
+
+        Prompt: {prompt}
+    """,
+)
+
+_generateAgentTemplate = PromptTemplate(
+    prefix="""
+        You are now an AI agent.
+
+        Agent information:
+            - Agent name: {name}
+            - Agent instruction: {instruction}
+
+        The agent information defines you. You can't make any other info up.
+
+        You need to make the agents that are asked in the prompt. Give every agent a descriptive name and an instruction. Order the agents in the order on wich they're needed for the task.
+
+        Extra instructions:
+            - You need to only generate agents asked. So don't add unnecessary agents like tokenizer.
+
+        Follow these instructions precisely.
+    """,
+    suffix="""
+        Prompt: {prompt}
+    """,
+)
+
+
+def _outputGuardrailsPrompt(agent: 'Agent', response: str) -> str:
+    return _outputGuardrailsTemplate.render({"guardrails": agent.outputGuardrails}, response=response)
+
+
+_agentsSchema = {
+    "type": "object",
+    "properties": {
+        "agents": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"name": {"type": "string"}, "instruction": {"type": "string"}},
+                "required": ["name", "instruction"],
+            },
+        },
+    },
+    "required": ["agents"],
+}
+
+
+def _outputGuardrailsResult(verdict: str, response: str, debug: bool = False) -> str:
+    if verdict.strip() == "ok":
+        if debug:
+            print("[DEBUG] No guardrails triggered")
+        return response
+    elif verdict.strip() == "triggered":
+        if debug:
+            print(f"[DEBUG] Guardrails is triggered with {response}")
+        return f"Guardrails triggered"
+    else:
+        if debug:
+            print(f"[DEBUG] Guardrails couldn't be checked with the response: {response}")
+        return f"Guardrails couldn't be checked"
+
+
+def _outputGuardrailsVerdict(agent: 'Agent', response: str, debug: bool = False) -> str:
+    checkOutputGuardrailsPrompt = _outputGuardrailsPrompt(agent, response)
+
+    if debug:
+        print(f"[DEBUG] Current prompt: {checkOutputGuardrailsPrompt}")
+
+    verdict = GuardrailCache.get("output", agent.outputGuardrails, agent.model, response)
+    if verdict is None:
+        verdict = agent.runModel(checkOutputGuardrailsPrompt, debug).strip()
+        GuardrailCache.set("output", agent.outputGuardrails, agent.model, response, verdict)
+    elif debug:
+        print(f"[DEBUG] Cached output guardrails verdict: {verdict}")
+
+    return verdict
+
+
+async def _aoutputGuardrailsVerdict(agent: 'Agent', response: str, debug: bool = False) -> str:
+    checkOutputGuardrailsPrompt = _outputGuardrailsPrompt(agent, response)
+
+    if debug:
+        print(f"[DEBUG] Current prompt: {checkOutputGuardrailsPrompt}")
+
+    verdict = GuardrailCache.get("output", agent.outputGuardrails, agent.model, response)
+    if verdict is None:
+        verdict = (await agent.arunModel(checkOutputGuardrailsPrompt, debug)).strip()
+        GuardrailCache.set("output", agent.outputGuardrails, agent.model, response, verdict)
+    elif debug:
+        print(f"[DEBUG] Cached output guardrails verdict: {verdict}")
+
+    return verdict
+
 
 def _checkOutputGuardrails(agent: 'Agent', response: str, debug: bool = False):
-    # OpenAI
-    if agent.openAI:
-        from openai import OpenAI
-        client = OpenAI()
-        
-        if agent.outputGuardrails != None:
-            
-            checkOutputGuardrailsPrompt = f"""
-                You are now an AI safety compliance agent.
-
-                    - Your task: Evaluate if the provided output violates the established guardrails.
-                    - Guardrails: {agent.outputGuardrails}
-                    - Output: {response}
-
-                    Instructions:
-                    1. If the output violates any of the guardrails, respond strictly with: 'triggered'.
-                    2. If the output does NOT violate any of the guardrails, respond strictly with: 'ok'.
-                    3. You are not permitted to generate, interpret, or elaborate on the output in any way other than specified above.
-
-                    Adhere to these instructions precisely.
-                """
-            
-            stdout = agent.runOpenAI(checkOutputGuardrailsPrompt, debug)
-            
-            if stdout.choices[0].message.content == "ok":
-                if debug:
-                    print("[DEBUG] No guardrails triggered")
-                return response
-            elif stdout.choices[0].message.content == "triggered":
-                if debug:
-                    print(f"[DEBUG] Guardrails is triggered with {response}")
-                return f"Guardrails triggered"
-            else:
-                if debug:
-                    print(f"[DEBUG] Guardrails couldn't be checked with the response: {response}")
-                return f"Guardrails couldn't be checked"
-        else:
-            return response
-        
-    
-    #Local
-    elif not agent.openAI:
-        if agent.outputGuardrails != None:
-            checkOutputGuardrailsPrompt = f"""
-                ollama run {agent.model} "You are now an AI safety compliance agent.
-
-                - Your task: Evaluate if the provided output violates the established guardrails.
-                - Guardrails: {agent.outputGuardrails}
-                - Output: {response}
-
-                Instructions:
-                1. If the output violates any of the guardrails, respond strictly with: 'triggered'.
-                2. If the output does NOT violate any of the guardrails, respond strictly with: 'ok'.
-                3. You are not permitted to generate, interpret, or elaborate on the output in any way other than specified above.
-
-                Adhere to these instructions precisely."
-            """
-            
-            if debug:
-                print(f"[DEBUG] Current prompt: {checkOutputGuardrailsPrompt}")
-            
-            process = subprocess.Popen(checkOutputGuardrailsPrompt, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-            stdout, stderr = process.communicate()
-            
-            if debug:
-                print(f"[DEBUG] Stdout: {stdout}")
-                print(f"[DEBUG] stderr: {stderr}")
-            
-            if stdout.strip() == "ok":
-                if debug:
-                    print("[DEBUG] No guardrails triggered")
-                return response
-            elif stdout.strip() == "triggered":
-                if debug:
-                    print(f"[DEBUG] Guardrails is triggered with {response}")
-                return f"Guardrails triggered"
-            else:
-                if debug:
-                    print(f"[DEBUG] Guardrails couldn't be checked with the response: {response}")
-                return f"Guardrails couldn't be checked"
-        else:
-            return response
+    if agent.outputGuardrails == None:
+        return response
+
+    return _outputGuardrailsResult(_outputGuardrailsVerdict(agent, response, debug), response, debug)
+
+
+async def _acheckOutputGuardrails(agent: 'Agent', response: str, debug: bool = False):
+    if agent.outputGuardrails == None:
+        return response
+
+    return _outputGuardrailsResult(await _aoutputGuardrailsVerdict(agent, response, debug), response, debug)
+
+
+_speculationPool = None
+_speculationPoolLock = threading.Lock()
+
+def _speculationExecutor() -> concurrent.futures.ThreadPoolExecutor:
+    # One pool for every speculative run instead of a new one per call
+    global _speculationPool
+    with _speculationPoolLock:
+        if _speculationPool is None:
+            _speculationPool = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="speculative")
+        return _speculationPool
 
 
 
 class Agent:
-    def __init__(self, name: str, instruction: str, model: str = None, tools: list = None, handoffs: list = None, outputs: list = None, inputGuardrails: str = None, outputGuardrails: str = None, openAI: bool = False, images: list = None, selectiveToolUse: bool=True):
+    def __init__(self, name: str, instruction: str, model: str = None, tools: list = None, handoffs: list = None, outputs: list = None, inputGuardrails: str = None, outputGuardrails: str = None, openAI: bool = False, images: list = None, selectiveToolUse: bool=True, toolSelection: str = "model", concurrentTools: bool = False, maxConcurrentTools: int = 4, toolTimeout: float = None, toolDependencies: dict = None, speculativeGuardrails: bool = False, batchToolInference: bool = False, register: bool = True):
         self.name = name
         self.instruction = instruction
-        
-        
+
+
         if model == None:
             if ModelConfig.getDefaultOpenAI() == True: # niet voor deze agent wel algemeen
                 self.model = ModelConfig.getDefaultModel()
                 self.openAI = ModelConfig.getDefaultOpenAI()
-            else: # voor geen van beide 
+            else: # voor geen van beide
                 self.model = "llama3.1"
                 self.openAI = False
         else:
             self.model = model
             self.openAI = openAI
 
+        # With more than 1 tool only the tools relevant for the prompt are run, picked by the model or a local word match
         self.selectiveToolUse = selectiveToolUse
+        self.toolSelector = ToolSelector(toolSelection)
         self.tools = tools if tools is not None else []
         self.handoffs = handoffs if handoffs is not None else []
         self.outputs = outputs if outputs is not None else []
@@ -131,59 +318,173 @@ class Agent:
         self.outputGuardrails = outputGuardrails
         self.images = images if images is not None else []
 
-        AgentRegistry.register(self)
+        # Concurrent tool use, toolDependencies maps a tool name to the tool names whose output it needs
+        self.concurrentTools = concurrentTools
+        self.maxConcurrentTools = maxConcurrentTools
+        self.toolTimeout = toolTimeout
+        self.toolDependencies = toolDependencies if toolDependencies is not None else {}
 
+        # Check the input guardrails at the same time as running the agent
+        self.speculativeGuardrails = speculativeGuardrails
 
+        # Infer the parameters of all dynamic tools with one model call
+        self.batchToolInference = batchToolInference
 
-    def runTools(self, prompt: str, debug: bool = False):
-        response = ""
+        # Helper agents that are only used internally don't need to be found by name
+        if register:
+            AgentRegistry.register(self)
+
+
+
+    def _runTool(self, tool, prompt: str, debug: bool = False) -> str:
+        if callable(tool):
+            if debug:
+                print(f"[DEBUG] {tool.__name__} is een functie (def).")
+
+            try:
+                if hasattr(tool, '__wrapped__'):
+                    toolResult = tool(prompt=prompt)
+                    if debug:
+                        print(f"[DEBUG] toolresult: {toolResult}")
+                else:
+                    toolResult = tool()
+                    if debug:
+                        print(f"[DEBUG] toolresult: {toolResult}")
+
+                # Async tools can be used from the sync path too
+                if inspect.isawaitable(toolResult):
+                    toolResult = asyncio.run(toolResult)
+
+                if debug:
+                    print(f"[DEBUG] Response {tool.__name__}: {toolResult}")
+
+                return f" response tool: {tool.__name__}: {toolResult} \n"
 
-        for tool in self.tools[:]:
-            if callable(tool):  
+            except Exception as e:
                 if debug:
-                    print(f"[DEBUG] {tool.__name__} is een functie (def).")
+                    print(f"[ERROR] Error with {tool.__name__}: {str(e)}")
+                return f" response tool: {tool.__name__} failed: {str(e)} \n"
+
+        elif isinstance(tool, Agent):
+            if debug:
+                print(f"[DEBUG] {tool.name} is an instance of Agent class")
+
+            try:
+                toolResult = tool.run(prompt, debug)
+
+                if debug:
+                    print(f"[DEBUG] Response {tool.name}: {toolResult}")
+
+                return f" response tool: {tool.name}: {toolResult} \n"
+
+            except Exception as e:
+                if debug:
+                    print(f"[ERROR] Error with {tool.name}: {str(e)}")
+                return f" response tool: {tool.name} failed: {str(e)} \n"
+
+        else:
+            if debug:
+                print(f"[ERROR] Unknown type: {type(tool)}")
+            return f" Error: Unknown type: ({type(tool)}).\n"
+
+
 
-                try:
+    async def _arunTool(self, tool, prompt: str, debug: bool = False) -> str:
+        if callable(tool):
+            if debug:
+                print(f"[DEBUG] {tool.__name__} is een functie (def).")
+
+            try:
+                # Async tools are awaited, normal functions run in a thread so they don't block the loop
+                if inspect.iscoroutinefunction(tool):
+                    if hasattr(tool, '__wrapped__'):
+                        toolResult = await tool(prompt=prompt)
+                    else:
+                        toolResult = await tool()
+                else:
                     if hasattr(tool, '__wrapped__'):
-                        toolResult = tool(prompt=prompt)
-                        if debug:
-                            print(f"[DEBUG] toolresult: {toolResult}")
+                        toolResult = await asyncio.to_thread(tool, prompt=prompt)
                     else:
-                        toolResult = tool()
-                        if debug:
-                            print(f"[DEBUG] toolresult: {toolResult}")
+                        toolResult = await asyncio.to_thread(tool)
 
-                    response += f" response tool: {tool.__name__}: {toolResult} \n"
+                if debug:
+                    print(f"[DEBUG] Response {tool.__name__}: {toolResult}")
 
-                    if debug:
-                        print(f"[DEBUG] Response {tool.__name__}: {toolResult}")
+                return f" response tool: {tool.__name__}: {toolResult} \n"
 
-                except Exception as e:
-                    response += f" response tool: {tool.__name__} failed: {str(e)} \n"
-                    if debug:
-                        print(f"[ERROR] Error with {tool.__name__}: {str(e)}")
+            except Exception as e:
+                if debug:
+                    print(f"[ERROR] Error with {tool.__name__}: {str(e)}")
+                return f" response tool: {tool.__name__} failed: {str(e)} \n"
+
+        elif isinstance(tool, Agent):
+            if debug:
+                print(f"[DEBUG] {tool.name} is an instance of Agent class")
+
+            try:
+                toolResult = await tool.arun(prompt, debug)
 
-            elif isinstance(tool, Agent):  
                 if debug:
-                    print(f"[DEBUG] {tool.name} is an instance of Agent class")
+                    print(f"[DEBUG] Response {tool.name}: {toolResult}")
 
-                try:
-                    toolResult = tool.run(prompt + response, debug)
-                    response += f" response tool: {tool.name}: {toolResult} \n"
+                return f" response tool: {tool.name}: {toolResult} \n"
 
-                    if debug:
-                        print(f"[DEBUG] Response {tool.name}: {toolResult}")
-                        print(f"[DEBUG] Total response: {response}")
+            except Exception as e:
+                if debug:
+                    print(f"[ERROR] Error with {tool.name}: {str(e)}")
+                return f" response tool: {tool.name} failed: {str(e)} \n"
 
-                except Exception as e:
-                    response += f" response tool: {tool.name} failed: {str(e)} \n"
-                    if debug:
-                        print(f"[ERROR] Error with {tool.name}: {str(e)}")
+        else:
+            if debug:
+                print(f"[ERROR] Unknown type: {type(tool)}")
+            return f" Error: Unknown type: ({type(tool)}).\n"
+
+
+
+    def _withDependencies(self, selected: list) -> list:
+        # A selected tool still needs the tools it depends on
+        names = {_toolName(tool) for tool in selected}
+        added = True
+        while added:
+            added = False
+            for name in list(names):
+                for dep in self.toolDependencies.get(name, []):
+                    if dep not in names:
+                        names.add(dep)
+                        added = True
+
+        return [tool for tool in self.tools if _toolName(tool) in names]
+
+
+
+    def _batchableTools(self, tools: list) -> list:
+        # Tools with dependencies get a different prompt, so only the independent ones are batched
+        if self.concurrentTools:
+            return [tool for tool in tools if not self.toolDependencies.get(_toolName(tool))]
+        return tools
+
+
+
+    def runTools(self, prompt: str, debug: bool = False):
+        tools = self.tools[:]
+        if self.selectiveToolUse and len(tools) > 1:
+            tools = self._withDependencies(self.toolSelector.select(self, tools, prompt, debug))
 
+        if self.batchToolInference:
+            from agent.Tool import inferParameters
+            inferParameters(self._batchableTools(tools), prompt, debug)
+
+        if self.concurrentTools:
+            return self._toolExecutor(tools, debug).run(prompt)
+
+        response = ""
+
+        for tool in tools:
+            # Agent tools also get the responses of the tools before them
+            if isinstance(tool, Agent):
+                response += self._runTool(tool, prompt + response, debug)
             else:
-                if debug:
-                    print(f"[ERROR] Unknown type: {type(tool)}")
-                response += f" Error: Unknown type: ({type(tool)}).\n"
+                response += self._runTool(tool, prompt, debug)
 
             if debug:
                 print(f"[DEBUG] running agent {self.name}")
@@ -191,107 +492,498 @@ class Agent:
 
         return response
 
-    
-    
-    
-    def runOpenAI(self, prompt: str, debug: bool = False):
-        from openai import OpenAI
-        client = OpenAI()
-        
-        if debug:
-            print(f"[DEBUG] Current prompt: {prompt}")
-        
-        
+
+
+    async def arunTools(self, prompt: str, debug: bool = False):
+        tools = self.tools[:]
+        if self.selectiveToolUse and len(tools) > 1:
+            tools = self._withDependencies(await self.toolSelector.aselect(self, tools, prompt, debug))
+
+        if self.batchToolInference:
+            from agent.Tool import ainferParameters
+            await ainferParameters(self._batchableTools(tools), prompt, debug)
+
+        if self.concurrentTools:
+            return await self._toolExecutor(tools, debug).arun(prompt)
+
+        response = ""
+
+        for tool in tools:
+            if isinstance(tool, Agent):
+                response += await self._arunTool(tool, prompt + response, debug)
+            else:
+                response += await self._arunTool(tool, prompt, debug)
+
+            if debug:
+                print(f"[DEBUG] running agent {self.name}")
+                print(f"[DEBUG] response tool: {response}")
+
+        return response
+
+
+
+    def _toolExecutor(self, tools: list, debug: bool = False) -> ToolExecutor:
+        return ToolExecutor(
+            self,
+            maxConcurrency=self.maxConcurrentTools,
+            timeout=self.toolTimeout,
+            dependencies=self.toolDependencies,
+            tools=tools,
+            debug=debug,
+        )
+
+
+
+
+    def _imageEntries(self, debug: bool = False) -> list:
+        # Read and encoded once per version of the file, see ImageCache
+        images = []
+        for imagePath in self.images:
+            image = ImageCache.get(imagePath, debug)
+            if image is None:
+                if debug:
+                    print(f"[DEBUG] Niet gevonden: {imagePath}")
+                continue
+            images.append(image)
+        return images
+
+
+
+    def _localImages(self, debug: bool = False) -> list:
+        # All images go with the request in ollama's images field
+        images = [image["base64"] for image in self._imageEntries(debug)]
+
+        if debug and images:
+            print(f"[DEBUG] Running: {self.model} with {len(images)} images")
+
+        return images
+
+
+
+    def _openAIMessages(self, prompt: str, debug: bool = False, schema: dict = None) -> dict:
         if self.images != []:
             content = [{"type": "text", "text": prompt}]
-            
-            for imagePath in self.images:
-                if not os.path.exists(imagePath):
-                    if debug:
-                        print(f"[DEBUG] Niet gevonden: {imagePath}")
-                    continue
-                
-                with open(imagePath, "rb") as f:
-                    base64Image = base64.b64encode(f.read()).decode("utf-8")
-                    content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64Image}"
-                        }
-                    })
-                    
-            stdout = client.chat.completions.create(
-                model=self.model,
-                messages=[{
+
+            for image in self._imageEntries(debug):
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{image['mime']};base64,{image['base64']}"
+                    }
+                })
+
+            return {
+                "model": self.model,
+                "messages": [{
                     "role": "user",
                     "content": content
                 }],
-                max_tokens=4000
-            )
-        elif self.images == []:
-            stdout = client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt,
-                    }
-                ]
-            )
-        else:
-            if debug:
-                print(f"[DEBUG] Error in runOpenAI, self.images is not an allowed value: {self.images}")
-            
-            return "If this happens you better open a github issue."
-        
+                **self._openAIParams(schema),
+            }
+
+        return {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            **self._openAIParams(schema),
+        }
+
+
+
+    def _openAIParams(self, schema: dict = None) -> dict:
+        params = {"max_tokens": 4000} if self.images != [] else {}
+        if schema is not None:
+            params["response_format"] = {"type": "json_schema", "json_schema": {"name": schemaName(schema), "schema": schema}}
+        return params
+
+
+
+    def _cacheKey(self, backend: str, prompt: str, params: dict, useCache: bool = True):
+        cache = getResponseCache()
+        if cache is None or not useCache:
+            return None, None
+
+        images = [image["digest"] for image in self._imageEntries()]
+        return cache, cacheKey(backend, self.model, prompt, images, params)
+
+
+
+    def runOpenAI(self, prompt: str, debug: bool = False, useCache: bool = True, schema: dict = None):
+        client = getOpenAIClient()
+
+        if debug:
+            print(f"[DEBUG] Current prompt: {prompt}")
+
+        cache, key = self._cacheKey("openai", prompt, self._openAIParams(schema), useCache)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                if debug:
+                    print(f"[DEBUG] Cache hit for {self.name}")
+                from openai.types.chat import ChatCompletion
+                return ChatCompletion.model_validate_json(cached)
+
+        request = self._openAIMessages(prompt, debug, schema)
+        stdout = RateLimiter.call("openai", self.model, countTokens(prompt), lambda: client.chat.completions.create(**request), debug)
+        PromptCacheStats.record(self.model, stdout)
+
+        if cache is not None:
+            cache.set(key, stdout.model_dump_json())
+
         if debug:
             print(f"[DEBUG] completion: {stdout}")
-        
+
         return stdout
-    
-    
-    
-    def runLocalModel(self, prompt: str, debug: bool = False) -> str:
-        if self.images:
-            for imagePath in self.images:
-                if not os.path.exists(imagePath):
-                    if debug:
-                        print(f"[DEBUG] Niet gevonden: {imagePath}")
-                    continue
 
-                cmd = ["ollama", "run", self.model]
+
+
+    async def arunOpenAI(self, prompt: str, debug: bool = False, useCache: bool = True, schema: dict = None):
+        client = getAsyncOpenAIClient()
+
+        if debug:
+            print(f"[DEBUG] Current prompt: {prompt}")
+
+        cache, key = self._cacheKey("openai", prompt, self._openAIParams(schema), useCache)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                if debug:
+                    print(f"[DEBUG] Cache hit for {self.name}")
+                from openai.types.chat import ChatCompletion
+                return ChatCompletion.model_validate_json(cached)
+
+        request = self._openAIMessages(prompt, debug, schema)
+        stdout = await RateLimiter.acall("openai", self.model, countTokens(prompt), lambda: client.chat.completions.create(**request), debug)
+        PromptCacheStats.record(self.model, stdout)
+
+        if cache is not None:
+            cache.set(key, stdout.model_dump_json())
+
+        if debug:
+            print(f"[DEBUG] completion: {stdout}")
+
+        return stdout
+
+
+
+    def runLocalModel(self, prompt: str, debug: bool = False, useCache: bool = True, schema: dict = None) -> str:
+        cache, key = self._cacheKey("ollama", prompt, {} if schema is None else {"format": schema}, useCache)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
                 if debug:
-                    print(f"[DEBUG] Running: {' '.join(cmd)} with image: {imagePath}")
-                    print(f"[DEBUG] Prompt: {prompt}")
+                    print(f"[DEBUG] Cache hit for {self.name}")
+                return cached
 
-                # Encode the image to base64
-                with open(imagePath, "rb") as image_file:
-                    base64Image = base64.b64encode(image_file.read()).decode("utf-8")
+        try:
+            images = self._localImages(debug)
+            stdout = RateLimiter.call("ollama", self.model, countTokens(prompt), lambda: getOllamaClient().generate(self.model, prompt, images, format=schema, debug=debug), debug)
 
-                image_instruction = f"""
-                <image>\ndata:image/jpeg;base64,{base64Image}\n</image>
-                {prompt}
-                """
+            if cache is not None:
+                cache.set(key, stdout)
+        except OllamaError as e:
+            stdout = str(e)
+
+        if debug:
+            print(f"[DEBUG] Stdout: {stdout}")
+
+        return stdout
 
-                process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                stdout, stderr = process.communicate(input=image_instruction)
 
+
+    async def arunLocalModel(self, prompt: str, debug: bool = False, useCache: bool = True, schema: dict = None) -> str:
+        cache, key = self._cacheKey("ollama", prompt, {} if schema is None else {"format": schema}, useCache)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
                 if debug:
-                    print(f"[DEBUG] Stdout: {stdout}")
-                    print(f"[DEBUG] stderr: {stderr}")
+                    print(f"[DEBUG] Cache hit for {self.name}")
+                return cached
+
+        try:
+            images = self._localImages(debug)
+            stdout = await RateLimiter.acall("ollama", self.model, countTokens(prompt), lambda: getAsyncOllamaClient().generate(self.model, prompt, images, format=schema, debug=debug), debug)
+
+            if cache is not None:
+                cache.set(key, stdout)
+        except OllamaError as e:
+            stdout = str(e)
+
+        if debug:
+            print(f"[DEBUG] Stdout: {stdout}")
+
+        return stdout
+
+
+
+    def runModel(self, prompt: str, debug: bool = False, useCache: bool = True, schema: dict = None) -> str:
+        if self.openAI:
+            return self.runOpenAI(prompt, debug, useCache, schema).choices[0].message.content
+        return self.runLocalModel(prompt, debug, useCache, schema)
+
+
+
+    async def arunModel(self, prompt: str, debug: bool = False, useCache: bool = True, schema: dict = None) -> str:
+        if self.openAI:
+            stdout = await self.arunOpenAI(prompt, debug, useCache, schema)
+            return stdout.choices[0].message.content
+        return await self.arunLocalModel(prompt, debug, useCache, schema)
 
-                return stdout if stdout else stderr
 
-        else:
-            cmd = ["ollama", "run", self.model]
-            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            stdout, stderr = process.communicate(input=prompt)
 
+    def _forgetStructured(self, sentPrompt: str, schema: dict):
+        # A cached answer that doesn't fit would be replayed on every later call, so it's removed
+        params = self._openAIParams(schema) if self.openAI else {"format": schema}
+        cache, key = self._cacheKey("openai" if self.openAI else "ollama", sentPrompt, params)
+        if cache is not None:
+            cache.delete(key)
+
+    def _structuredResult(self, spec, schema: dict, prompt: str, sentPrompt: str, answer, debug: bool = False):
+        """(result, repairPrompt), the repair prompt is None when the answer is good."""
+        data, errors = parseStructured(answer, schema)
+        if not errors:
+            return build(spec, data), None
+
+        if debug:
+            print(f"[DEBUG] {self.name} gave an answer that doesn't fit the schema: {errors}")
+
+        self._forgetStructured(sentPrompt, schema)
+        return None, repairPrompt(prompt, answer, errors)
+
+    def runStructured(self, prompt: str, schema, debug: bool = False, useCache: bool = True):
+        """Runs the prompt with the output constrained to a JSON schema and checks the answer.
+
+        schema is a JSON schema, a dataclass or a function (its parameters). An answer that
+        doesn't fit is sent back once with what's wrong with it. Returns the data (a dataclass
+        instance for a dataclass), or None if the second answer doesn't fit either. Answers that
+        don't fit aren't kept in the response cache.
+        """
+        spec = schema
+        schema = toSchema(spec)
+
+        result, repair = self._structuredResult(spec, schema, prompt, prompt, self.runModel(prompt, debug, useCache, schema), debug)
+        if repair is None:
+            return result
+
+        result, repair = self._structuredResult(spec, schema, prompt, repair, self.runModel(repair, debug, useCache, schema), debug)
+        if repair is not None:
+            print(f"[ERROR] {self.name} couldn't give an answer that fits the schema")
+        return result
+
+    async def arunStructured(self, prompt: str, schema, debug: bool = False, useCache: bool = True):
+        spec = schema
+        schema = toSchema(spec)
+
+        result, repair = self._structuredResult(spec, schema, prompt, prompt, await self.arunModel(prompt, debug, useCache, schema), debug)
+        if repair is None:
+            return result
+
+        result, repair = self._structuredResult(spec, schema, prompt, repair, await self.arunModel(repair, debug, useCache, schema), debug)
+        if repair is not None:
+            print(f"[ERROR] {self.name} couldn't give an answer that fits the schema")
+        return result
+
+
+
+    def _streamedCompletion(self, chunk, content: str, finishReason: str) -> str:
+        # A streamed answer is cached as a normal completion, so runOpenAI can use it too
+        from openai.types.chat import ChatCompletion
+
+        return ChatCompletion.model_validate({
+            "id": chunk.id,
+            "object": "chat.completion",
+            "created": chunk.created,
+            "model": chunk.model,
+            "choices": [{"index": 0, "finish_reason": finishReason or "stop", "message": {"role": "assistant", "content": content}}],
+        }).model_dump_json()
+
+
+
+    def streamOpenAI(self, prompt: str, debug: bool = False, useCache: bool = True):
+        cache, key = self._cacheKey("openai", prompt, self._openAIParams(), useCache)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                if debug:
+                    print(f"[DEBUG] Cache hit for {self.name}")
+                from openai.types.chat import ChatCompletion
+                yield ChatCompletion.model_validate_json(cached).choices[0].message.content
+                return
+
+        parts = []
+        lastChunk = None
+        finishReason = None
+        stream = RateLimiter.openStream("openai", self.model, countTokens(prompt), lambda: getOpenAIClient().chat.completions.create(**self._openAIMessages(prompt, debug), stream=True), debug)
+
+        for chunk in stream:
+            lastChunk = chunk
+            if not chunk.choices:
+                continue
+
+            finishReason = chunk.choices[0].finish_reason or finishReason
+            content = chunk.choices[0].delta.content
+            if content:
+                parts.append(content)
+                yield content
+
+        if cache is not None and lastChunk is not None:
+            cache.set(key, self._streamedCompletion(lastChunk, "".join(parts), finishReason))
+
+
+
+    async def astreamOpenAI(self, prompt: str, debug: bool = False, useCache: bool = True):
+        cache, key = self._cacheKey("openai", prompt, self._openAIParams(), useCache)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                if debug:
+                    print(f"[DEBUG] Cache hit for {self.name}")
+                from openai.types.chat import ChatCompletion
+                yield ChatCompletion.model_validate_json(cached).choices[0].message.content
+                return
+
+        parts = []
+        lastChunk = None
+        finishReason = None
+        stream = await RateLimiter.aopenStream("openai", self.model, countTokens(prompt), lambda: getAsyncOpenAIClient().chat.completions.create(**self._openAIMessages(prompt, debug), stream=True), debug)
+
+        async for chunk in stream:
+            lastChunk = chunk
+            if not chunk.choices:
+                continue
+
+            finishReason = chunk.choices[0].finish_reason or finishReason
+            content = chunk.choices[0].delta.content
+            if content:
+                parts.append(content)
+                yield content
+
+        if cache is not None and lastChunk is not None:
+            cache.set(key, self._streamedCompletion(lastChunk, "".join(parts), finishReason))
+
+
+
+    def streamLocalModel(self, prompt: str, debug: bool = False, useCache: bool = True):
+        cache, key = self._cacheKey("ollama", prompt, {}, useCache)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                if debug:
+                    print(f"[DEBUG] Cache hit for {self.name}")
+                yield cached
+                return
+
+        parts = []
+        try:
+            stream = RateLimiter.openStream("ollama", self.model, countTokens(prompt), lambda: getOllamaClient().generateStream(self.model, prompt, self._localImages(debug), debug=debug), debug)
+            for chunk in stream:
+                parts.append(chunk)
+                yield chunk
+        except OllamaError as e:
+            yield str(e)
+            return
+
+        if cache is not None:
+            cache.set(key, "".join(parts))
+
+
+
+    async def astreamLocalModel(self, prompt: str, debug: bool = False, useCache: bool = True):
+        cache, key = self._cacheKey("ollama", prompt, {}, useCache)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                if debug:
+                    print(f"[DEBUG] Cache hit for {self.name}")
+                yield cached
+                return
+
+        parts = []
+        try:
+            stream = await RateLimiter.aopenStream("ollama", self.model, countTokens(prompt), lambda: getAsyncOllamaClient().generateStream(self.model, prompt, self._localImages(debug), debug=debug), debug)
+            async for chunk in stream:
+                parts.append(chunk)
+                yield chunk
+        except OllamaError as e:
+            yield str(e)
+            return
+
+        if cache is not None:
+            cache.set(key, "".join(parts))
+
+
+
+    def streamModel(self, prompt: str, debug: bool = False, useCache: bool = True):
+        if self.openAI:
+            return self.streamOpenAI(prompt, debug, useCache)
+        return self.streamLocalModel(prompt, debug, useCache)
+
+
+
+    def astreamModel(self, prompt: str, debug: bool = False, useCache: bool = True):
+        if self.openAI:
+            return self.astreamOpenAI(prompt, debug, useCache)
+        return self.astreamLocalModel(prompt, debug, useCache)
+
+
+
+    def _inputGuardrailsPrompt(self, prompt: str) -> str:
+        return _inputGuardrailsTemplate.render({"guardrails": self.inputGuardrails}, prompt=prompt)
+
+
+
+    def _inputGuardrailsResult(self, verdict: str, prompt: str, debug: bool = False):
+        # None means the prompt passed, otherwise it's the message run returns
+        if verdict.strip() == "ok":
+            if debug:
+                print("[DEBUG] No guardrails triggered")
+            return None
+        elif verdict.strip() == "triggered":
             if debug:
-                print(f"[DEBUG] Stdout: {stdout}")
-                print(f"[DEBUG] stderr: {stderr}")
+                print(f"[DEBUG] Guardrails is triggered with '{prompt}'")
+            return f"Guardrails triggered with '{prompt}'"
+        else:
+            if debug:
+                print(f"[DEBUG] Guardrails couldn't be checked with the prompt: '{prompt}'")
+            return f"Guardrails couldn't be checked with the prompt: '{prompt}'"
+
+
+
+    def _handoffsPrompt(self, prompt: str, handoffsList: str) -> str:
+        return _handoffsTemplate.render({"name": self.name, "instruction": self.instruction, "handoffs": handoffsList}, prompt=prompt)
+
+
+
+    def _normalPrompt(self, prompt: str, response: str) -> str:
+        return _normalTemplate.render({"name": self.name, "instruction": self.instruction}, prompt=prompt, response=response)
+
+
+
+    def _checkInputGuardrails(self, prompt: str, debug: bool = False):
+        verdict = GuardrailCache.get("input", self.inputGuardrails, self.model, prompt)
+        if verdict is None:
+            verdict = self.runModel(self._inputGuardrailsPrompt(prompt), debug).strip()
+            GuardrailCache.set("input", self.inputGuardrails, self.model, prompt, verdict)
+        elif debug:
+            print(f"[DEBUG] Cached input guardrails verdict: {verdict}")
+
+        return self._inputGuardrailsResult(verdict, prompt, debug)
+
+
 
-            return stdout if stdout else stderr
+    async def _acheckInputGuardrails(self, prompt: str, debug: bool = False):
+        verdict = GuardrailCache.get("input", self.inputGuardrails, self.model, prompt)
+        if verdict is None:
+            verdict = (await self.arunModel(self._inputGuardrailsPrompt(prompt), debug)).strip()
+            GuardrailCache.set("input", self.inputGuardrails, self.model, prompt, verdict)
+        elif debug:
+            print(f"[DEBUG] Cached input guardrails verdict: {verdict}")
+
+        return self._inputGuardrailsResult(verdict, prompt, debug)
 
 
 
@@ -300,288 +992,424 @@ class Agent:
             if debug:
                 print(f"[DEBUG] Using openAI model: {self.model}")
 
+        handoffsList = ", ".join([handoff.name for handoff in self.handoffs])
+        if debug:
+            print(f"[DEBUG] HandoffsList: {handoffsList}")
+
+        # Guardrails
+        if self.inputGuardrails != None:
+            if  disableGuardrails == False:
+                if self.speculativeGuardrails:
+                    return self._runSpeculative(prompt, handoffsList, debug)
+
+                blocked = self._checkInputGuardrails(prompt, debug)
+                if blocked is not None:
+                    return blocked
+
+        return self._runAfterGuardrails(prompt, handoffsList, debug, disableGuardrails)
+
+
+
+    def _speculate(self, prompt: str, handoffsList: str, debug: bool = False):
+        # Only model calls without side effects: the handoff routing, or the answer when no tools have to run first
+        if self.handoffs != []:
+            return self.runModel(self._handoffsPrompt(prompt, handoffsList), debug)
+        if self.tools == []:
+            return self.runModel(self._normalPrompt(prompt, ""), debug)
+        return None
+
+
+
+    def _runSpeculative(self, prompt: str, handoffsList: str, debug: bool = False) -> str:
+        # The input guardrails are checked while the model already answers, tools only run once they passed
+        future = _speculationExecutor().submit(self._speculate, prompt, handoffsList, debug)
+
+        try:
+            blocked = self._checkInputGuardrails(prompt, debug)
+        except BaseException:
+            future.cancel()
+            raise
+
+        if blocked is not None:
+            future.cancel()
+            if debug:
+                print(f"[DEBUG] Speculative answer of {self.name} discarded")
+            return blocked
+
+        # The verdict can be there before the speculation started (e.g. a cached one), then it's run here instead
+        speculated = None if future.cancel() else future.result()
+        return self._runAfterGuardrails(prompt, handoffsList, debug, False, speculated)
+
+
+
+    def _runAfterGuardrails(self, prompt: str, handoffsList: str, debug: bool = False, disableGuardrails: bool = False, speculated: str = None) -> str:
         response = ""
 
+        # Run Tools
+        if self.tools != []:
+            response = self.runTools(prompt, debug)
+
+
+        # Run Handoffs
+        if self.handoffs != []:
+            stdout = speculated if speculated is not None else self.runModel(self._handoffsPrompt(prompt, handoffsList), debug)
+            selectedAgentName = stdout.strip()
+
+            selectedAgent = AgentRegistry.get_agent(selectedAgentName)
+
+            if debug:
+                print(f"[DEBUG] selectedAgent: {selectedAgent}")
+
+            return selectedAgent.run(prompt, debug)
+
+
+        # Run normal
+        stdout = speculated if speculated is not None else self.runModel(self._normalPrompt(prompt, response), debug)
+
+        response += f"response of {self.name}: {stdout}"
+        if disableGuardrails == True:
+            return response
+        elif disableGuardrails == False:
+            return _checkOutputGuardrails(self, stdout, debug)
+
+
+
+    async def arun(self, prompt: str, debug: bool = False, disableGuardrails: bool = False) -> str:
+        if self.openAI:
+            if debug:
+                print(f"[DEBUG] Using openAI model: {self.model}")
+
         handoffsList = ", ".join([handoff.name for handoff in self.handoffs])
         if debug:
             print(f"[DEBUG] HandoffsList: {handoffsList}")
 
-#---------------------------------------------------------------------------------------------------
+        # Guardrails
+        if self.inputGuardrails != None:
+            if  disableGuardrails == False:
+                if self.speculativeGuardrails:
+                    return await self._arunSpeculative(prompt, handoffsList, debug)
 
-        # OpenAI 
-        if self.openAI:
-            # Guardrails
-            if self.inputGuardrails != None:
-                if  disableGuardrails == False:
-                    checkInputGuardrailsPrompt = f"""
-                        You are now an AI safety compliance agent.
-
-                        - Your task: Evaluate if the provided prompt violates the established guardrails.
-                        - Guardrails: {self.inputGuardrails}
-                        - Input Prompt: {prompt}
-
-                        Instructions:
-                        1. If the prompt violates any of the guardrails, respond strictly with: 'triggered'.
-                        2. If the prompt does NOT violate any of the guardrails, respond strictly with: 'ok'.
-                        3. You are not permitted to generate, interpret, or elaborate on the prompt in any way other than specified above.
-
-                        Adhere to these instructions precisely.
-                    """
-                    
-                    stdout = self.runOpenAI(checkInputGuardrailsPrompt, debug)
-
-                    if stdout.choices[0].message.content == "ok":
-                        if debug:
-                            print("[DEBUG] No guardrails triggered")
-                    elif stdout.choices[0].message.content == "triggered":
-                        if debug:
-                            print(f"[DEBUG] Guardrails is triggered with '{prompt}'")
-                        return f"Guardrails triggered with '{prompt}'"
-                    else:
-                        if debug:
-                            print(f"[DEBUG] Guardrails couldn't be checked with the prompt: '{prompt}'")
-                        return f"Guardrails couldn't be checked with the prompt: '{prompt}'"
-            
-            
-            
-            # Run Tools
-            if self.tools != []:
-                response = self.runTools(prompt, debug)
-
-
-            # Run Handoffs
-            if self.handoffs != []:
-                promptWithHandoffs = f"""
-                    You are now an AI agent.
-
-                    Agent information:
-                    - Agent name: {self.name}
-                    - Agent instruction: {self.instruction}
-                    - Agent handoffs: {handoffsList}
-                    - Prompt: {prompt}
-
-                    The above list defines you. You can't make any other info up.
-
-                    **Formatting Rules:**
-                    - You have to select a handoff from your list fitting the task and prompt. It can only be from your list, don't make anything up.
-                    - Only respond with the name of the agent, nothing else.
-
-                    Example input:
-                        - Agent handoffs: [spanishAgent, englishAgent]
-
-                    Example output:
-                    spanishAgent
-                """
-                
-                if self.openAI:
-                    stdout = self.runOpenAI(promptWithHandoffs, debug)
-                    selectedAgentName = stdout.choices[0].message.content
-                elif not self.openAI:
-                    stdout = self.runLocalModel(promptWithHandoffs, debug)
-
-                    selectedAgentName = stdout.strip()
-                
-                selectedAgent = AgentRegistry.get_agent(selectedAgentName)
-                
-                if debug:
-                    print(f"[DEBUG] selectedAgent: {selectedAgent}")
-                                
-                return selectedAgent.run(prompt, debug)              
-                        
-            
-
-
-            # Run normal
-            normalPrompt = f"""
-                You are now an AI agent.
-
-                Agent information:
-                    - Agent name: {self.name}
-                    - Agent instruction: {self.instruction}
-                    - Prompt: {prompt}
-                    - Extra info: {response}
-
-                The above list defines you. You can't make any other info up.
-                
-                Follow these instructions precisely.
-            """
-            
-            stdout = self.runOpenAI(normalPrompt, debug)
-
-            response += f"response of {self.name}: {stdout.choices[0].message.content}"
-            if disableGuardrails == True:
-                return response
-            elif disableGuardrails == False:
-                return _checkOutputGuardrails(self, stdout.choices[0].message.content, debug)
-            
-            
-#---------------------------------------------------------------------------------------------------
-            
-        # Local 
-        elif not self.openAI:
-            # Check input guardrails
-            if self.inputGuardrails != None:
-                if  disableGuardrails == False:
-                    checkInputGuardrailsPrompt = f"""
-                        ollama run {self.model} "You are now an AI safety compliance agent.
-
-                        - Your task: Evaluate if the provided prompt violates the established guardrails.
-                        - Guardrails: {self.inputGuardrails}
-                        - Input Prompt: {prompt}
-
-                        Instructions:
-                        1. If the prompt violates any of the guardrails, respond strictly with: 'triggered'.
-                        2. If the prompt does NOT violate any of the guardrails, respond strictly with: 'ok'.
-                        3. You are not permitted to generate, interpret, or elaborate on the prompt in any way other than specified above.
-
-                        Adhere to these instructions precisely."
-                    """
-                    
-                    stdout = self.runLocalModel(checkInputGuardrailsPrompt, debug)
-                        
-                    if stdout.strip() == "ok":
-                        if debug:
-                            print("[DEBUG] No guardrails triggered")
-                    elif stdout.strip() == "triggered":
-                        if debug:
-                            print(f"[DEBUG] Guardrails is triggered with '{prompt}'")
-                        return f"Guardrails triggered with '{prompt}'"
-                    else:
-                        if debug:
-                            print(f"[DEBUG] Guardrails couldn't be checked with the prompt: '{prompt}'")
-                        return f"Guardrails couldn't be checked with the prompt: '{prompt}'"
-            
-            
-            
-            # Run Tools
-            if self.tools != []:
-                response = self.runTools(prompt, debug)
-                        
-            
-            
-            # Run Handoffs
-            if self.handoffs != []:
-                promptWithHandoffs = f"""
-                    ollama run {self.model} "You are now an AI agent.
-
-                    Agent information:
-                    - Agent name: {self.name}
-                    - Agent instruction: {self.instruction}
-                    - Agent handoffs: {handoffsList}
-                    - Prompt: {prompt}
-
-                    The above list defines you. You can't make any other info up.
-
-                    **Formatting Rules:**
-                    - You have to select a handoff from your list fitting the task and prompt. It can only be from your list, don't make anything up.
-                    - Only respond with the name of the agent, nothing else.
-
-                    Example input:
-                        - Agent handoffs: [spanishAgent, englishAgent]
-
-                    Example output:
-                    spanishAgent
-                    "
-                """
-                
-                stdout = self.runLocalModel(promptWithHandoffs, debug)
-
-                selectedAgentName = stdout.strip()
-                
-                selectedAgent = AgentRegistry.get_agent(selectedAgentName)
-                
-                if debug:
-                    print(f"[DEBUG] selectedAgent: {selectedAgent}")
-                                
-                return selectedAgent.run(prompt, debug)              
-                        
-            
+                blocked = await self._acheckInputGuardrails(prompt, debug)
+                if blocked is not None:
+                    return blocked
+
+        return await self._arunAfterGuardrails(prompt, handoffsList, debug, disableGuardrails)
+
+
+
+    async def _aspeculate(self, prompt: str, handoffsList: str, debug: bool = False):
+        if self.handoffs != []:
+            return await self.arunModel(self._handoffsPrompt(prompt, handoffsList), debug)
+        if self.tools == []:
+            return await self.arunModel(self._normalPrompt(prompt, ""), debug)
+        return None
+
+
+
+    async def _arunSpeculative(self, prompt: str, handoffsList: str, debug: bool = False) -> str:
+        task = asyncio.ensure_future(self._aspeculate(prompt, handoffsList, debug))
+
+        try:
+            blocked = await self._acheckInputGuardrails(prompt, debug)
+        except BaseException:
+            task.cancel()
+            raise
+
+        if blocked is not None:
+            task.cancel()
             if debug:
-                stdout = ""
+                print(f"[DEBUG] Speculative answer of {self.name} cancelled")
+            return blocked
 
-            # Run normal
-            normalPrompt = f"""
-                ollama run {self.model} "You are now an AI agent.
+        return await self._arunAfterGuardrails(prompt, handoffsList, debug, False, await task)
 
-                Agent information:
-                    - Agent name: {self.name}
-                    - Agent instruction: {self.instruction}
-                    - Prompt: {prompt}
-                    - Extra info: {response}
 
-                The above list defines you. You can't make any other info up.
-                
-                Follow these instructions precisely."
-            """
-            
-            stdout = self.runLocalModel(normalPrompt, debug)
 
-            response += f"response of {self.name}: {stdout}"
-            if disableGuardrails == True:
-                return response
-            elif disableGuardrails == False:
-                return _checkOutputGuardrails(self, stdout, debug)
+    async def _arunAfterGuardrails(self, prompt: str, handoffsList: str, debug: bool = False, disableGuardrails: bool = False, speculated: str = None) -> str:
+        response = ""
 
+        # Run Tools
+        if self.tools != []:
+            response = await self.arunTools(prompt, debug)
 
 
+        # Run Handoffs
+        if self.handoffs != []:
+            stdout = speculated if speculated is not None else await self.arunModel(self._handoffsPrompt(prompt, handoffsList), debug)
+            selectedAgentName = stdout.strip()
 
-    def generateAgent(self, prompt: str, debug: bool = False) -> 'list[Agent]':
-        promptCreateAgent = f"""
-            ollama run {self.model} "You are now an AI agent.
-
-            Agent information:
-                - Agent name: {self.name}
-                - Agent instruction: {self.instruction}
-                - Prompt: {prompt}
-
-            The above list defines you. You can't make any other info up.
-            
-            You need to make the agents that are asked in the prompt, make the agents using the json. Order the agents in the order on wich they're needed for the task.
-
-            You need to give an output like this (valid JSON):
-
-            {{
-                "agents": [
-                    {{
-                        "name": "descriptiveAgentName1",
-                        "instruction": "agent1 instruction"
-                    }},
-                    {{
-                        "name": "descriptiveAgentName2",
-                        "instruction": "agent2 instruction"
-                    }}
-                ]
-            }}
-
-            Extra instructions:
-                - You need to only generate agents asked. So don't add unnecessary agents like tokenizer. 
-                - Only Respond with valid json. Don't add anything else so no: '```json'
-                
-            Follow these instructions precisely."
+            selectedAgent = AgentRegistry.get_agent(selectedAgentName)
+
+            if debug:
+                print(f"[DEBUG] selectedAgent: {selectedAgent}")
+
+            return await selectedAgent.arun(prompt, debug)
+
+
+        # Run normal
+        stdout = speculated if speculated is not None else await self.arunModel(self._normalPrompt(prompt, response), debug)
+
+        response += f"response of {self.name}: {stdout}"
+        if disableGuardrails == True:
+            return response
+        elif disableGuardrails == False:
+            return await _acheckOutputGuardrails(self, stdout, debug)
+
+
+
+
+    def _batchConcurrency(self, maxConcurrency: int) -> int:
+        # Ollama runs only a few requests of a model at the same time, OpenAI takes a lot more
+        if maxConcurrency is not None:
+            return maxConcurrency
+        return 16 if self.openAI else 4
+
+
+
+    def runMany(self, prompts, maxConcurrency: int = None, ordered: bool = True, progress=None, debug: bool = False, disableGuardrails: bool = False):
+        """Runs the agent for every prompt, at most maxConcurrency at the same time.
+
+        Yields {"index", "prompt", "result", "error"} per prompt, in the order of the prompts or
+        as they finish with ordered=False. A prompt that fails doesn't stop the others, identical
+        prompts are only run once and progress gets the stats after every prompt.
         """
-        
-        
-        if self.openAI:
-            stdout = self.runOpenAI(promptCreateAgent, debug)
-        else:
-            stdout = self.runLocalModel(prompt, debug)
-        
-        if debug:
-            print(f"\n[DEBUG] Raw stdout before cleanOutput:\n{stdout}\n")
+        batch = Batch(prompts, self._batchConcurrency(maxConcurrency), ordered, progress, debug)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=batch.maxConcurrency)
+        running = {}
 
+        try:
+            while True:
+                for prompt in batch.admit(len(running)):
+                    running[pool.submit(self.run, prompt, debug, disableGuardrails)] = prompt
+
+                yield from batch.ready()
+
+                if not running:
+                    if batch.exhausted:
+                        break
+                    continue
+
+                done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    prompt = running.pop(future)
+                    try:
+                        batch.finish(prompt, future.result(), None)
+                    except Exception as e:
+                        batch.finish(prompt, None, e)
+
+                yield from batch.ready()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+
+    async def arunMany(self, prompts, maxConcurrency: int = None, ordered: bool = True, progress=None, debug: bool = False, disableGuardrails: bool = False):
+        batch = Batch(prompts, self._batchConcurrency(maxConcurrency), ordered, progress, debug)
+        running = {}
+
+        try:
+            while True:
+                for prompt in batch.admit(len(running)):
+                    running[asyncio.ensure_future(self.arun(prompt, debug, disableGuardrails))] = prompt
+
+                for item in batch.ready():
+                    yield item
+
+                if not running:
+                    if batch.exhausted:
+                        break
+                    continue
+
+                done, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    prompt = running.pop(task)
+                    try:
+                        batch.finish(prompt, task.result(), None)
+                    except Exception as e:
+                        batch.finish(prompt, None, e)
+
+                for item in batch.ready():
+                    yield item
+        finally:
+            for task in running:
+                task.cancel()
+
+
+
+    def _streamBlocked(self, verdict: str, text: str, released: int, debug: bool = False) -> str:
+        # Text that was already checked is kept, the message goes on a new line after it
+        message = _outputGuardrailsResult(verdict, text, debug)
+        return message if released == 0 else f"\n{message}"
+
+
+
+    def _guardedStream(self, chunks, guardrailsMode: str, guardrailsInterval: int, debug: bool = False):
+        if self.outputGuardrails == None:
+            yield from chunks
+            return
+
+        text = ""
+        released = 0
+        for chunk in chunks:
+            text += chunk
+
+            if guardrailsMode == "incremental" and len(text) - released >= guardrailsInterval:
+                verdict = _outputGuardrailsVerdict(self, text, debug)
+                if verdict != "ok":
+                    chunks.close()
+                    yield self._streamBlocked(verdict, text, released, debug)
+                    return
+
+                yield text[released:]
+                released = len(text)
+
+        if released < len(text) or released == 0:
+            verdict = _outputGuardrailsVerdict(self, text, debug)
+            if verdict != "ok":
+                yield self._streamBlocked(verdict, text, released, debug)
+                return
+
+            yield text[released:]
+
+
+
+    async def _aguardedStream(self, chunks, guardrailsMode: str, guardrailsInterval: int, debug: bool = False):
+        if self.outputGuardrails == None:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        text = ""
+        released = 0
+        async for chunk in chunks:
+            text += chunk
+
+            if guardrailsMode == "incremental" and len(text) - released >= guardrailsInterval:
+                verdict = await _aoutputGuardrailsVerdict(self, text, debug)
+                if verdict != "ok":
+                    await chunks.aclose()
+                    yield self._streamBlocked(verdict, text, released, debug)
+                    return
+
+                yield text[released:]
+                released = len(text)
+
+        if released < len(text) or released == 0:
+            verdict = await _aoutputGuardrailsVerdict(self, text, debug)
+            if verdict != "ok":
+                yield self._streamBlocked(verdict, text, released, debug)
+                return
+
+            yield text[released:]
+
+
+
+    def stream(self, prompt: str, debug: bool = False, disableGuardrails: bool = False, guardrailsMode: str = "incremental", guardrailsInterval: int = 400):
+        """Same as run, but yields the response in pieces as the model generates it.
+
+        With output guardrails the text is only let through after it's checked: every
+        guardrailsInterval characters with 'incremental', or all at once with 'end'.
+        """
+        if guardrailsMode not in ("incremental", "end"):
+            raise ValueError(f"Unknown guardrails mode: {guardrailsMode}")
+
+        handoffsList = ", ".join([handoff.name for handoff in self.handoffs])
+
+        # Guardrails
+        if self.inputGuardrails != None and disableGuardrails == False:
+            blocked = self._checkInputGuardrails(prompt, debug)
+            if blocked is not None:
+                yield blocked
+                return
+
+        response = ""
+
+        # Run Tools
+        if self.tools != []:
+            response = self.runTools(prompt, debug)
+
+        # Run Handoffs
+        if self.handoffs != []:
+            selectedAgentName = self.runModel(self._handoffsPrompt(prompt, handoffsList), debug).strip()
+            selectedAgent = AgentRegistry.get_agent(selectedAgentName)
+
+            if debug:
+                print(f"[DEBUG] selectedAgent: {selectedAgent}")
+
+            yield from selectedAgent.stream(prompt, debug, guardrailsMode=guardrailsMode, guardrailsInterval=guardrailsInterval)
+            return
+
+        # Run normal
+        chunks = self.streamModel(self._normalPrompt(prompt, response), debug)
+
+        if disableGuardrails == True:
+            yield response + f"response of {self.name}: "
+            yield from chunks
+            return
+
+        yield from self._guardedStream(chunks, guardrailsMode, guardrailsInterval, debug)
+
+
+
+    async def astream(self, prompt: str, debug: bool = False, disableGuardrails: bool = False, guardrailsMode: str = "incremental", guardrailsInterval: int = 400):
+        if guardrailsMode not in ("incremental", "end"):
+            raise ValueError(f"Unknown guardrails mode: {guardrailsMode}")
+
+        handoffsList = ", ".join([handoff.name for handoff in self.handoffs])
+
+        # Guardrails
+        if self.inputGuardrails != None and disableGuardrails == False:
+            blocked = await self._acheckInputGuardrails(prompt, debug)
+            if blocked is not None:
+                yield blocked
+                return
+
+        response = ""
+
+        # Run Tools
+        if self.tools != []:
+            response = await self.arunTools(prompt, debug)
+
+        # Run Handoffs
+        if self.handoffs != []:
+            selectedAgentName = (await self.arunModel(self._handoffsPrompt(prompt, handoffsList), debug)).strip()
+            selectedAgent = AgentRegistry.get_agent(selectedAgentName)
+
+            if debug:
+                print(f"[DEBUG] selectedAgent: {selectedAgent}")
+
+            async for chunk in selectedAgent.astream(prompt, debug, guardrailsMode=guardrailsMode, guardrailsInterval=guardrailsInterval):
+                yield chunk
+            return
+
+        # Run normal
+        chunks = self.astreamModel(self._normalPrompt(prompt, response), debug)
+
+        if disableGuardrails == True:
+            yield response + f"response of {self.name}: "
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        async for chunk in self._aguardedStream(chunks, guardrailsMode, guardrailsInterval, debug):
+            yield chunk
+
+
+
+
+    def generateAgent(self, prompt: str, debug: bool = False) -> 'list[Agent]':
+        promptCreateAgent = _generateAgentTemplate.render({"name": self.name, "instruction": self.instruction}, prompt=prompt)
+
+        data = self.runStructured(promptCreateAgent, _agentsSchema, debug)
 
-        if self.openAI:
-            data = cleanOutput(stdout.choices[0].message.content, self.openAI, debug=debug)
-        elif not self.openAI:
-            data = cleanOutput(stdout, self.openAI, debug=debug)
-        
         if debug:
-            print(f"[DEBUG] Raw stdout: {stdout}")
             print(f"[DEBUG] Parsed data: {data}")
-        
-        if "agents" not in data:
+
+        if data is None:
             if debug:
-                print("[ERROR] JSON is missing 'agents' key.")
+                print("[ERROR] No agents were made.")
             return None
 
         agentObjects = []
@@ -0,0 +1,105 @@
+import time
+
+
+class Batch:
+    """Bookkeeping for Agent.runMany: which prompts to start, duplicates, ordering and progress.
+
+    Every item is a dict with index, prompt, result and error (the exception, or None).
+    """
+
+    def __init__(self, prompts, maxConcurrency: int, ordered: bool = True, progress=None, debug: bool = False):
+        self.iterator = enumerate(prompts)
+        self.maxConcurrency = max(1, maxConcurrency)
+        self.ordered = ordered
+        self.progress = progress
+        self.debug = debug
+
+        # In order, results can wait for an earlier slow prompt, so only this many prompts are read ahead
+        self.window = self.maxConcurrency * 4
+
+        self.exhausted = False
+        self.admitted = 0
+        self.nextIndex = 0
+
+        self.waiting = {}
+        self.finished = {}
+        self.buffered = {}
+        self.pending = []
+
+        self.started = time.monotonic()
+        self.done = 0
+        self.failed = 0
+        self.deduplicated = 0
+
+    def _item(self, index: int, prompt: str, result, error) -> dict:
+        return {"index": index, "prompt": prompt, "result": result, "error": error}
+
+    def _emit(self, item: dict):
+        if self.ordered:
+            self.buffered[item["index"]] = item
+        else:
+            self.pending.append(item)
+
+        self.done += 1
+        if item["error"] is not None:
+            self.failed += 1
+
+        if self.progress is not None or self.debug:
+            stats = self.stats()
+            if self.progress is not None:
+                self.progress(stats)
+            if self.debug:
+                print(f"[DEBUG] runMany: {stats['done']} done, {stats['failed']} failed, {stats['perSecond']:.2f}/s")
+
+    def admit(self, running: int) -> list:
+        """The new prompts to start, duplicates of earlier prompts share their result instead."""
+        prompts = []
+
+        while not self.exhausted and running + len(prompts) < self.maxConcurrency:
+            if self.ordered and self.admitted - self.nextIndex >= self.window:
+                break
+
+            try:
+                index, prompt = next(self.iterator)
+            except StopIteration:
+                self.exhausted = True
+                break
+
+            self.admitted += 1
+
+            if prompt in self.finished:
+                self.deduplicated += 1
+                self._emit(self._item(index, prompt, *self.finished[prompt]))
+            elif prompt in self.waiting:
+                self.deduplicated += 1
+                self.waiting[prompt].append(index)
+            else:
+                self.waiting[prompt] = [index]
+                prompts.append(prompt)
+
+        return prompts
+
+    def finish(self, prompt: str, result, error):
+        self.finished[prompt] = (result, error)
+        for index in self.waiting.pop(prompt):
+            self._emit(self._item(index, prompt, result, error))
+
+    def ready(self) -> list:
+        items = self.pending
+        self.pending = []
+
+        while self.nextIndex in self.buffered:
+            items.append(self.buffered.pop(self.nextIndex))
+            self.nextIndex += 1
+
+        return items
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "done": self.done,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+            "elapsed": elapsed,
+            "perSecond": self.done / elapsed if elapsed > 0 else 0.0,
+        }
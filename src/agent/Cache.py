@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def hashFile(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cacheKey(backend: str, model: str, prompt: str, images: list = None, params: dict = None) -> str:
+    """images are content hashes, params are the sampling parameters sent with the request."""
+    data = json.dumps({
+        "backend": backend,
+        "model": model,
+        "prompt": prompt,
+        "images": images or [],
+        "params": params or {},
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LLM responses by content hash, in a bounded memory LRU and optionally a SQLite file."""
+
+    def __init__(self, maxEntries: int = 1024, path: str = None, ttl: float = None, maxDiskEntries: int = 100000):
+        self.maxEntries = maxEntries
+        self.path = path
+        self.ttl = ttl
+        self.maxDiskEntries = maxDiskEntries
+
+        self.hits = 0
+        self.misses = 0
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.evictions = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = 0
+
+        if path is not None:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._db.commit()
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def _remember(self, key: str, value: str, created: float):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+
+        while len(self._memory) > self.maxEntries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str):
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if not self._expired(created, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memoryHits += 1
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, created = row
+                    if not self._expired(created, now):
+                        self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                        self._remember(key, value, created)
+                        self.hits += 1
+                        self.diskHits += 1
+                        return value
+
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str):
+        now = time.time()
+
+        with self._lock:
+            self._remember(key, value, now)
+
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)", (key, value, now, now))
+                self._writes += 1
+
+                # Trimming the file on every write is wasteful, every 100 writes is close enough
+                if self._writes % 100 == 0:
+                    self._evictDisk(now)
+
+                self._db.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._memory.pop(key, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+
+    def _evictDisk(self, now: float):
+        if self.ttl is not None:
+            cursor = self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self.evictions += cursor.rowcount
+
+        count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.maxDiskEntries:
+            cursor = self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed ASC LIMIT ?)",
+                (count - self.maxDiskEntries,),
+            )
+            self.evictions += cursor.rowcount
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memoryHits": self.memoryHits,
+                "diskHits": self.diskHits,
+                "evictions": self.evictions,
+                "entries": len(self._memory),
+                "hitRate": self.hits / total if total else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_responseCache = None
+
+def setResponseCache(cache: ResponseCache):
+    # None turns the cache off
+    global _responseCache
+    _responseCache = cache
+
+
+def getResponseCache() -> ResponseCache:
+    return _responseCache
+
+
+
+class GuardrailCache:
+    """Guardrail verdicts ('ok' or 'triggered') by guardrails, model and a hash of the checked text."""
+
+    _verdicts = OrderedDict()
+    _lock = threading.Lock()
+    _maxEntries = 4096
+    _enabled = True
+
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def configure(cls, maxEntries: int = None, enabled: bool = None):
+        with cls._lock:
+            if maxEntries is not None:
+                cls._maxEntries = maxEntries
+            if enabled is not None:
+                cls._enabled = enabled
+
+            while len(cls._verdicts) > cls._maxEntries:
+                cls._verdicts.popitem(last=False)
+
+    @classmethod
+    def _key(cls, kind: str, guardrails: str, model: str, text: str) -> tuple:
+        return (kind, guardrails, model, hashlib.sha256(text.encode("utf-8")).hexdigest())
+
+    @classmethod
+    def get(cls, kind: str, guardrails: str, model: str, text: str):
+        if not cls._enabled:
+            return None
+
+        key = cls._key(kind, guardrails, model, text)
+        with cls._lock:
+            verdict = cls._verdicts.get(key)
+            if verdict is None:
+                cls.misses += 1
+                return None
+
+            cls._verdicts.move_to_end(key)
+            cls.hits += 1
+            return verdict
+
+    @classmethod
+    def set(cls, kind: str, guardrails: str, model: str, text: str, verdict: str):
+        # Only real verdicts are kept, a response that couldn't be read should be checked again
+        if not cls._enabled or verdict not in ("ok", "triggered"):
+            return
+
+        key = cls._key(kind, guardrails, model, text)
+        with cls._lock:
+            cls._verdicts[key] = verdict
+            cls._verdicts.move_to_end(key)
+
+            while len(cls._verdicts) > cls._maxEntries:
+                cls._verdicts.popitem(last=False)
+
+    @classmethod
+    def invalidate(cls, guardrails: str = None):
+        # Without guardrails everything is removed
+        with cls._lock:
+            if guardrails is None:
+                cls._verdicts.clear()
+                return
+
+            for key in [key for key in cls._verdicts if key[1] == guardrails]:
+                del cls._verdicts[key]
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {"hits": cls.hits, "misses": cls.misses, "entries": len(cls._verdicts)}
@@ -1,106 +1,395 @@
 import json
+import asyncio
 
 from agent.Agent import Agent
 from agent.Config import ModelConfig
-from agent.CleanOutput import cleanOutput
+from agent.ExitCondition import exitEvaluators, checkExit
+from agent.Transcript import Transcript
+from agent.Checkpoint import CheckpointStore, newRunId
+from agent.Prompt import PromptTemplate
+from agent.Graph import checkCycles, runGraph, arunGraph
+
+# Only the conversation changes between the judge calls of a run, so it comes last
+_exitTemplate = PromptTemplate(
+    prefix="""
+        You are now an AI agent.
+
+        Agent information:
+            - Agent instruction: {instruction}
+            - The exit condition: {exitValue}
+
+        The agent information defines you. You can't make any other info up.
+
+        You need to decide if the exit conditions have been met. Set exitCondition to yes if they have been met and no if not.
+        If they have been met, put the answer to the prompt in goodAnswerToPrompt (e.g. "The answer to 4+1=5"), otherwise leave it empty.
+
+        Prompt: {prompt}
+    """,
+    suffix="""
+        The conversation: {conversation}
+    """,
+)
+
+_judgeSchema = {
+    "type": "object",
+    "properties": {
+        "exitCondition": {"enum": ["yes", "no"]},
+        "goodAnswerToPrompt": {"type": "string"},
+    },
+    "required": ["exitCondition", "goodAnswerToPrompt"],
+}
 
 class Chain:
-    def __init__(self, agents: list['Agent']):
+    def __init__(self, agents: list['Agent'], tokenBudget: int = None, keepRecent: int = 4, dependencies: dict = None, maxConcurrency: int = 4, checkpoint: CheckpointStore = None):
+        # With a token budget older responses are summarized so the prompt stays under it
         self.agents = agents
-    
+        self.tokenBudget = tokenBudget
+        self.keepRecent = keepRecent
+
+        # With a checkpoint store every runUntil step is saved and a run can be resumed by its run ID
+        self.checkpoint = checkpoint
+        self.lastRunId = None
+
+        # With dependencies ({agent name: [agent names it needs]}) the chain runs as a graph,
+        # an agent only gets the responses of the agents it depends on and independent agents run at the same time
+        self.dependencies = None
+        self.maxConcurrency = max(1, maxConcurrency)
+
+        if dependencies is not None:
+            names = [agent.name for agent in agents]
+            unknown = {name: deps for name, deps in dependencies.items() if name not in names or any(dep not in names for dep in deps)}
+            if unknown:
+                raise ValueError(f"Unknown agents in chain dependencies: {unknown}")
+
+            self.dependencies = {name: list(dependencies.get(name, [])) for name in names}
+            checkCycles(names, self.dependencies, "Chain")
+
+    def _transcript(self, prompt: str, debug: bool = False) -> Transcript:
+        return Transcript(prompt, self.tokenBudget, self.keepRecent, debug)
+
+    def _graphTranscript(self, prompt: str, name: str, results: dict, debug: bool = False) -> Transcript:
+        # The responses of the dependencies, in chain order
+        transcript = self._transcript(prompt, debug)
+        for agent in self.agents:
+            if agent.name in self.dependencies[name]:
+                transcript.add(agent.name, results[agent.name])
+        return transcript
+
+    def _graphResult(self, name: str, result, debug: bool = False):
+        if debug:
+            print(f"[DEBUG] Results {name}: {result}")
+        return result
+
+    def _executeGraph(self, prompt: str, disableGuardrails: bool = False, debug: bool = False) -> dict:
+        agents = {agent.name: agent for agent in self.agents}
+
+        def runAgent(name, results):
+            currentPrompt = self._graphTranscript(prompt, name, results, debug).render()
+            return self._graphResult(name, agents[name].run(currentPrompt, debug, disableGuardrails), debug)
+
+        results = runGraph(list(agents), self.dependencies, runAgent, self.maxConcurrency)
+        return {agent.name: results[agent.name] for agent in self.agents}
+
+    async def _aexecuteGraph(self, prompt: str, disableGuardrails: bool = False, debug: bool = False) -> dict:
+        agents = {agent.name: agent for agent in self.agents}
+
+        async def runAgent(name, results):
+            currentPrompt = await self._graphTranscript(prompt, name, results, debug).arender()
+            return self._graphResult(name, await agents[name].arun(currentPrompt, debug, disableGuardrails), debug)
+
+        results = await arunGraph(list(agents), self.dependencies, runAgent, self.maxConcurrency)
+        return {agent.name: results[agent.name] for agent in self.agents}
+
     def execute(self, prompt: str, disableGuardrails: bool = False, debug: bool = False) -> dict:
+        if self.dependencies is not None:
+            if debug:
+                print(f"[DEBUG] agents in crew: {self.agents}")
+                print(f"[DEBUG] dependencies: {self.dependencies}")
+            return self._executeGraph(prompt, disableGuardrails, debug)
+
         results = {}
-        currentPrompt = prompt
-        
+        transcript = self._transcript(prompt, debug)
+
         if debug:
             print(f"[DEBUG] agents in crew: {self.agents}")
 
         for agent in self.agents:
-            result = agent.run(currentPrompt, debug, disableGuardrails)
+            result = agent.run(transcript.render(), debug, disableGuardrails)
             results[agent.name] = result
-            
+
             if debug:
                 print(f"[DEBUG] Results {agent.name}: {result}")
-                
-            currentPrompt += f"\n{agent.name} response: {result}"
+
+            transcript.add(agent.name, result)
 
         return results
 
 
 
+    async def aexecute(self, prompt: str, disableGuardrails: bool = False, debug: bool = False) -> dict:
+        if self.dependencies is not None:
+            if debug:
+                print(f"[DEBUG] agents in crew: {self.agents}")
+                print(f"[DEBUG] dependencies: {self.dependencies}")
+            return await self._aexecuteGraph(prompt, disableGuardrails, debug)
 
-    def runUntil(self, prompt: str, exitValue: str, maxRuns: int = 0, disableGuardrails: bool = False, debug: bool = False) -> str:
         results = {}
-        currentPrompt = prompt
+        transcript = self._transcript(prompt, debug)
+
+        if debug:
+            print(f"[DEBUG] agents in crew: {self.agents}")
+
+        for agent in self.agents:
+            result = await agent.arun(await transcript.arender(), debug, disableGuardrails)
+            results[agent.name] = result
+
+            if debug:
+                print(f"[DEBUG] Results {agent.name}: {result}")
+
+            transcript.add(agent.name, result)
+
+        return results
+
+
+
+    def stream(self, prompt: str, disableGuardrails: bool = False, debug: bool = False, guardrailsMode: str = "incremental"):
+        """Runs every agent but the last one like execute, then yields the response of the last agent as it's generated."""
+        if self.dependencies is not None:
+            raise ValueError("Only chains without dependencies can be streamed")
+
+        transcript = self._transcript(prompt, debug)
+
+        for agent in self.agents[:-1]:
+            result = agent.run(transcript.render(), debug, disableGuardrails)
+
+            if debug:
+                print(f"[DEBUG] Results {agent.name}: {result}")
+
+            transcript.add(agent.name, result)
+
+        yield from self.agents[-1].stream(transcript.render(), debug, disableGuardrails, guardrailsMode)
+
+
+
+    async def astream(self, prompt: str, disableGuardrails: bool = False, debug: bool = False, guardrailsMode: str = "incremental"):
+        if self.dependencies is not None:
+            raise ValueError("Only chains without dependencies can be streamed")
+
+        transcript = self._transcript(prompt, debug)
+
+        for agent in self.agents[:-1]:
+            result = await agent.arun(await transcript.arender(), debug, disableGuardrails)
+
+            if debug:
+                print(f"[DEBUG] Results {agent.name}: {result}")
+
+            transcript.add(agent.name, result)
+
+        async for chunk in self.agents[-1].astream(await transcript.arender(), debug, disableGuardrails, guardrailsMode):
+            yield chunk
 
-        maxRuns = maxRuns * len(self.agents)
 
-        _agent = Agent(
+
+    def _exitAgent(self) -> Agent:
+        return Agent(
             name="agent",
             instruction="You need to decide if the exit conditions are met.",
             model=ModelConfig.getDefaultModel(),
             openAI=ModelConfig.getDefaultOpenAI(),
+            register=False,
         )
 
+
+
+    def _exitPrompt(self, _agent: Agent, prompt: str, currentPrompt: str, exitValue: str) -> str:
+        return _exitTemplate.render({"instruction": _agent.instruction, "exitValue": exitValue, "prompt": prompt}, conversation=currentPrompt)
+
+
+
+
+    def _judge(self, _agent: Agent, prompt: str, currentPrompt: str, exitValue: str, debug: bool = False) -> tuple:
+        data = _agent.runStructured(self._exitPrompt(_agent, prompt, currentPrompt, exitValue), _judgeSchema, debug=debug)
+        return self._judgeVerdict(data, debug)
+
+    async def _ajudge(self, _agent: Agent, prompt: str, currentPrompt: str, exitValue: str, debug: bool = False) -> tuple:
+        data = await _agent.arunStructured(self._exitPrompt(_agent, prompt, currentPrompt, exitValue), _judgeSchema, debug=debug)
+        return self._judgeVerdict(data, debug)
+
+    def _judgeVerdict(self, data: dict, debug: bool = False) -> tuple:
+        if debug:
+            print(f"[DEBUG] JSON output from decision agent: {data}")
+
+        if not isinstance(data, dict):
+            return False, None
+
+        if data.get("exitCondition") == "yes":
+            return True, data.get("goodAnswerToPrompt", "")
+        return False, None
+
+
+
+    def _runUntilSetup(self, exitValue, judge: str, debug: bool = False) -> tuple:
+        # A str exitValue is judged by a model after every round, local evaluators are checked after every agent
+        # and the judge (if set) is only asked when none of them could tell
+        evaluators = exitEvaluators(exitValue)
+        judgeValue = exitValue if evaluators is None else judge
+        _agent = self._exitAgent() if judgeValue is not None else None
+
         if debug:
-            print(f"[DEBUG] _agent.openAI: {_agent.openAI}")
+            if _agent is not None:
+                print(f"[DEBUG] _agent.openAI: {_agent.openAI}")
             print(f"[DEBUG] agents in crew: {self.agents}")
             print(f"[DEBUG] exitCondition: {exitValue}")
-        
-        i = 0
+
+        return evaluators, judgeValue, _agent
+
+
+
+    def _runId(self, runId: str) -> str:
+        if self.checkpoint is not None and runId is None:
+            runId = newRunId()
+        self.lastRunId = runId
+        return runId
+
+    def _saveStep(self, runId: str, prompt: str, round: int, nextAgent: int, inconclusive: bool, results: dict, transcript: Transcript, finished: bool = False, answer=None):
+        if self.checkpoint is None:
+            return
+
+        self.checkpoint.save(runId, "runUntil", round * len(self.agents) + nextAgent, {
+            "prompt": prompt,
+            "round": round,
+            "nextAgent": nextAgent,
+            "inconclusive": inconclusive,
+            "results": results,
+            "transcript": transcript.state(),
+            "finished": finished,
+            "answer": answer,
+        })
+
+    def _finish(self, runId: str, prompt: str, round: int, results: dict, transcript: Transcript, answer):
+        self._saveStep(runId, prompt, round, 0, True, results, transcript, True, answer)
+        return answer
+
+    def _resume(self, runId: str, prompt: str, results: dict, transcript: Transcript, debug: bool = False) -> dict:
+        if self.checkpoint is None:
+            return None
+
+        state = self.checkpoint.load(runId, "runUntil")
+        if state is None:
+            return None
+        if state["prompt"] != prompt:
+            raise ValueError(f"Run {runId} was started with a different prompt")
+
+        results.update(state["results"])
+        transcript.restore(state["transcript"])
+
+        if debug:
+            print(f"[DEBUG] Resuming run {runId} at round {state['round']}, agent {state['nextAgent']}")
+
+        return state
+
+
+
+    def runUntil(self, prompt: str, exitValue, maxRuns: int = 0, disableGuardrails: bool = False, debug: bool = False, judge: str = None, runId: str = None) -> str:
+        results = {}
+        transcript = self._transcript(prompt, debug)
+
+        maxRuns = maxRuns * len(self.agents)
+
+        evaluators, judgeValue, _agent = self._runUntilSetup(exitValue, judge, debug)
+
+        runId = self._runId(runId)
+        state = self._resume(runId, prompt, results, transcript, debug)
+
+        if state is not None and state["finished"]:
+            return state["answer"]
+
+        i = state["round"] if state else 0
+        start = state["nextAgent"] if state else 0
+        inconclusive = state["inconclusive"] if state else True
 
         while i < maxRuns:
-            for agent in self.agents:
-                result = agent.run(currentPrompt, debug, disableGuardrails)
+            for j in range(start, len(self.agents)):
+                agent = self.agents[j]
+                result = agent.run(transcript.render(), debug, disableGuardrails)
                 results[agent.name] = result
 
                 if debug:
                     print(f"[DEBUG] Results {agent.name}: {result}")
 
-                currentPrompt += f"\n{agent.name} response: {result}"
+                transcript.add(agent.name, result)
 
-            promptRunUntilExitValue = f"""
-                "You are now an AI agent.
+                if evaluators is not None:
+                    verdict, answer = checkExit(evaluators, result, debug)
+                    if verdict:
+                        return self._finish(runId, prompt, i, results, transcript, answer)
+                    if verdict is False:
+                        inconclusive = False
 
-                    Agent information:
-                        - Agent instruction: {_agent.instruction}
-                        - Prompt: {prompt}
-                        - The conversation: {currentPrompt}
-                        - The exit condition: {exitValue}
+                self._saveStep(runId, prompt, i, j + 1, inconclusive, results, transcript)
 
-                    The above list defines you. You can't make any other info up.
+            start = 0
+            i += 1
 
-                    You need to decide if the exit conditions have been met. If so, respond with a JSON like this:
+            if _agent is not None and inconclusive:
+                verdict, answer = self._judge(_agent, prompt, transcript.render(), judgeValue, debug)
+                if verdict:
+                    return self._finish(runId, prompt, i, results, transcript, answer)
 
-                    {{
-                        "exitCondition": "yes", # make it no if it hasn't been met.
-                        "goodAnswerToPrompt": "The answer to 4+1=5" # leave empty if exit condition is no
-                    }}
+            inconclusive = True
+            self._saveStep(runId, prompt, i, 0, inconclusive, results, transcript)
 
-                    Extra instructions:
-                        - Only respond with valid JSON. Don't add anything else.
-                        - Never use codeblocks (```json ... ```)
-                "
-            """
+        return self._finish(runId, prompt, i, results, transcript, results)
 
-            if _agent.openAI:
-                stdout = _agent.runOpenAI(promptRunUntilExitValue, debug=debug)
-            else:
-                stdout = _agent.runLocalModel(promptRunUntilExitValue, debug=debug)
 
-            data = cleanOutput(stdout, ModelConfig.getDefaultOpenAI(), debug=debug)
 
-            if debug:
-                print(f"[DEBUG] JSON output from decision agent: {data}")
+    async def arunUntil(self, prompt: str, exitValue, maxRuns: int = 0, disableGuardrails: bool = False, debug: bool = False, judge: str = None, runId: str = None) -> str:
+        results = {}
+        transcript = self._transcript(prompt, debug)
+
+        maxRuns = maxRuns * len(self.agents)
+
+        evaluators, judgeValue, _agent = self._runUntilSetup(exitValue, judge, debug)
+
+        runId = self._runId(runId)
+        state = self._resume(runId, prompt, results, transcript, debug)
+
+        if state is not None and state["finished"]:
+            return state["answer"]
+
+        i = state["round"] if state else 0
+        start = state["nextAgent"] if state else 0
+        inconclusive = state["inconclusive"] if state else True
+
+        while i < maxRuns:
+            for j in range(start, len(self.agents)):
+                agent = self.agents[j]
+                result = await agent.arun(await transcript.arender(), debug, disableGuardrails)
+                results[agent.name] = result
 
-            i += 1
-            
-            try:
-                if data.get("exitCondition") == "yes":
-                    return data.get("goodAnswerToPrompt", "")
-            except Exception as e:
                 if debug:
-                    print(f"[DEBUG] Failed to parse JSON output: {e}")
-                    print(f"[DEBUG] Raw output: {data}")
+                    print(f"[DEBUG] Results {agent.name}: {result}")
+
+                transcript.add(agent.name, result)
+
+                if evaluators is not None:
+                    verdict, answer = checkExit(evaluators, result, debug)
+                    if verdict:
+                        return self._finish(runId, prompt, i, results, transcript, answer)
+                    if verdict is False:
+                        inconclusive = False
+
+                self._saveStep(runId, prompt, i, j + 1, inconclusive, results, transcript)
+
+            start = 0
+            i += 1
+
+            if _agent is not None and inconclusive:
+                verdict, answer = await self._ajudge(_agent, prompt, await transcript.arender(), judgeValue, debug)
+                if verdict:
+                    return self._finish(runId, prompt, i, results, transcript, answer)
+
+            inconclusive = True
+            self._saveStep(runId, prompt, i, 0, inconclusive, results, transcript)
 
-        return results
\ No newline at end of file
+        return self._finish(runId, prompt, i, results, transcript, results)
@@ -0,0 +1,61 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+
+def newRunId() -> str:
+    return uuid.uuid4().hex
+
+
+class CheckpointStore:
+    """The last completed step of every run in a SQLite file, so a run can be resumed by its run ID."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS checkpoints (runId TEXT PRIMARY KEY, kind TEXT NOT NULL, step INTEGER NOT NULL, state TEXT NOT NULL, updated REAL NOT NULL)")
+        self._db.commit()
+
+    def save(self, runId: str, kind: str, step: int, state: dict):
+        # Only the last step is kept, earlier ones are in it anyway
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints (runId, kind, step, state, updated) VALUES (?, ?, ?, ?, ?)",
+                (runId, kind, step, json.dumps(state, default=str), time.time()),
+            )
+            self._db.commit()
+
+    def load(self, runId: str, kind: str = None) -> dict:
+        with self._lock:
+            row = self._db.execute("SELECT kind, state FROM checkpoints WHERE runId = ?", (runId,)).fetchone()
+
+        if row is None:
+            return None
+        if kind is not None and row[0] != kind:
+            raise ValueError(f"Run {runId} is a {row[0]} run, not a {kind} run")
+        return json.loads(row[1])
+
+    def delete(self, runId: str):
+        with self._lock:
+            self._db.execute("DELETE FROM checkpoints WHERE runId = ?", (runId,))
+            self._db.commit()
+
+    def runs(self) -> list:
+        with self._lock:
+            rows = self._db.execute("SELECT runId, kind, step, updated FROM checkpoints ORDER BY updated DESC").fetchall()
+        return [{"runId": runId, "kind": kind, "step": step, "updated": updated} for runId, kind, step, updated in rows]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -1,7 +1,156 @@
 import re
 import json
+import time
+
+# Outside a string only braces and quotes matter, inside a string only quotes and escapes
+_outside = re.compile(r'[{}"]')
+_inside = re.compile(r'["\\]')
+_trailingComma = re.compile(r'("(?:[^"\\]|\\.)*")|,(\s*[}\]])')
+
+
+def _removeTrailingCommas(text: str) -> str:
+    return _trailingComma.sub(lambda match: match.group(1) or match.group(2), text)
+
+
+def _loads(text: str):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
 
-def cleanOutput(stdout: any, openAI: bool, debug: bool = False): 
+    try:
+        return json.loads(_removeTrailingCommas(text))
+    except ValueError:
+        return None
+
+
+class JsonExtractor:
+    """Finds the first complete JSON object in model output, fed all at once or chunk by chunk.
+
+    Code fences, prose around the object and trailing commas are ignored. With key, only an object
+    with that top-level key counts. feed() returns the object as soon as its closing brace comes in.
+    """
+
+    def __init__(self, key: str = None, debug: bool = False):
+        self.key = key
+        self.debug = debug
+        self.text = ""
+        self.result = None
+        self.done = False
+
+        self._position = 0
+        self._start = None
+        self._depth = 0
+        self._inString = False
+
+    def _accept(self, data) -> bool:
+        return isinstance(data, dict) and (self.key is None or self.key in data)
+
+    def feed(self, chunk: str):
+        if self.done:
+            return self.result
+
+        self.text += chunk
+        text = self.text
+        i = self._position
+
+        while True:
+            if self._inString:
+                match = _inside.search(text, i)
+                if match is None:
+                    i = len(text)
+                    break
+                if match.group() == "\\":
+                    if match.end() >= len(text):
+                        # The escaped character is in the next chunk
+                        i = match.start()
+                        break
+                    i = match.end() + 1
+                    continue
+                self._inString = False
+                i = match.end()
+                continue
+
+            match = _outside.search(text, i)
+            if match is None:
+                i = len(text)
+                break
+
+            char = match.group()
+            i = match.end()
+
+            # Quotes only start a string inside an object, in prose they're just quotes
+            if char == '"':
+                if self._depth > 0:
+                    self._inString = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._start = match.start()
+                self._depth += 1
+            elif self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    data = _loads(text[self._start:i])
+                    if self._accept(data):
+                        self.result = data
+                        self.done = True
+                        break
+                    self._start = None
+
+        self._position = i
+        return self.result
+
+    def finish(self):
+        """The object, or a last try when the text never balanced (e.g. a stray brace in the prose before it)."""
+        if self.done:
+            return self.result
+
+        decoder = json.JSONDecoder()
+        text = _removeTrailingCommas(self.text)
+        index = text.find("{")
+        while index != -1:
+            try:
+                data, _ = decoder.raw_decode(text, index)
+                if self._accept(data):
+                    self.result = data
+                    break
+            except ValueError:
+                pass
+            index = text.find("{", index + 1)
+
+        if self.result is None and self.debug:
+            print(f"[ERROR] No JSON object{'' if self.key is None else f' with {self.key!r}'} found in output:\n{self.text}")
+
+        self.done = True
+        return self.result
+
+
+def extractJson(source, key: str = None, debug: bool = False):
+    """The first JSON object in source (a string or an iterable of chunks, e.g. a stream), or None.
+
+    A stream is only read up to the end of the object.
+    """
+    if isinstance(source, dict):
+        return source if key is None or key in source else None
+
+    if isinstance(source, str):
+        # Most of the time the output is just the JSON, json.loads is the fastest way to find out
+        try:
+            data = json.loads(source)
+            if isinstance(data, dict) and (key is None or key in data):
+                return data
+        except ValueError:
+            pass
+        source = (source,)
+
+    extractor = JsonExtractor(key=key, debug=debug)
+    for chunk in source:
+        if extractor.feed(chunk) is not None:
+            return extractor.result
+    return extractor.finish()
+
+
+def cleanOutput(stdout: any, openAI: bool, debug: bool = False):
     try:
         # Als stdout al een dict is, direct teruggeven
         if isinstance(stdout, dict):
@@ -10,12 +159,7 @@ def cleanOutput(stdout: any, openAI: bool, debug: bool = False):
                 print(f"[DEBUG] data: {stdout}")
             return stdout
 
-        content = stdout.strip()
-
-        # Strip eventueel markdown zoals ```json\n...\n```
-        clean_output = re.sub(r"^```(?:json)?\n|\n```$", "", content)
-
-        data = json.loads(clean_output)
+        data = extractJson(stdout, debug=debug)
 
         if debug:
             print(f"[DEBUG] openAI: {openAI}")
@@ -27,3 +171,58 @@ def cleanOutput(stdout: any, openAI: bool, debug: bool = False):
         if debug:
             print(f"[ERROR] Failed to clean/parse output: {e}")
         return None
+
+
+def benchmark(repeat: int = 2000):
+    """Times extractJson against the old cleanOutput and extract_json on typical model output.
+
+    Prints the time per call and whether each one found the object.
+    """
+    def oldCleanOutput(stdout):
+        try:
+            return json.loads(re.sub(r"^```(?:json)?\n|\n```$", "", stdout.strip()))
+        except Exception:
+            return None
+
+    def oldExtractJson(raw):
+        raw = re.sub(r"```(?:json)?", "", raw).replace("```", "").strip()
+        match = re.search(r'({\s*"parameters"\s*:\s*{[^{}]*}\s*})', raw, re.DOTALL)
+        try:
+            return json.loads(match.group(0)) if match else None
+        except ValueError:
+            return None
+
+    parameters = '{"parameters": {"city": "Amsterdam", "days": 3, "units": "metric"}}'
+    cases = {
+        "clean": parameters,
+        "fenced": f"```json\n{parameters}\n```",
+        "prose": f"Sure! Here are the parameters:\n{parameters}\nLet me know if you need anything else.",
+        "trailing comma": '{"parameters": {"city": "Amsterdam", "days": 3,},}',
+        "nested": '{"parameters": {"location": {"city": "Amsterdam", "country": "NL"}, "days": [1, 2, 3]}}',
+        "large": json.dumps({"parameters": {f"key{i}": {"value": "x" * 20, "list": list(range(5))} for i in range(200)}}),
+    }
+    functions = {
+        "cleanOutput (old)": oldCleanOutput,
+        "extract_json (old)": oldExtractJson,
+        "extractJson": lambda text: extractJson(text, key="parameters"),
+    }
+
+    for case, text in cases.items():
+        print(f"{case} ({len(text)} chars)")
+        for name, function in functions.items():
+            started = time.perf_counter()
+            for _ in range(repeat):
+                data = function(text)
+            perCall = (time.perf_counter() - started) / repeat * 1e6
+            print(f"    {name:<20} {perCall:8.1f} µs  {'found' if data is not None else 'failed'}")
+
+    # The same object as a token stream, parsed as soon as it closes
+    tokens = [parameters[i:i + 4] for i in range(0, len(parameters), 4)] + ["\nSome text after it"] * 50
+    started = time.perf_counter()
+    for _ in range(repeat):
+        data = extractJson(iter(tokens), key="parameters")
+    print(f"stream ({len(tokens)} chunks)\n    {'extractJson':<20} {(time.perf_counter() - started) / repeat * 1e6:8.1f} µs  {'found' if data is not None else 'failed'}")
+
+
+if __name__ == "__main__":
+    benchmark()
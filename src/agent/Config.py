@@ -1,6 +1,10 @@
+import os
+
 class ModelConfig:
     _model = "llama3.1"
     _openai = False
+    _ollamaHost = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
+    _keepAlive = None
 
     @classmethod
     def setDefaultModel(cls, model: str, openAI: bool):
@@ -14,3 +18,20 @@ class ModelConfig:
     @classmethod
     def getDefaultOpenAI(cls):
         return cls._openai
+
+    @classmethod
+    def setOllamaHost(cls, host: str):
+        cls._ollamaHost = host
+
+    @classmethod
+    def getOllamaHost(cls):
+        return cls._ollamaHost
+
+    @classmethod
+    def setKeepAlive(cls, keepAlive):
+        # e.g. "10m", 3600 or -1 to keep the model loaded forever
+        cls._keepAlive = keepAlive
+
+    @classmethod
+    def getKeepAlive(cls):
+        return cls._keepAlive
@@ -0,0 +1,102 @@
+import re
+
+from agent.CleanOutput import extractJson
+
+_missing = object()
+
+
+def _readJson(text: str, key: str = None):
+    if not isinstance(text, (str, dict)):
+        return None
+    return extractJson(text, key=key)
+
+
+class Regex:
+    """Exits when the response matches, the answer is the matched group. No match is inconclusive."""
+
+    def __init__(self, pattern, group=0, flags: int = 0):
+        self.pattern = re.compile(pattern, flags) if isinstance(pattern, str) else pattern
+        self.group = group
+
+    def __call__(self, result: str):
+        match = self.pattern.search(result)
+        if match is None:
+            return None
+        return match.group(self.group)
+
+    def __repr__(self):
+        return f"Regex({self.pattern.pattern!r})"
+
+
+class JsonField:
+    """Checks a field of a JSON response against a value or a predicate.
+
+    The answer is answerField of the JSON if it's set, else the whole response.
+    A response without JSON or without the field is inconclusive.
+    """
+
+    def __init__(self, field: str, value=_missing, predicate=None, answerField: str = None):
+        self.field = field
+        self.value = value
+        self.predicate = predicate
+        self.answerField = answerField
+
+    def __call__(self, result: str):
+        data = _readJson(result, self.field)
+        if not isinstance(data, dict) or self.field not in data:
+            return None
+
+        fieldValue = data[self.field]
+        if self.predicate is not None:
+            met = bool(self.predicate(fieldValue))
+        elif self.value is not _missing:
+            met = fieldValue == self.value
+        else:
+            met = bool(fieldValue)
+
+        if not met:
+            return False
+        if self.answerField is not None:
+            return str(data.get(self.answerField, ""))
+        return True
+
+    def __repr__(self):
+        return f"JsonField({self.field!r})"
+
+
+def exitEvaluators(exitValue) -> list:
+    """The local evaluators in exitValue, or None when exitValue is a description for the LLM judge."""
+    if exitValue is None or isinstance(exitValue, str):
+        return None
+
+    values = exitValue if isinstance(exitValue, (list, tuple)) else [exitValue]
+    return [Regex(value) if isinstance(value, re.Pattern) else value for value in values]
+
+
+def checkExit(evaluators: list, result: str, debug: bool = False) -> tuple:
+    """Returns (verdict, answer). verdict is True to exit, False if not met and None if inconclusive.
+
+    An evaluator returns True (exit with the response), a str (exit with that answer),
+    False (not met) or None (inconclusive). The first evaluator that says exit wins.
+    """
+    verdict = None
+
+    for evaluator in evaluators:
+        try:
+            outcome = evaluator(result)
+        except Exception as e:
+            if debug:
+                print(f"[DEBUG] Exit evaluator {evaluator} failed: {e}")
+            continue
+
+        if debug:
+            print(f"[DEBUG] Exit evaluator {evaluator}: {outcome}")
+
+        if isinstance(outcome, str):
+            return True, outcome
+        if outcome is True:
+            return True, result
+        if outcome is False:
+            verdict = False
+
+    return verdict, None
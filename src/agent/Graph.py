@@ -0,0 +1,106 @@
+import time
+import asyncio
+import concurrent.futures
+
+
+def checkCycles(order: list, dependencies: dict, kind: str):
+    """Raises a ValueError with the cycle if the dependencies ({name: [names it needs]}) have one."""
+    visited = set()
+    visiting = set()
+
+    def visit(name, path):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"{kind} dependency cycle: {' -> '.join(path + [name])}")
+
+        visiting.add(name)
+        for dep in dependencies[name]:
+            visit(dep, path + [name])
+        visiting.discard(name)
+        visited.add(name)
+
+    for name in order:
+        visit(name, [])
+
+
+def _depResults(name: str, dependencies: dict, results: dict) -> dict:
+    return {dep: results[dep] for dep in dependencies[name]}
+
+
+def runGraph(order: list, dependencies: dict, task, maxConcurrency: int, timeout: float = None, onTimeout=None) -> dict:
+    """Runs task(name, results of its dependencies) for every name in its own thread and returns {name: result}.
+
+    A name starts as soon as its dependencies are done, at most maxConcurrency at the same time.
+    With a timeout a task that takes longer gets onTimeout(name) as its result.
+    """
+    results = {}
+    pending = list(order)
+    running = {}
+
+    # Every task gets its own worker so a task that timed out doesn't take a slot from the others
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(order)))
+
+    try:
+        while pending or running:
+            for name in list(pending):
+                if len(running) >= maxConcurrency:
+                    break
+                if all(dep in results for dep in dependencies[name]):
+                    pending.remove(name)
+                    future = pool.submit(task, name, _depResults(name, dependencies, results))
+                    running[future] = (name, time.monotonic())
+
+            waitFor = None
+            if timeout is not None:
+                now = time.monotonic()
+                waitFor = max(0, min(started + timeout - now for _, started in running.values()))
+
+            done, _ = concurrent.futures.wait(running.keys(), timeout=waitFor, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                name, _ = running.pop(future)
+                results[name] = future.result()
+
+            if timeout is not None:
+                now = time.monotonic()
+                for future, (name, started) in list(running.items()):
+                    if now - started >= timeout:
+                        running.pop(future)
+                        future.cancel()
+                        results[name] = onTimeout(name)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+
+async def arunGraph(order: list, dependencies: dict, task, maxConcurrency: int, timeout: float = None, onTimeout=None) -> dict:
+    """Async version of runGraph, task(name, results) returns an awaitable."""
+    results = {}
+    tasks = {}
+    semaphore = asyncio.Semaphore(maxConcurrency)
+
+    async def runTask(name):
+        for dep in dependencies[name]:
+            await tasks[dep]
+
+        async with semaphore:
+            try:
+                results[name] = await asyncio.wait_for(task(name, _depResults(name, dependencies, results)), timeout=timeout)
+            except asyncio.TimeoutError:
+                if onTimeout is None:
+                    raise
+                results[name] = onTimeout(name)
+
+    # The dependencies have no cycles, so every task can be made before any of them runs
+    for name in order:
+        tasks[name] = asyncio.ensure_future(runTask(name))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for pending in tasks.values():
+            pending.cancel()
+
+    return results
@@ -0,0 +1,154 @@
+import io
+import os
+import base64
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+
+_signatures = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+
+def mimeType(data: bytes, path: str = None) -> str:
+    for signature, mime in _signatures:
+        if data.startswith(signature):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+
+    # Not a format we know by its first bytes, so go by the extension
+    guessed = mimetypes.guess_type(path)[0] if path else None
+    return guessed or "application/octet-stream"
+
+
+class ImageCache:
+    """Encoded images by path, modification time and size, so a file is only read and encoded once.
+
+    Images bigger than maxSide pixels or maxFileBytes bytes are downscaled or recompressed
+    before they're sent, that needs Pillow. Without it images are sent as they are.
+    """
+
+    _entries = OrderedDict()
+    _lock = threading.Lock()
+
+    _maxBytes = 64 * 1024 * 1024
+    _maxSide = 2048
+    _maxFileBytes = 4 * 1024 * 1024
+    _quality = 85
+
+    _currentBytes = 0
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def configure(cls, maxBytes: int = None, maxSide: int = None, maxFileBytes: int = None, quality: int = None):
+        with cls._lock:
+            if maxBytes is not None:
+                cls._maxBytes = maxBytes
+            if maxSide is not None:
+                cls._maxSide = maxSide
+            if maxFileBytes is not None:
+                cls._maxFileBytes = maxFileBytes
+            if quality is not None:
+                cls._quality = quality
+
+            # Images encoded with the old settings would be wrong now
+            cls._entries.clear()
+            cls._currentBytes = 0
+
+    @classmethod
+    def _shrink(cls, data: bytes, mime: str, debug: bool = False) -> tuple:
+        try:
+            from PIL import Image
+        except ImportError:
+            if debug and len(data) > cls._maxFileBytes:
+                print("[DEBUG] Pillow isn't installed, sending the image as it is")
+            return data, mime
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            tooBig = max(image.size) > cls._maxSide
+            if not tooBig and len(data) <= cls._maxFileBytes:
+                return data, mime
+
+            image.thumbnail((cls._maxSide, cls._maxSide))
+
+            # Transparent images stay PNG, everything else becomes a JPEG
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+                image.save(output, format="PNG", optimize=True)
+                shrunkMime = "image/png"
+            else:
+                image.convert("RGB").save(output, format="JPEG", quality=cls._quality, optimize=True)
+                shrunkMime = "image/jpeg"
+            shrunk = output.getvalue()
+        except Exception as e:
+            if debug:
+                print(f"[DEBUG] Couldn't shrink the image: {e}")
+            return data, mime
+
+        # Recompressing an image that was only big in bytes can make it bigger, then the original is better
+        if not tooBig and len(shrunk) >= len(data):
+            return data, mime
+
+        if debug:
+            print(f"[DEBUG] Image shrunk from {len(data)} to {len(shrunk)} bytes")
+
+        return shrunk, shrunkMime
+
+    @classmethod
+    def get(cls, path: str, debug: bool = False) -> dict:
+        """{"mime", "base64", "digest"} for the image, or None if the file doesn't exist."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is not None:
+                cls._entries.move_to_end(key)
+                cls.hits += 1
+                return entry
+            cls.misses += 1
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        data, mime = cls._shrink(data, mimeType(data, path), debug)
+        encoded = base64.b64encode(data).decode("utf-8")
+        entry = {"mime": mime, "base64": encoded, "digest": hashlib.sha256(data).hexdigest()}
+
+        with cls._lock:
+            # An older version of the same file won't be asked for again
+            for oldKey in [oldKey for oldKey in cls._entries if oldKey[0] == key[0] and oldKey != key]:
+                cls._currentBytes -= len(cls._entries.pop(oldKey)["base64"])
+
+            if key not in cls._entries:
+                cls._entries[key] = entry
+                cls._currentBytes += len(encoded)
+
+            while cls._currentBytes > cls._maxBytes and len(cls._entries) > 1:
+                _, evicted = cls._entries.popitem(last=False)
+                cls._currentBytes -= len(evicted["base64"])
+
+        return entry
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries.clear()
+            cls._currentBytes = 0
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {"hits": cls.hits, "misses": cls.misses, "entries": len(cls._entries), "bytes": cls._currentBytes}
@@ -1,31 +1,108 @@
 from agent.Config import ModelConfig
+from agent.Ollama import getOllamaClient, getAsyncOllamaClient, OllamaError
+from agent.OpenAIClient import getOpenAIClient, getAsyncOpenAIClient
+from agent.Cache import getResponseCache, cacheKey
+from agent.RateLimit import RateLimiter
+from agent.Transcript import countTokens
+from agent.Prompt import PromptCacheStats
 
-import subprocess
+def _fromCache(prompt: str, useCache: bool, debug: bool = False):
+    cache = getResponseCache()
+    if cache is None or not useCache:
+        return None, None, None
+
+    if ModelConfig.getDefaultOpenAI():
+        key = cacheKey("openai", ModelConfig.getDefaultModel(), prompt, params={"max_tokens": 4000})
+    else:
+        key = cacheKey("ollama", ModelConfig.getDefaultModel(), prompt)
+
+    cached = cache.get(key)
+    if cached is not None:
+        if debug:
+            print("[DEBUG] Cache hit for runLLM")
+
+        if ModelConfig.getDefaultOpenAI():
+            from openai.types.chat import ChatCompletion
+            cached = ChatCompletion.model_validate_json(cached)
+
+    return cache, key, cached
+
+
+def runLLM(prompt: str, debug: bool = False, useCache: bool = True):
 
-def runLLM(prompt: str, debug: bool = False):
-    
     if debug:
         print(f"[DEBUG] ModelConig.getDefaultOpenAI: {ModelConfig.getDefaultOpenAI()}")
         print(f"[DEBUG] ModelConig.getDefaultModel: {ModelConfig.getDefaultModel()}")
-    
+
+    cache, key, cached = _fromCache(prompt, useCache, debug)
+    if cached is not None:
+        return cached
+
     if ModelConfig.getDefaultOpenAI():
-        from openai import OpenAI
-        client = OpenAI()
-        
-        stdout = client.chat.completions.create(
+        client = getOpenAIClient()
+
+        stdout = RateLimiter.call("openai", ModelConfig.getDefaultModel(), countTokens(prompt), lambda: client.chat.completions.create(
             model=ModelConfig.getDefaultModel(),
             messages=[{
                 "role": "user",
                 "content": prompt
             }],
             max_tokens=4000
-        )
+        ), debug)
+        PromptCacheStats.record(ModelConfig.getDefaultModel(), stdout)
+
+        if cache is not None:
+            cache.set(key, stdout.model_dump_json())
     elif not ModelConfig.getDefaultOpenAI():
-        cmd = ["ollama", "run", ModelConfig.getDefaultModel()]
-        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate(input=prompt)
-        
+        try:
+            stdout = RateLimiter.call("ollama", ModelConfig.getDefaultModel(), countTokens(prompt), lambda: getOllamaClient().generate(ModelConfig.getDefaultModel(), prompt, debug=debug), debug)
+
+            if cache is not None:
+                cache.set(key, stdout)
+        except OllamaError as e:
+            stdout = str(e)
+
     if debug:
         print(f"[DEBUG] stdout: {stdout}")
-    
-    return stdout
\ No newline at end of file
+
+    return stdout
+
+
+async def arunLLM(prompt: str, debug: bool = False, useCache: bool = True):
+
+    if debug:
+        print(f"[DEBUG] ModelConig.getDefaultOpenAI: {ModelConfig.getDefaultOpenAI()}")
+        print(f"[DEBUG] ModelConig.getDefaultModel: {ModelConfig.getDefaultModel()}")
+
+    cache, key, cached = _fromCache(prompt, useCache, debug)
+    if cached is not None:
+        return cached
+
+    if ModelConfig.getDefaultOpenAI():
+        client = getAsyncOpenAIClient()
+
+        stdout = await RateLimiter.acall("openai", ModelConfig.getDefaultModel(), countTokens(prompt), lambda: client.chat.completions.create(
+            model=ModelConfig.getDefaultModel(),
+            messages=[{
+                "role": "user",
+                "content": prompt
+            }],
+            max_tokens=4000
+        ), debug)
+        PromptCacheStats.record(ModelConfig.getDefaultModel(), stdout)
+
+        if cache is not None:
+            cache.set(key, stdout.model_dump_json())
+    elif not ModelConfig.getDefaultOpenAI():
+        try:
+            stdout = await RateLimiter.acall("ollama", ModelConfig.getDefaultModel(), countTokens(prompt), lambda: getAsyncOllamaClient().generate(ModelConfig.getDefaultModel(), prompt, debug=debug), debug)
+
+            if cache is not None:
+                cache.set(key, stdout)
+        except OllamaError as e:
+            stdout = str(e)
+
+    if debug:
+        print(f"[DEBUG] stdout: {stdout}")
+
+    return stdout
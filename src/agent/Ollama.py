@@ -0,0 +1,308 @@
+import json
+import queue
+import asyncio
+import weakref
+import threading
+import http.client
+from urllib.parse import urlparse
+
+from agent.Config import ModelConfig
+
+
+class OllamaError(Exception):
+    # status is the HTTP status, None when the server couldn't be reached
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+def _normalizeHost(host: str) -> str:
+    host = host if host is not None else ModelConfig.getOllamaHost()
+    if "://" not in host:
+        host = f"http://{host}"
+
+    parsed = urlparse(host)
+    return f"{parsed.scheme}://{parsed.hostname or '127.0.0.1'}:{parsed.port or 11434}{parsed.path.rstrip('/')}"
+
+
+def _buildPayload(model: str, keepAlive, options: dict, format=None) -> dict:
+    payload = {"model": model, "stream": False}
+
+    # "json" or a JSON schema, ollama then only generates output that fits it
+    if format is not None:
+        payload["format"] = format
+
+    keepAlive = keepAlive if keepAlive is not None else ModelConfig.getKeepAlive()
+    if keepAlive is not None:
+        payload["keep_alive"] = keepAlive
+    if options:
+        payload["options"] = options
+
+    return payload
+
+
+class OllamaClient:
+    """Talks to the Ollama REST API over a small pool of keep-alive connections."""
+
+    def __init__(self, host: str = None, poolSize: int = 4, timeout: float = 300):
+        host = _normalizeHost(host)
+        parsed = urlparse(host)
+        self.host = host
+        self.scheme = parsed.scheme
+        self.hostname = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port
+        self.basePath = parsed.path.rstrip("/")
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=poolSize)
+
+    def _newConnection(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.hostname, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.hostname, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._newConnection()
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _send(self, path: str, payload: dict, debug: bool = False):
+        body = json.dumps(payload)
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+
+        # A pooled connection can be closed by the server while idle, so retry once on a fresh one
+        for attempt in range(2):
+            connection = self._acquire()
+            try:
+                connection.request("POST", self.basePath + path, body=body, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError) as e:
+                connection.close()
+                if attempt == 0:
+                    if debug:
+                        print(f"[DEBUG] Ollama connection dropped, retrying: {e}")
+                    continue
+                raise OllamaError(f"Connection to ollama at {self.host} failed: {e}") from e
+            except OSError as e:
+                connection.close()
+                raise OllamaError(f"Connection to ollama at {self.host} failed: {e}") from e
+
+    def _finish(self, connection, response):
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+
+    def _request(self, path: str, payload: dict, debug: bool = False) -> dict:
+        connection, response = self._send(path, payload, debug)
+
+        try:
+            data = response.read()
+        except OSError as e:
+            connection.close()
+            raise OllamaError(f"Connection to ollama at {self.host} failed: {e}") from e
+
+        self._finish(connection, response)
+
+        if response.status != 200:
+            raise OllamaError(f"Ollama returned {response.status}: {data.decode('utf-8', errors='replace')}", response.status)
+
+        return json.loads(data)
+
+    def _streamLines(self, path: str, payload: dict, debug: bool = False):
+        connection, response = self._send(path, payload, debug)
+
+        if response.status != 200:
+            data = response.read()
+            self._finish(connection, response)
+            raise OllamaError(f"Ollama returned {response.status}: {data.decode('utf-8', errors='replace')}", response.status)
+
+        # A stream that is stopped halfway leaves data on the connection, so it's only reused when read to the end
+        finished = False
+        try:
+            for line in response:
+                if not line.strip():
+                    continue
+
+                data = json.loads(line)
+                if "error" in data:
+                    raise OllamaError(f"Ollama returned an error: {data['error']}", 500)
+
+                yield data
+
+                if data.get("done"):
+                    break
+
+            response.read()
+            finished = True
+        except OSError as e:
+            raise OllamaError(f"Connection to ollama at {self.host} failed: {e}") from e
+        finally:
+            if finished:
+                self._finish(connection, response)
+            else:
+                connection.close()
+
+    def generate(self, model: str, prompt: str, images: list = None, keepAlive=None, options: dict = None, format=None, debug: bool = False) -> str:
+        payload = _buildPayload(model, keepAlive, options, format)
+        payload["prompt"] = prompt
+        if images:
+            payload["images"] = images
+
+        data = self._request("/api/generate", payload, debug)
+
+        if debug:
+            print(f"[DEBUG] Ollama generate: {data}")
+
+        return data.get("response", "")
+
+    def chat(self, model: str, messages: list, keepAlive=None, options: dict = None, format=None, debug: bool = False) -> str:
+        payload = _buildPayload(model, keepAlive, options, format)
+        payload["messages"] = messages
+
+        data = self._request("/api/chat", payload, debug)
+
+        if debug:
+            print(f"[DEBUG] Ollama chat: {data}")
+
+        return data.get("message", {}).get("content", "")
+
+    def generateStream(self, model: str, prompt: str, images: list = None, keepAlive=None, options: dict = None, debug: bool = False):
+        """Yields the response in pieces as the model generates it."""
+        payload = _buildPayload(model, keepAlive, options)
+        payload["stream"] = True
+        payload["prompt"] = prompt
+        if images:
+            payload["images"] = images
+
+        for data in self._streamLines("/api/generate", payload, debug):
+            if data.get("response"):
+                yield data["response"]
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class AsyncOllamaClient:
+    """Asyncio version of OllamaClient, the connection pool belongs to one event loop."""
+
+    def __init__(self, host: str = None, poolSize: int = 100, timeout: float = 300):
+        import httpx
+
+        self.host = _normalizeHost(host)
+        self.timeout = timeout
+        self._client = httpx.AsyncClient(
+            base_url=self.host,
+            limits=httpx.Limits(max_connections=poolSize, max_keepalive_connections=poolSize),
+            timeout=timeout,
+        )
+
+    async def _request(self, path: str, payload: dict, debug: bool = False) -> dict:
+        import httpx
+
+        try:
+            response = await self._client.post(path, json=payload)
+        except httpx.HTTPError as e:
+            raise OllamaError(f"Connection to ollama at {self.host} failed: {e}") from e
+
+        if response.status_code != 200:
+            raise OllamaError(f"Ollama returned {response.status_code}: {response.text}", response.status_code)
+
+        return response.json()
+
+    async def _streamLines(self, path: str, payload: dict, debug: bool = False):
+        import httpx
+
+        try:
+            async with self._client.stream("POST", path, json=payload) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise OllamaError(f"Ollama returned {response.status_code}: {response.text}", response.status_code)
+
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+
+                    data = json.loads(line)
+                    if "error" in data:
+                        raise OllamaError(f"Ollama returned an error: {data['error']}", 500)
+
+                    yield data
+
+                    if data.get("done"):
+                        break
+        except httpx.HTTPError as e:
+            raise OllamaError(f"Connection to ollama at {self.host} failed: {e}") from e
+
+    async def generate(self, model: str, prompt: str, images: list = None, keepAlive=None, options: dict = None, format=None, debug: bool = False) -> str:
+        payload = _buildPayload(model, keepAlive, options, format)
+        payload["prompt"] = prompt
+        if images:
+            payload["images"] = images
+
+        data = await self._request("/api/generate", payload, debug)
+
+        if debug:
+            print(f"[DEBUG] Ollama generate: {data}")
+
+        return data.get("response", "")
+
+    async def chat(self, model: str, messages: list, keepAlive=None, options: dict = None, format=None, debug: bool = False) -> str:
+        payload = _buildPayload(model, keepAlive, options, format)
+        payload["messages"] = messages
+
+        data = await self._request("/api/chat", payload, debug)
+
+        if debug:
+            print(f"[DEBUG] Ollama chat: {data}")
+
+        return data.get("message", {}).get("content", "")
+
+    async def generateStream(self, model: str, prompt: str, images: list = None, keepAlive=None, options: dict = None, debug: bool = False):
+        payload = _buildPayload(model, keepAlive, options)
+        payload["stream"] = True
+        payload["prompt"] = prompt
+        if images:
+            payload["images"] = images
+
+        async for data in self._streamLines("/api/generate", payload, debug):
+            if data.get("response"):
+                yield data["response"]
+
+    async def close(self):
+        await self._client.aclose()
+
+
+_clients = {}
+_asyncClients = weakref.WeakKeyDictionary()
+_clientsLock = threading.Lock()
+
+def getOllamaClient(host: str = None) -> OllamaClient:
+    host = _normalizeHost(host)
+
+    with _clientsLock:
+        if host not in _clients:
+            _clients[host] = OllamaClient(host)
+        return _clients[host]
+
+
+def getAsyncOllamaClient(host: str = None) -> AsyncOllamaClient:
+    host = _normalizeHost(host)
+    loop = asyncio.get_running_loop()
+
+    with _clientsLock:
+        loopClients = _asyncClients.setdefault(loop, {})
+        if host not in loopClients:
+            loopClients[host] = AsyncOllamaClient(host)
+        return loopClients[host]
@@ -0,0 +1,90 @@
+import os
+import asyncio
+import weakref
+import threading
+
+
+class OpenAIClientRegistry:
+    """Process-wide OpenAI clients, one per (base url, api key), so HTTP connections get reused."""
+
+    _clients = {}
+    _asyncClients = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
+
+    _maxConnections = 100
+    _maxKeepaliveConnections = 20
+    _timeout = 600.0
+
+    @classmethod
+    def configure(cls, maxConnections: int = None, maxKeepaliveConnections: int = None, timeout: float = None):
+        if maxConnections is not None:
+            cls._maxConnections = maxConnections
+        if maxKeepaliveConnections is not None:
+            cls._maxKeepaliveConnections = maxKeepaliveConnections
+        if timeout is not None:
+            cls._timeout = timeout
+
+        # Clients made with the old settings are dropped, new ones are made on the next call
+        cls.clear()
+
+    @classmethod
+    def getClient(cls, baseURL: str = None, apiKey: str = None):
+        baseURL = baseURL if baseURL is not None else os.environ.get("OPENAI_BASE_URL")
+        apiKey = apiKey if apiKey is not None else os.environ.get("OPENAI_API_KEY")
+        key = (baseURL, apiKey)
+
+        with cls._lock:
+            client = cls._clients.get(key)
+            if client is None:
+                import httpx
+                from openai import OpenAI
+
+                httpClient = httpx.Client(
+                    limits=httpx.Limits(max_connections=cls._maxConnections, max_keepalive_connections=cls._maxKeepaliveConnections),
+                    timeout=cls._timeout,
+                )
+                # Retries are done by the RateLimiter, so they're counted against the limits
+                client = OpenAI(api_key=apiKey, base_url=baseURL, timeout=cls._timeout, max_retries=0, http_client=httpClient)
+                cls._clients[key] = client
+
+            return client
+
+    @classmethod
+    def getAsyncClient(cls, baseURL: str = None, apiKey: str = None):
+        # Async connections can't be shared between event loops, so every loop gets its own clients
+        baseURL = baseURL if baseURL is not None else os.environ.get("OPENAI_BASE_URL")
+        apiKey = apiKey if apiKey is not None else os.environ.get("OPENAI_API_KEY")
+        key = (baseURL, apiKey)
+        loop = asyncio.get_running_loop()
+
+        with cls._lock:
+            loopClients = cls._asyncClients.setdefault(loop, {})
+            client = loopClients.get(key)
+            if client is None:
+                import httpx
+                from openai import AsyncOpenAI
+
+                httpClient = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=cls._maxConnections, max_keepalive_connections=cls._maxKeepaliveConnections),
+                    timeout=cls._timeout,
+                )
+                client = AsyncOpenAI(api_key=apiKey, base_url=baseURL, timeout=cls._timeout, max_retries=0, http_client=httpClient)
+                loopClients[key] = client
+
+            return client
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            for client in cls._clients.values():
+                client.close()
+            cls._clients = {}
+            cls._asyncClients = weakref.WeakKeyDictionary()
+
+
+def getOpenAIClient(baseURL: str = None, apiKey: str = None):
+    return OpenAIClientRegistry.getClient(baseURL, apiKey)
+
+
+def getAsyncOpenAIClient(baseURL: str = None, apiKey: str = None):
+    return OpenAIClientRegistry.getAsyncClient(baseURL, apiKey)
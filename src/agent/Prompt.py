@@ -0,0 +1,76 @@
+import re
+import textwrap
+import threading
+
+
+def normalize(text: str) -> str:
+    """Removes the indentation of a prompt written in code, trailing spaces and extra blank lines."""
+    text = textwrap.dedent(text).strip("\n")
+    text = "\n".join(line.rstrip() for line in text.split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+class PromptTemplate:
+    """A prompt with the instructions first and the variable data last.
+
+    The prefix only has fields that stay the same for an agent (name, instruction, guardrails),
+    so every call of that agent starts with the same bytes. OpenAI's prompt caching and ollama's
+    KV cache can then reuse it, only the suffix (the prompt, the responses) is new.
+    Both parts are normalized once, when the template is made.
+    """
+
+    def __init__(self, prefix: str, suffix: str):
+        self.prefix = normalize(prefix)
+        self.suffix = normalize(suffix)
+
+    def render(self, static: dict, **data) -> str:
+        return f"{self.prefix.format(**static)}\n\n{self.suffix.format(**data)}"
+
+
+class PromptCacheStats:
+    """How many prompt tokens the provider served from its prompt cache, per model.
+
+    Read from usage.prompt_tokens_details.cached_tokens of OpenAI responses.
+    """
+
+    _models = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def record(cls, model: str, completion):
+        usage = getattr(completion, "usage", None)
+        promptTokens = getattr(usage, "prompt_tokens", None)
+        if promptTokens is None:
+            return
+
+        details = getattr(usage, "prompt_tokens_details", None)
+        cachedTokens = getattr(details, "cached_tokens", None) or 0
+
+        with cls._lock:
+            entry = cls._models.setdefault(model, {"requests": 0, "promptTokens": 0, "cachedTokens": 0})
+            entry["requests"] += 1
+            entry["promptTokens"] += promptTokens
+            entry["cachedTokens"] += cachedTokens
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._models = {}
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            models = {
+                model: {**entry, "hitRate": entry["cachedTokens"] / entry["promptTokens"] if entry["promptTokens"] else 0.0}
+                for model, entry in cls._models.items()
+            }
+
+        promptTokens = sum(entry["promptTokens"] for entry in models.values())
+        cachedTokens = sum(entry["cachedTokens"] for entry in models.values())
+        return {
+            "requests": sum(entry["requests"] for entry in models.values()),
+            "promptTokens": promptTokens,
+            "cachedTokens": cachedTokens,
+            "hitRate": cachedTokens / promptTokens if promptTokens else 0.0,
+            "models": models,
+        }
@@ -0,0 +1,332 @@
+import time
+import random
+import asyncio
+import inspect
+import weakref
+import threading
+import contextlib
+
+from agent.Ollama import OllamaError
+
+
+class TokenBucket:
+    """Allows perMinute units a minute, with bursts of up to a minute's worth."""
+
+    def __init__(self, perMinute: float):
+        self.capacity = perMinute
+        self.rate = perMinute / 60
+        self.tokens = perMinute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Takes amount right away and returns how long to wait before using it."""
+        with self._lock:
+            self._refill(time.monotonic())
+
+            # A request bigger than the bucket would wait forever, so it waits for a full bucket
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def adjust(self, amount: float):
+        # Corrects an estimate once the real usage is known, a negative amount gives tokens back
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+def _retryAfter(error) -> float:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return 0.0
+
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _retryable(error) -> bool:
+    if isinstance(error, OllamaError):
+        return error.status is None or error.status == 429 or error.status >= 500
+
+    try:
+        import openai
+    except ImportError:
+        return False
+
+    # APIConnectionError includes timeouts
+    return isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+
+def _prepend(first, chunks):
+    try:
+        yield first
+        yield from chunks
+    finally:
+        # Stops the request when the stream isn't read to the end
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+async def _aprepend(first, chunks):
+    if chunks is None:
+        return
+
+    try:
+        yield first
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        close = getattr(chunks, "aclose", None) or getattr(chunks, "close", None)
+        if close is not None:
+            await close()
+
+
+class RateLimiter:
+    """Process-wide limits per backend and model: requests and tokens per minute, concurrent
+    requests, and retries with jittered exponential backoff for rate limits and server errors.
+
+    Limits set without a model are the defaults for every model of that backend.
+    """
+
+    _limits = {}
+    _buckets = {}
+    _semaphores = {}
+    _asyncSemaphores = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
+
+    # Local models share the CPU or GPU, so by default only a few requests run at the same time
+    _defaultLimits = {"ollama": {"rpm": None, "tpm": None, "maxConcurrency": 4}}
+
+    _maxRetries = 3
+    _baseDelay = 1.0
+    _maxDelay = 30.0
+    _completionTokens = 256
+
+    requests = 0
+    retries = 0
+    waited = 0.0
+
+    @classmethod
+    def configure(cls, backend: str, model: str = None, rpm: float = None, tpm: float = None, maxConcurrency: int = None):
+        """backend is 'openai' or 'ollama'. None for a limit means no limit."""
+        with cls._lock:
+            cls._limits[(backend, model)] = {"rpm": rpm, "tpm": tpm, "maxConcurrency": maxConcurrency}
+
+            # Buckets and semaphores with the old limits are made again on the next call
+            for key in [key for key in cls._buckets if key[0] == backend and (model is None or key[1] == model)]:
+                del cls._buckets[key]
+            for key in [key for key in cls._semaphores if key[0] == backend and (model is None or key[1] == model)]:
+                del cls._semaphores[key]
+            cls._asyncSemaphores = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def configureRetries(cls, maxRetries: int = None, baseDelay: float = None, maxDelay: float = None):
+        if maxRetries is not None:
+            cls._maxRetries = maxRetries
+        if baseDelay is not None:
+            cls._baseDelay = baseDelay
+        if maxDelay is not None:
+            cls._maxDelay = maxDelay
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._limits = {}
+            cls._buckets = {}
+            cls._semaphores = {}
+            cls._asyncSemaphores = weakref.WeakKeyDictionary()
+            cls.requests = 0
+            cls.retries = 0
+            cls.waited = 0.0
+
+    @classmethod
+    def _settings(cls, backend: str, model: str) -> dict:
+        return cls._limits.get((backend, model)) or cls._limits.get((backend, None)) or cls._defaultLimits.get(backend) or {}
+
+    @classmethod
+    def _reserve(cls, backend: str, model: str, tokens: int) -> float:
+        settings = cls._settings(backend, model)
+
+        with cls._lock:
+            cls.requests += 1
+            buckets = cls._buckets.get((backend, model))
+            if buckets is None:
+                buckets = (
+                    TokenBucket(settings["rpm"]) if settings.get("rpm") else None,
+                    TokenBucket(settings["tpm"]) if settings.get("tpm") else None,
+                )
+                cls._buckets[(backend, model)] = buckets
+
+        requestBucket, tokenBucket = buckets
+        wait = 0.0
+        if requestBucket is not None:
+            wait = max(wait, requestBucket.reserve(1))
+        if tokenBucket is not None:
+            wait = max(wait, tokenBucket.reserve(tokens + cls._completionTokens))
+        return wait
+
+    @classmethod
+    def _adjust(cls, backend: str, model: str, tokens: int, result):
+        usage = getattr(result, "usage", None)
+        total = getattr(usage, "total_tokens", None)
+        buckets = cls._buckets.get((backend, model))
+
+        if total is not None and buckets is not None and buckets[1] is not None:
+            buckets[1].adjust(total - (tokens + cls._completionTokens))
+
+    @classmethod
+    def _semaphore(cls, backend: str, model: str):
+        maxConcurrency = cls._settings(backend, model).get("maxConcurrency")
+        if not maxConcurrency:
+            return None
+
+        with cls._lock:
+            semaphore = cls._semaphores.get((backend, model))
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(maxConcurrency)
+                cls._semaphores[(backend, model)] = semaphore
+            return semaphore
+
+    @classmethod
+    def _asyncSemaphore(cls, backend: str, model: str):
+        # asyncio semaphores belong to one event loop, so the cap counts per loop
+        maxConcurrency = cls._settings(backend, model).get("maxConcurrency")
+        if not maxConcurrency:
+            return None
+
+        loop = asyncio.get_running_loop()
+        with cls._lock:
+            loopSemaphores = cls._asyncSemaphores.setdefault(loop, {})
+            semaphore = loopSemaphores.get((backend, model))
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(maxConcurrency)
+                loopSemaphores[(backend, model)] = semaphore
+            return semaphore
+
+    @classmethod
+    def _backoff(cls, attempt: int, error) -> float:
+        delay = random.uniform(0, min(cls._maxDelay, cls._baseDelay * 2 ** attempt))
+        return max(delay, _retryAfter(error))
+
+    @classmethod
+    def _wait(cls, wait: float, debug: bool = False):
+        if wait > 0:
+            if debug:
+                print(f"[DEBUG] Rate limited, waiting {wait:.2f}s")
+            with cls._lock:
+                cls.waited += wait
+        return wait
+
+    @classmethod
+    @contextlib.contextmanager
+    def slot(cls, backend: str, model: str, tokens: int = 0, debug: bool = False):
+        """Waits for the rate limits and a free slot, for calls that can't simply be retried."""
+        time.sleep(cls._wait(cls._reserve(backend, model, tokens), debug))
+
+        semaphore = cls._semaphore(backend, model)
+        if semaphore is None:
+            yield
+            return
+
+        with semaphore:
+            yield
+
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def aslot(cls, backend: str, model: str, tokens: int = 0, debug: bool = False):
+        await asyncio.sleep(cls._wait(cls._reserve(backend, model, tokens), debug))
+
+        semaphore = cls._asyncSemaphore(backend, model)
+        if semaphore is None:
+            yield
+            return
+
+        async with semaphore:
+            yield
+
+    @classmethod
+    def openStream(cls, backend: str, model: str, tokens: int, function, debug: bool = False):
+        """Starts the stream function() returns within the limits and returns an iterator over its chunks.
+
+        The slot is only held until the first chunk comes in. A stream is read at the pace of the caller,
+        who can make other calls on the same model in between (like the output guardrails of a stream),
+        so holding the slot for the whole stream could wait on itself forever.
+        """
+        with cls.slot(backend, model, tokens, debug):
+            chunks = iter(function())
+            try:
+                first = next(chunks)
+            except StopIteration:
+                return iter(())
+        return _prepend(first, chunks)
+
+    @classmethod
+    async def aopenStream(cls, backend: str, model: str, tokens: int, function, debug: bool = False):
+        """Async version of openStream, function() returns an async iterable or an awaitable of one."""
+        async with cls.aslot(backend, model, tokens, debug):
+            chunks = function()
+            if inspect.isawaitable(chunks):
+                chunks = await chunks
+            chunks = chunks.__aiter__()
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                return _aprepend(None, None)
+        return _aprepend(first, chunks)
+
+    @classmethod
+    def call(cls, backend: str, model: str, tokens: int, function, debug: bool = False):
+        """Runs function() within the limits, retrying rate limits and server errors."""
+        attempt = 0
+        while True:
+            try:
+                with cls.slot(backend, model, tokens, debug):
+                    result = function()
+                cls._adjust(backend, model, tokens, result)
+                return result
+            except Exception as e:
+                if attempt >= cls._maxRetries or not _retryable(e):
+                    raise
+
+                delay = cls._backoff(attempt, e)
+                attempt += 1
+                with cls._lock:
+                    cls.retries += 1
+                if debug:
+                    print(f"[DEBUG] {backend} {model} failed ({e}), retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+
+    @classmethod
+    async def acall(cls, backend: str, model: str, tokens: int, function, debug: bool = False):
+        """Async version of call, function() returns an awaitable."""
+        attempt = 0
+        while True:
+            try:
+                async with cls.aslot(backend, model, tokens, debug):
+                    result = await function()
+                cls._adjust(backend, model, tokens, result)
+                return result
+            except Exception as e:
+                if attempt >= cls._maxRetries or not _retryable(e):
+                    raise
+
+                delay = cls._backoff(attempt, e)
+                attempt += 1
+                with cls._lock:
+                    cls.retries += 1
+                if debug:
+                    print(f"[DEBUG] {backend} {model} failed ({e}), retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {"requests": cls.requests, "retries": cls.retries, "waited": cls.waited}
@@ -0,0 +1,179 @@
+import re
+import typing
+import inspect
+import dataclasses
+
+from agent.CleanOutput import extractJson
+from agent.Prompt import PromptTemplate
+
+_simpleTypes = {str: "string", int: "integer", float: "number", bool: "boolean", dict: "object", list: "array", type(None): "null"}
+
+
+def _typeSchema(annotation) -> dict:
+    if annotation is inspect.Parameter.empty or annotation is typing.Any:
+        return {}
+    if annotation in _simpleTypes:
+        return {"type": _simpleTypes[annotation]}
+    if dataclasses.is_dataclass(annotation):
+        return schemaFromDataclass(annotation)
+
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if origin is typing.Literal:
+        return {"enum": list(args)}
+    if origin in (list, tuple, set, frozenset):
+        return {"type": "array", "items": _typeSchema(args[0])} if args else {"type": "array"}
+    if origin is dict:
+        return {"type": "object", "additionalProperties": _typeSchema(args[1])} if len(args) == 2 else {"type": "object"}
+    if origin is typing.Union or type(annotation).__name__ == "UnionType":
+        return {"anyOf": [_typeSchema(arg) for arg in args]}
+
+    # Anything else (a class, a string annotation that couldn't be resolved) can be any value
+    return {}
+
+
+def _hints(target) -> dict:
+    try:
+        return typing.get_type_hints(target)
+    except Exception:
+        return {}
+
+
+def schemaFromFunction(function) -> dict:
+    """A JSON schema for the arguments of function, parameters without a default are required."""
+    hints = _hints(function)
+    properties = {}
+    required = []
+
+    for name, parameter in inspect.signature(function).parameters.items():
+        if parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+            continue
+
+        properties[name] = _typeSchema(hints.get(name, parameter.annotation))
+        if parameter.default is inspect.Parameter.empty:
+            required.append(name)
+
+    return {"type": "object", "properties": properties, "required": required}
+
+
+def schemaFromDataclass(cls) -> dict:
+    hints = _hints(cls)
+    properties = {}
+    required = []
+
+    for field in dataclasses.fields(cls):
+        properties[field.name] = _typeSchema(hints.get(field.name, field.type))
+        if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING:
+            required.append(field.name)
+
+    return {"type": "object", "properties": properties, "required": required}
+
+
+def toSchema(spec) -> dict:
+    """spec is a JSON schema (dict), a dataclass or a function."""
+    if isinstance(spec, dict):
+        return spec
+    if dataclasses.is_dataclass(spec) and isinstance(spec, type):
+        return schemaFromDataclass(spec)
+    if callable(spec):
+        return schemaFromFunction(spec)
+    raise TypeError(f"Can't make a JSON schema from {spec!r}")
+
+
+def schemaName(schema: dict) -> str:
+    # OpenAI only takes letters, digits, _ and - in the name
+    return re.sub(r"[^a-zA-Z0-9_-]", "_", schema.get("title", "response"))[:64]
+
+
+def _isType(value, kind: str) -> bool:
+    if kind == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if kind == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    return isinstance(value, {"string": str, "boolean": bool, "object": dict, "array": list, "null": type(None)}.get(kind, object))
+
+
+def validate(data, schema: dict, path: str = "$") -> list:
+    """The problems with data for the schema, an empty list if there are none.
+
+    Only the parts of JSON schema that are used here: type, enum, properties, required,
+    additionalProperties, items and anyOf.
+    """
+    if "anyOf" in schema:
+        if not any(not validate(data, option, path) for option in schema["anyOf"]):
+            return [f"{path} doesn't match any of the allowed types"]
+        return []
+
+    kinds = schema.get("type")
+    if kinds is not None:
+        kinds = kinds if isinstance(kinds, list) else [kinds]
+        if not any(_isType(data, kind) for kind in kinds):
+            return [f"{path} should be {' or '.join(kinds)}, not {type(data).__name__}"]
+
+    if "enum" in schema and data not in schema["enum"]:
+        return [f"{path} should be one of {schema['enum']}"]
+
+    errors = []
+
+    if isinstance(data, dict):
+        properties = schema.get("properties", {})
+        for name in schema.get("required", []):
+            if name not in data:
+                errors.append(f"{path} is missing {name!r}")
+
+        additional = schema.get("additionalProperties", True)
+        for name, value in data.items():
+            if name in properties:
+                errors.extend(validate(value, properties[name], f"{path}.{name}"))
+            elif additional is False:
+                errors.append(f"{path} has {name!r}, that isn't allowed")
+            elif isinstance(additional, dict):
+                errors.extend(validate(value, additional, f"{path}.{name}"))
+
+    if isinstance(data, list) and "items" in schema:
+        for i, value in enumerate(data):
+            errors.extend(validate(value, schema["items"], f"{path}[{i}]"))
+
+    return errors
+
+
+def parseStructured(text, schema: dict) -> tuple:
+    """(data, errors) for a model answer."""
+    data = extractJson(text) if isinstance(text, (str, dict)) else None
+    if data is None:
+        return None, ["the answer isn't a JSON object"]
+    return data, validate(data, schema)
+
+
+# The first request stays in front, so the retry starts with the same bytes as the call before it
+_repairTemplate = PromptTemplate(
+    prefix="{prompt}",
+    suffix="""
+        Your previous answer has problems. Give the corrected JSON.
+
+        Problems:
+        {problems}
+
+        Previous answer:
+        {answer}
+    """,
+)
+
+
+def repairPrompt(prompt: str, answer, errors: list) -> str:
+    problems = "\n".join(f"- {error}" for error in errors)
+    return _repairTemplate.render({"prompt": prompt}, problems=problems, answer=answer)
+
+
+def build(spec, data):
+    # A dataclass spec gives a dataclass back (nested dataclasses too), everything else the dict
+    if not (dataclasses.is_dataclass(spec) and isinstance(spec, type)) or not isinstance(data, dict):
+        return data
+
+    hints = _hints(spec)
+    values = {}
+    for field in dataclasses.fields(spec):
+        if field.name in data:
+            values[field.name] = build(hints.get(field.name, field.type), data[field.name])
+    return spec(**values)
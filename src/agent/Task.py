@@ -1,14 +1,35 @@
 from agent.LLM import runLLM
 from agent.Agent import AgentRegistry
 from agent.Config import ModelConfig
+from agent.Checkpoint import CheckpointStore, newRunId
+from agent.Prompt import PromptTemplate
 
 # __main__
-from Agent import Agent
+from agent.Agent import Agent
+
+# The agents stay the same for a task, the task and the responses come last
+_selectAgentTemplate = PromptTemplate(
+    prefix="""
+        You need to give the right agent for solving the task. If you have found the right on only respond with the name of the agent.
+
+        Only respond with the name of the right agent you want to select. You chose from agents given to you, you cant make agents up.
+
+        agents: {agents}
+    """,
+    suffix="""
+        task: {task}
+        other responses: {response}
+    """,
+)
 
 class Task:
-    def __init__(self, task: str, agents: list, repeat: bool = False, exitValue: str = None, debug: bool = False):
+    def __init__(self, task: str, agents: list, repeat: bool = False, exitValue: str = None, debug: bool = False, checkpoint: CheckpointStore = None):
         self.task = task
         self.agents = agents
+
+        # With a checkpoint store every step is saved and solve can be resumed by its run ID
+        self.checkpoint = checkpoint
+        self.lastRunId = None
         
         if repeat:
             if exitValue != None:
@@ -23,45 +44,68 @@ class Task:
 
         self.debug = debug
     
-    def solve(self):
+    def _save(self, runId: str, step: int, state: dict):
+        if self.checkpoint is not None:
+            self.checkpoint.save(runId, "task", step, state)
+
+    def _resume(self, runId: str) -> dict:
+        if self.checkpoint is None:
+            return {}
+
+        state = self.checkpoint.load(runId, "task") or {}
+        if state and state["task"] != self.task:
+            raise ValueError(f"Run {runId} was started for a different task")
+
+        if state and self.debug:
+            print(f"[DEBUG] Resuming run {runId}: {state}")
+
+        return state
+
+    def _selectPrompt(self, response: str) -> str:
+        return _selectAgentTemplate.render({"agents": [agent.name for agent in self.agents]}, task=self.task, response=response)
+
+    def solve(self, runId: str = None):
+        if self.checkpoint is not None and runId is None:
+            runId = newRunId()
+        self.lastRunId = runId
+
+        state = self._resume(runId)
+        if state.get("finished"):
+            return state["response"]
+
         response = ""
         if self.repeat:
-            attemptSolvePrompt = f"""
-                You need to give the right agent for solving the task. If you have found the right on only respond with the name of the agent.
-                
-                agents: {[agent.name for agent in self.agents]}
-                task: {self.task}
-                other responses: {response}
-                
-                Only respond with the name of the right agent you want to select. You chose from agents given to you, you cant make agents up.
-            """
+            attemptSolvePrompt = self._selectPrompt(response)
             
             if self.debug:
                 print(f"[DEBUG] current prompt: {attemptSolvePrompt}")
             
-            stdout = runLLM(prompt=attemptSolvePrompt, debug=self.debug)  # select agent
-            
-            if ModelConfig.getDefaultOpenAI():
-                selectedAgent = AgentRegistry.get_agent(stdout.choices[0].message.content.strip())
-            elif not ModelConfig.getDefaultOpenAI():
-                selectedAgent = AgentRegistry.get_agent(stdout.strip())
+            if "selectedAgent" in state:
+                selectedAgentName = state["selectedAgent"]
+            else:
+                stdout = runLLM(prompt=attemptSolvePrompt, debug=self.debug)  # select agent
+                
+                if ModelConfig.getDefaultOpenAI():
+                    selectedAgentName = stdout.choices[0].message.content.strip()
+                elif not ModelConfig.getDefaultOpenAI():
+                    selectedAgentName = stdout.strip()
+
+                self._save(runId, 1, {"task": self.task, "selectedAgent": selectedAgentName})
+
+            selectedAgent = AgentRegistry.get_agent(selectedAgentName)
             
             response += selectedAgent.run(prompt=attemptSolvePrompt, debug=self.debug)            
+
+            self._save(runId, 2, {"task": self.task, "selectedAgent": selectedAgentName, "response": response, "finished": True})
             
             if self.debug:
                 print(f"[DEBUG] selectedAgent: {selectedAgent}")
                 print(f"[DEBUG] response: {response}")
 
         elif not self.repeat:
-            attemptSolvePrompt = f"""
-                You need to give the right agent for solving the task. If you have found the right on only respond with the name of the agent.
-                
-                agents: {[agent.name for agent in self.agents]}
-                task: {self.task}
-                other responses: {response}
-                
-                Only respond with the name of the right agent you want to select. You chose from agents given to you, you cant make agents up.
-            """
+            attemptSolvePrompt = self._selectPrompt(response)
+
+        return response
 
 
 if __name__== "__main__":
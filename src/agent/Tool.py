@@ -1,148 +1,294 @@
 import inspect
-import re
-import json
+import textwrap
 import functools
+import threading
+from collections import OrderedDict
 
 # from functools import wraps
 
 from agent.Agent import Agent
 from agent.Config import ModelConfig
+from agent.CleanOutput import extractJson
+from agent.Structured import schemaFromFunction
+from agent.Prompt import normalize
 
 debug = False
 
-def extract_json(raw: str, debug: bool = False) -> dict | None:
-    raw = re.sub(r"```(?:json)?", "", raw)
-    raw = raw.replace("```", "").strip()
+def _coerceParams(params: dict, signature: inspect.Signature = None) -> dict:
+    # With a signature only parameters without a type annotation are coerced, the schema already typed the rest
+    for key, value in params.items():
+        if signature is not None and key in signature.parameters and signature.parameters[key].annotation is not inspect.Parameter.empty:
+            continue
+        if isinstance(value, str):
+            if value.lower() == "true":
+                params[key] = True
+            elif value.lower() == "false":
+                params[key] = False
+            elif value.isdigit():
+                params[key] = int(value)
+    return params
+
 
-    if debug:
-        print(f"[DEBUG] Cleaned raw:\n{raw}")
+def extract_json(raw: str, debug: bool = False) -> dict | None:
+    json_obj = extractJson(raw, key="parameters", debug=debug)
 
-    match = re.search(r'({\s*"parameters"\s*:\s*{[^{}]*}\s*})', raw, re.DOTALL)
-    if not match:
+    if json_obj is None:
         print("[ERROR] No valid JSON object found in output.")
-        if debug:
-            print(f"[DEBUG] Raw output was:\n{raw}")
-        return None
-    
-
-    try:
-        json_obj = json.loads(match.group(0))
-
-        params = json_obj.get("parameters", {})
-        for key, value in params.items():
-            if isinstance(value, str):
-                if value.lower() == "true":
-                    params[key] = True
-                elif value.lower() == "false":
-                    params[key] = False
-                elif value.isdigit():
-                    params[key] = int(value)
-        
-        return json_obj
-    except json.JSONDecodeError as e:
-        print(f"[ERROR] JSON decode failed: {e}")
         return None
 
+    if isinstance(json_obj["parameters"], dict):
+        _coerceParams(json_obj["parameters"])
+
+    return json_obj
 
 
 
-def dynamicTool(function):
-    @functools.wraps(function)
-    def wrapper(*args, prompt=None, **kwargs):
-        sig = inspect.signature(function)
+
+class _ToolSpec:
+    """Everything about a dynamic tool that doesn't change between calls, made once when it's decorated."""
+
+    def __init__(self, function, maxMemo: int = 256):
+        self.function = function
+        self.signature = inspect.signature(function)
+        self.parameters = list(self.signature.parameters.keys())
 
         try:
-            bound_args = sig.bind(*args, **kwargs)
-            bound_args.apply_defaults()
-            return function(*args, **kwargs)
-        
+            self.source = inspect.getsource(function)
+        except (OSError, TypeError):
+            # No source file (e.g. made in a REPL), the docstring is the best we have
+            self.source = f"def {function.__name__}{self.signature}:\n    \"\"\"{function.__doc__ or ''}\"\"\""
+
+        # Everything about the function is the same for every call, only the user prompt at the end changes
+        agentDetails = normalize(f"""
+        You are an AI agent.
+
+        Agent details:
+        - Name: dynamicAgent
+        - Function parameters: {self.parameters}
+        - Function code:
+        """)
+
+        self.promptPrefix = agentDetails + "\n" + textwrap.dedent(self.source).strip() + "\n\n" + normalize("""
+        This defines your identity. Do not invent or assume any additional context.
+
+        Your job is to infer the correct function parameter values based solely on the user prompt.
+
+        Strict rules:
+        - Put the values in "parameters", by parameter name.
+        - Only include parameters listed in the function signature.
+        """)
+
+        # The answer is constrained to this, so the model can't answer with anything else
+        self.parameterSchema = schemaFromFunction(function)
+        self.schema = {"type": "object", "properties": {"parameters": self.parameterSchema}, "required": ["parameters"]}
+
+        self.maxMemo = maxMemo
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prompt(self, prompt: str) -> str:
+        return f"{self.promptPrefix}\n\nUser prompt: {prompt}"
+
+    def binds(self, args: tuple, kwargs: dict) -> bool:
+        try:
+            self.signature.bind(*args, **kwargs)
+            return True
         except TypeError as e:
             if debug:
                 print(f"[DEBUG] Argument mismatch, AI gaat invullen: {e}")
+            return False
 
-        source = inspect.getsource(function)
-        param_list = list(sig.parameters.keys())
+    def _memoKey(self, prompt: str) -> tuple:
+        return (ModelConfig.getDefaultModel(), ModelConfig.getDefaultOpenAI(), prompt)
 
-        dynamicAgent = Agent(
-            name="dynamicAgent",
-            instruction="",
-            model=ModelConfig.getDefaultModel(),
-            openAI=ModelConfig.getDefaultOpenAI(),
-            outputGuardrails="You need to check if the given parameters will not cause problems, so dont't use spaces in links. Or other erros that can be prevented."
-        )
-        
-        agent  = Agent(
+    def getParameters(self, prompt: str):
+        with self._lock:
+            parameters = self._memo.get(self._memoKey(prompt))
+            if parameters is None:
+                return None
+            self._memo.move_to_end(self._memoKey(prompt))
+            return dict(parameters)
+
+    def setParameters(self, prompt: str, parameters: dict):
+        with self._lock:
+            self._memo[self._memoKey(prompt)] = dict(parameters)
+            self._memo.move_to_end(self._memoKey(prompt))
+
+            while len(self._memo) > self.maxMemo:
+                self._memo.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memo.clear()
+
+
+_defaultAgents = {}
+
+def defaultAgent() -> Agent:
+    """An unregistered agent on the default model, for helper calls like parameter inference or planning.
+
+    There's one per default model instead of a new one for every call.
+    """
+    key = (ModelConfig.getDefaultModel(), ModelConfig.getDefaultOpenAI())
+
+    agent = _defaultAgents.get(key)
+    if agent is None:
+        agent = Agent(
             name="agent",
             instruction="",
             model=ModelConfig.getDefaultModel(),
             openAI=ModelConfig.getDefaultOpenAI(),
+            register=False,
         )
+        _defaultAgents[key] = agent
+
+    return agent
 
-        prompt_for_params = f"""
-            You are an AI agent.
 
-            Agent details:
-            - Name: {dynamicAgent.name}
-            - Instruction: {dynamicAgent.instruction}
-            - Function parameters: {param_list}
-            - Function code: {source}
-            - User prompt: {prompt}
+def _parseParams(data: dict, spec: _ToolSpec) -> dict | None:
+    # data is a structured answer, it already fits spec.schema
+    if data is None:
+        print("[ERROR] No valid parameters found in output.")
+        return None
+
+    return _coerceParams(data["parameters"], spec.signature)
+
+
+
+
+_batchRules = normalize("""
+    This defines your identity. Do not invent or assume any additional context.
+
+    Your job is to infer the correct parameter values for every function above based solely on the user prompt.
+
+    Strict rules:
+    - Put the values in "tools", by function name and then parameter name.
+    - Use the function names exactly as given.
+    - Only include parameters listed in the function signature.
+""")
+
 
-            This defines your identity. Do not invent or assume any additional context.
+def _batchPrompt(specs: list, prompt: str) -> str:
+    # The same tools give the same prefix, the user prompt comes last
+    functions = "\n\n".join(
+        f"- Function name: {spec.function.__name__}\n  Function parameters: {spec.parameters}\n  Function code:\n{textwrap.dedent(spec.source).strip()}"
+        for spec in specs
+    )
 
-            Your job is to infer the correct function parameter values based solely on the user prompt. 
+    return f"You are an AI agent.\n\nFunctions:\n{functions}\n\n{_batchRules}\n\nUser prompt: {prompt}"
 
-            Respond with **only valid JSON**, like:
 
-            {{
-                "parameters": {{
-                    "parameter1": "value1",
-                    "parameter2": "value2"
-                }}
-            }}
+def _batchSchema(specs: list) -> dict:
+    # A function can be left out, it asks for its own parameters then
+    tools = {spec.function.__name__: spec.parameterSchema for spec in specs}
+    return {"type": "object", "properties": {"tools": {"type": "object", "properties": tools}}, "required": ["tools"]}
+
+
+def _batchSpecs(tools: list, prompt: str) -> list:
+    # Tools that already have parameters for this prompt don't need to be asked again
+    return [
+        tool.__tool_spec__ for tool in tools
+        if getattr(tool, "__tool_spec__", None) is not None and tool.__tool_spec__.getParameters(prompt) is None
+    ]
+
+
+def _storeBatch(specs: list, prompt: str, data: dict):
+    # data is a structured answer, it already fits the batch schema
+    if data is None:
+        print("[ERROR] No valid parameters found in output.")
+        return
+
+    for spec in specs:
+        parameters = data["tools"].get(spec.function.__name__)
+        if not isinstance(parameters, dict):
+            continue
+
+        _coerceParams(parameters, spec.signature)
+
+        # Parameters that don't fit the function are left out, the tool will ask for its own then
+        try:
+            spec.signature.bind(**parameters)
+        except TypeError:
+            if debug:
+                print(f"[DEBUG] Batched parameters don't fit {spec.function.__name__}: {parameters}")
+            continue
 
-            Strict rules:
-            - No prose, no explanations, no commentary.
-            - No code blocks or markdown formatting (no triple backticks).
-            - Output must start with '{{' and end with '}}'.
-            - Only include parameters listed in the function signature.
-            - The JSON must be parseable with `json.loads()` in Python.
-            """
+        spec.setParameters(prompt, parameters)
 
 
+def inferParameters(tools: list, prompt: str, debug: bool = False):
+    """Fills the parameter memory of all dynamic tools in one model call."""
+    specs = _batchSpecs(tools, prompt)
+    if len(specs) < 2:
+        return
 
-        if agent.openAI:
-            stdout = agent.runOpenAI(prompt_for_params, debug=debug)
-            rawOutput = stdout.choices[0].message.content.strip()
-        elif not agent.openAI:
-            stdout = agent.runLocalModel(prompt_for_params, debug=debug)
-            rawOutput = stdout.strip()
-        
+    data = defaultAgent().runStructured(_batchPrompt(specs, prompt), _batchSchema(specs), debug=debug)
+    _storeBatch(specs, prompt, data)
 
-        data = extract_json(rawOutput, debug=debug)
-        
-        if data is None:
-            return None
 
+async def ainferParameters(tools: list, prompt: str, debug: bool = False):
+    specs = _batchSpecs(tools, prompt)
+    if len(specs) < 2:
+        return
+
+    data = await defaultAgent().arunStructured(_batchPrompt(specs, prompt), _batchSchema(specs), debug=debug)
+    _storeBatch(specs, prompt, data)
+
+
+
+
+def dynamicTool(function):
+    spec = _ToolSpec(function)
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def asyncWrapper(*args, prompt=None, **kwargs):
+            if spec.binds(args, kwargs):
+                return await function(*args, **kwargs)
+
+            parameters = spec.getParameters(prompt)
+            if parameters is None:
+                data = await defaultAgent().arunStructured(spec.prompt(prompt), spec.schema, debug=debug)
+
+                parameters = _parseParams(data, spec)
+                if parameters is None:
+                    return None
+
+                spec.setParameters(prompt, parameters)
+            elif debug:
+                print(f"[DEBUG] Reusing parameters for {function.__name__}: {parameters}")
+
+            if debug:
+                print("Running function")
+            return await function(**parameters)
+
+        asyncWrapper.__dynamic_tool__ = True
+        asyncWrapper.__tool_spec__ = spec
+        return asyncWrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, prompt=None, **kwargs):
+        if spec.binds(args, kwargs):
+            return function(*args, **kwargs)
 
-        #clean_output = json_match.group(1)
+        parameters = spec.getParameters(prompt)
+        if parameters is None:
+            data = defaultAgent().runStructured(spec.prompt(prompt), spec.schema, debug=debug)
 
-        # voor openAI 
-        # try:
-        #     data = json.loads(data)
-        # except json.JSONDecodeError as e:
-        #     print(f"[ERROR] Failed to parse JSON: {e}")
-        #     return None
+            parameters = _parseParams(data, spec)
+            if parameters is None:
+                return None
 
-        if "parameters" not in data:
-            print("[ERROR] JSON is missing 'parameters' key.")
-            return None
+            spec.setParameters(prompt, parameters)
+        elif debug:
+            print(f"[DEBUG] Reusing parameters for {function.__name__}: {parameters}")
 
         if debug:
             print("Running function")
-        return function(**data["parameters"])
+        return function(**parameters)
 
     wrapper.__dynamic_tool__ = True
+    wrapper.__tool_spec__ = spec
     return wrapper
 
 
@@ -0,0 +1,64 @@
+from agent.Graph import checkCycles, runGraph, arunGraph
+
+
+def _toolName(tool) -> str:
+    name = getattr(tool, "name", None)
+    if isinstance(name, str):
+        return name
+    return getattr(tool, "__name__", str(tool))
+
+
+class ToolExecutor:
+    """Runs the tools of an agent in parallel, a tool only waits for the tools it depends on."""
+
+    def __init__(self, agent, maxConcurrency: int = 4, timeout: float = None, dependencies: dict = None, tools: list = None, debug: bool = False):
+        self.agent = agent
+        self.maxConcurrency = max(1, maxConcurrency)
+        self.timeout = timeout
+        self.debug = debug
+
+        self.tools = {_toolName(tool): tool for tool in (tools if tools is not None else agent.tools)}
+        self.order = list(self.tools.keys())
+
+        self.dependencies = {}
+        for name in self.order:
+            deps = (dependencies or {}).get(name, [])
+            unknown = [dep for dep in deps if dep not in self.tools]
+            if unknown and debug:
+                print(f"[DEBUG] Ignoring unknown dependencies of {name}: {unknown}")
+            self.dependencies[name] = [dep for dep in deps if dep in self.tools]
+
+        checkCycles(self.order, self.dependencies, "Tool")
+
+    def _toolPrompt(self, prompt: str, name: str, results: dict) -> str:
+        # A tool gets the prompt plus the responses of its dependencies, in tool order
+        deps = self.dependencies[name]
+        return prompt + "".join(results[dep] for dep in self.order if dep in deps)
+
+    def _timeoutResult(self, name: str) -> str:
+        if self.debug:
+            print(f"[ERROR] {name} timed out after {self.timeout}s")
+        return f" response tool: {name} failed: timed out after {self.timeout}s \n"
+
+    def _response(self, results: dict) -> str:
+        response = "".join(results[name] for name in self.order)
+
+        if self.debug:
+            print(f"[DEBUG] running agent {self.agent.name}")
+            print(f"[DEBUG] response tool: {response}")
+
+        return response
+
+    def run(self, prompt: str) -> str:
+        def runTool(name, results):
+            return self.agent._runTool(self.tools[name], self._toolPrompt(prompt, name, results), self.debug)
+
+        results = runGraph(self.order, self.dependencies, runTool, self.maxConcurrency, self.timeout, self._timeoutResult)
+        return self._response(results)
+
+    async def arun(self, prompt: str) -> str:
+        def runTool(name, results):
+            return self.agent._arunTool(self.tools[name], self._toolPrompt(prompt, name, results), self.debug)
+
+        results = await arunGraph(self.order, self.dependencies, runTool, self.maxConcurrency, self.timeout, self._timeoutResult)
+        return self._response(results)
@@ -0,0 +1,150 @@
+import re
+import threading
+from collections import OrderedDict
+
+from agent.ToolExecutor import _toolName
+from agent.Prompt import PromptTemplate
+
+# The same tools give the same prefix, only the prompt at the end changes
+_routingTemplate = PromptTemplate(
+    prefix="""
+        You are now an AI agent.
+
+        Your task: Select the tools that are needed to answer the prompt.
+
+        Tools:
+        {tools}
+
+        Extra instructions:
+            - Put the names of the tools in "tools".
+            - Leave the list empty if no tool is needed.
+    """,
+    suffix="""
+        Prompt: {prompt}
+    """,
+)
+
+_stopWords = {"the", "and", "for", "with", "you", "your", "are", "this", "that", "from", "what", "how", "can", "give", "get", "need", "use", "make", "into", "its", "has", "have", "will", "not", "but", "all", "any", "about"}
+
+
+def _words(text: str) -> set:
+    # Splits camelCase and snake_case so 'fetchWeather' matches 'weather'
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text or "")
+    return {word for word in re.findall(r"[a-z0-9]+", text.lower()) if len(word) > 2 and word not in _stopWords}
+
+
+class ToolSelector:
+    """Picks the tools that are relevant for a prompt, with a routing model call or a local word match."""
+
+    def __init__(self, mode: str = "model", maxCache: int = 256):
+        if mode not in ("model", "local"):
+            raise ValueError(f"Unknown tool selection mode: {mode}")
+
+        self.mode = mode
+        self.maxCache = maxCache
+        self.lastSelection = None
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _describe(self, tool) -> str:
+        description = getattr(tool, "instruction", None)
+        if not isinstance(description, str):
+            description = (getattr(tool, "__doc__", None) or "").strip()
+        return " ".join(description.split())
+
+    def _routingPrompt(self, tools: list, prompt: str) -> str:
+        toolList = "\n".join(f"- {_toolName(tool)}: {self._describe(tool) or 'no description'}" for tool in tools)
+        return _routingTemplate.render({"tools": toolList}, prompt=prompt)
+
+    def _routingSchema(self, tools: list) -> dict:
+        # Only names from the list can be picked
+        names = [_toolName(tool) for tool in tools]
+        return {
+            "type": "object",
+            "properties": {"tools": {"type": "array", "items": {"enum": names}}},
+            "required": ["tools"],
+        }
+
+    def _parse(self, data: dict, tools: list):
+        # data is a structured answer, None if the model couldn't give one
+        if data is None:
+            return None
+
+        names = set(data["tools"])
+        return [tool for tool in tools if _toolName(tool) in names]
+
+    def _score(self, tools: list, prompt: str) -> list:
+        promptWords = _words(prompt)
+        selected = [tool for tool in tools if promptWords & (_words(_toolName(tool)) | _words(self._describe(tool)))]
+
+        # Without any match there is nothing to go on, so nothing gets skipped
+        return selected if selected else list(tools)
+
+    def _cached(self, key: tuple):
+        with self._lock:
+            names = self._cache.get(key)
+            if names is not None:
+                self._cache.move_to_end(key)
+            return names
+
+    def _remember(self, key: tuple, names: list):
+        with self._lock:
+            self._cache[key] = names
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self.maxCache:
+                self._cache.popitem(last=False)
+
+    def _report(self, tools: list, selected: list, cached: bool, debug: bool = False) -> list:
+        selectedNames = [_toolName(tool) for tool in selected]
+        self.lastSelection = {
+            "selected": selectedNames,
+            "skipped": [_toolName(tool) for tool in tools if tool not in selected],
+            "mode": self.mode,
+            "cached": cached,
+        }
+
+        if debug:
+            print(f"[DEBUG] Selected tools: {self.lastSelection['selected']}")
+            print(f"[DEBUG] Skipped tools: {self.lastSelection['skipped']}")
+
+        return selected
+
+    def select(self, agent, tools: list, prompt: str, debug: bool = False) -> list:
+        key = (tuple(_toolName(tool) for tool in tools), prompt)
+
+        names = self._cached(key)
+        if names is not None:
+            return self._report(tools, [tool for tool in tools if _toolName(tool) in names], True, debug)
+
+        if self.mode == "local":
+            selected = self._score(tools, prompt)
+        else:
+            selected = self._parse(agent.runStructured(self._routingPrompt(tools, prompt), self._routingSchema(tools), debug), tools)
+            if selected is None:
+                if debug:
+                    print("[DEBUG] Tool selection couldn't be read, running all tools")
+                return self._report(tools, list(tools), False, debug)
+
+        self._remember(key, [_toolName(tool) for tool in selected])
+        return self._report(tools, selected, False, debug)
+
+    async def aselect(self, agent, tools: list, prompt: str, debug: bool = False) -> list:
+        key = (tuple(_toolName(tool) for tool in tools), prompt)
+
+        names = self._cached(key)
+        if names is not None:
+            return self._report(tools, [tool for tool in tools if _toolName(tool) in names], True, debug)
+
+        if self.mode == "local":
+            selected = self._score(tools, prompt)
+        else:
+            selected = self._parse(await agent.arunStructured(self._routingPrompt(tools, prompt), self._routingSchema(tools), debug), tools)
+            if selected is None:
+                if debug:
+                    print("[DEBUG] Tool selection couldn't be read, running all tools")
+                return self._report(tools, list(tools), False, debug)
+
+        self._remember(key, [_toolName(tool) for tool in selected])
+        return self._report(tools, selected, False, debug)
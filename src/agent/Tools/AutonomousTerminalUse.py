@@ -1,7 +1,7 @@
-import subprocess
 import sys
 import os
 import json
+import time
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from agent.Agent import Agent
@@ -9,6 +9,27 @@ from agent.Config import ModelConfig
 from agent.CleanOutput import cleanOutput
 from agent.LLM import runLLM
 from agent.Tool import dynamicTool
+from agent.Transcript import countTokens
+from agent.Tools.Shell import ShellSession
+from agent.Prompt import PromptTemplate
+
+# The task and the steps stay the same for a whole run, only the history at the end grows
+_commandTemplate = PromptTemplate(
+    prefix="""
+        You need to give a command based on the following information to get to closer to completing the task.
+
+        If the output shows the task is complete, only respond with: DONE
+        Otherwise only respond with the next command. Dont add anything else!! not 'oke ill do that' not ```bash or shell or whatever only the pure command.
+        NEVER use interactive tools like nano/vim/emacs.
+
+        task: {task}
+        steps to task: {steps}
+    """,
+    suffix="""
+        commands that have been run and their output:
+        {history}
+    """,
+)
 
 def _getSteps(task: str, debug: bool = False):
     getStepsPrompt = f"""
@@ -27,40 +48,118 @@ def _getSteps(task: str, debug: bool = False):
     
     return steps
 
-def _makeCommand(task: str, steps: str, previousCommand: str, debug: bool = False):
-    makeCommandPrompt = f"""
-        You need to give a command based on the following information to get to closer to completing the task.
-        
-        task: {task}
-        steps to task: {steps}
-        previous command: {previousCommand}
-        
-        Now only respond with the command. Dont add anything else!! not 'oke ill do that' not ```bash or shell or whatever only the pure command.
-    """
+def _truncate(text: str, maxChars: int) -> str:
+    # The start and the end of an output say the most, the middle is cut
+    if len(text) <= maxChars:
+        return text
+    half = maxChars // 2
+    return f"{text[:half]}\n... ({len(text) - maxChars} characters cut) ...\n{text[-half:]}"
+
+def _history(history: list, maxOutputChars: int, fullSteps: int = 5) -> str:
+    # Only the last few commands get their output, older ones only their exit code
+    lines = []
+    for i, entry in enumerate(history):
+        lines.append(f"$ {entry['command']}  (exit code: {entry['exitCode']}{', timed out' if entry['timedOut'] else ''})")
+        if i >= len(history) - fullSteps:
+            if entry["stdout"]:
+                lines.append(f"stdout:\n{_truncate(entry['stdout'], maxOutputChars)}")
+            if entry["stderr"]:
+                lines.append(f"stderr:\n{_truncate(entry['stderr'], maxOutputChars)}")
+    return "\n".join(lines) if lines else "none yet"
+
+def _cleanCommand(command: str) -> str:
+    command = command.strip()
+    if command.startswith("```"):
+        command = command.split("\n", 1)[1] if "\n" in command else ""
+        command = command.rsplit("```", 1)[0]
+    return command.strip()
+
+def _makeCommand(task: str, steps: str, history: list, maxOutputChars: int = 2000, debug: bool = False):
+    makeCommandPrompt = _commandTemplate.render({"task": task, "steps": steps}, history=_history(history, maxOutputChars))
 
     if debug:
         print(f"[DEBUG] makeCommandPrompt: {makeCommandPrompt}")
         
-    command = runLLM(prompt=makeCommandPrompt, debug=debug)
+    stdout = runLLM(prompt=makeCommandPrompt, debug=debug)
+
+    if ModelConfig.getDefaultOpenAI():
+        command = stdout.choices[0].message.content
+        usage = getattr(stdout, "usage", None)
+        tokens = usage.total_tokens if usage is not None else countTokens(makeCommandPrompt + command)
+    else:
+        command = stdout
+        tokens = countTokens(makeCommandPrompt + command)
     
     if debug:
         print(f"[DEBUG] command: {command}")
     
-    return command
+    return _cleanCommand(command), tokens
 
-def autonomousTerminalUse(task: str, debug: bool = False):
-    currentCommand = ""
-    commands = ""
+def autonomousTerminalUse(task: str, debug: bool = False, maxSteps: int = 15, timeLimit: float = 300, tokenBudget: int = 50000, commandTimeout: float = 60, maxOutputChars: int = 2000, maxRepeats: int = 2):
+    """Runs one command at a time and shows the model the output, until the model says the task is done
+    or a budget runs out: maxSteps commands, timeLimit seconds or tokenBudget tokens.
+
+    Returns {"done", "reason", "trace"}, the trace has the command, exit code, output and timings of every step.
+    """
+    started = time.monotonic()
+    deadline = started + timeLimit
     steps = _getSteps(task=task, debug=debug)
-    
-    while True:
-        currentCommand =_makeCommand(task=task, steps=steps, previousCommand=currentCommand, debug=debug)
-        
-        if ModelConfig.getDefaultOpenAI():
-            currentCommand = currentCommand.choices[0].message.content
-        
-        process = subprocess.Popen(stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate(input=currentCommand)
+    if not isinstance(steps, str):
+        steps = steps.choices[0].message.content
+
+    tokens = countTokens(steps)
+    history = []
+    trace = []
+    reason = "maxSteps"
+    repeats = 0
+
+    with ShellSession(debug=debug) as session:
+        for step in range(maxSteps):
+            if time.monotonic() >= deadline:
+                reason = "timeLimit"
+                break
+            if tokens >= tokenBudget:
+                reason = "tokenBudget"
+                break
+
+            modelStarted = time.monotonic()
+            command, commandTokens = _makeCommand(task=task, steps=steps, history=history, maxOutputChars=maxOutputChars, debug=debug)
+            modelSeconds = time.monotonic() - modelStarted
+            tokens += commandTokens
+
+            if command.upper().rstrip(".") == "DONE":
+                reason = "done"
+                trace.append({"step": step, "command": None, "modelSeconds": modelSeconds, "tokens": commandTokens})
+                break
+
+            # The same command again and again means the model is stuck
+            repeats = repeats + 1 if history and history[-1]["command"] == command else 0
+            if repeats >= maxRepeats:
+                reason = "repeated"
+                trace.append({"step": step, "command": command, "modelSeconds": modelSeconds, "tokens": commandTokens})
+                break
+
+            result = session.run(command, timeout=max(0.0, min(commandTimeout, deadline - time.monotonic())))
+            history.append(result)
+            trace.append({
+                "step": step,
+                "command": command,
+                "exitCode": result["exitCode"],
+                "timedOut": result["timedOut"],
+                "stdout": _truncate(result["stdout"], maxOutputChars),
+                "stderr": _truncate(result["stderr"], maxOutputChars),
+                "modelSeconds": modelSeconds,
+                "commandSeconds": result["duration"],
+                "tokens": commandTokens,
+            })
+
+            if debug:
+                print(f"[DEBUG] step {step}: exit {result['exitCode']}, {tokens} tokens, {time.monotonic() - started:.1f}s")
+
+    if debug:
+        print(f"[DEBUG] autonomous terminal use stopped: {reason}")
+
+    return {"done": reason == "done", "reason": reason, "trace": trace, "tokens": tokens, "seconds": time.monotonic() - started}
     
 if __name__ == "__main__":
     ModelConfig.setDefaultModel("gpt-4o", True)
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import platform
+import threading
+
+
+def normalizeTask(task: str) -> str:
+    # Only whitespace, the case can matter for file names
+    return " ".join(task.split())
+
+
+def environmentFingerprint(cwd: str = None) -> str:
+    return json.dumps({
+        "system": platform.system(),
+        "release": platform.release(),
+        "machine": platform.machine(),
+        "shell": "/bin/bash" if os.path.exists("/bin/bash") else "/bin/sh",
+        "cwd": os.path.abspath(cwd or os.getcwd()),
+    }, sort_keys=True)
+
+
+class PlanCache:
+    """Terminal plans (the commands JSON) by task and environment, in memory and optionally a SQLite file.
+
+    A plan is only stored after all of its commands succeeded, and a cached plan that fails is removed.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path is not None:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS plans (key TEXT PRIMARY KEY, task TEXT NOT NULL, environment TEXT NOT NULL, plan TEXT NOT NULL, created REAL NOT NULL)")
+            self._db.commit()
+
+    def key(self, task: str, cwd: str = None) -> str:
+        data = f"{normalizeTask(task)}\n{environmentFingerprint(cwd)}"
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, task: str, cwd: str = None) -> dict:
+        key = self.key(task, cwd)
+
+        with self._lock:
+            plan = self._memory.get(key)
+            if plan is None and self._db is not None:
+                row = self._db.execute("SELECT plan FROM plans WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    plan = json.loads(row[0])
+                    self._memory[key] = plan
+
+            if plan is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return plan
+
+    def set(self, task: str, plan: dict, cwd: str = None):
+        key = self.key(task, cwd)
+
+        with self._lock:
+            self._memory[key] = plan
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO plans (key, task, environment, plan, created) VALUES (?, ?, ?, ?, ?)",
+                    (key, normalizeTask(task), environmentFingerprint(cwd), json.dumps(plan), time.time()),
+                )
+                self._db.commit()
+
+    def invalidate(self, task: str = None, cwd: str = None):
+        # Without a task every plan is removed
+        with self._lock:
+            if task is None:
+                self._memory.clear()
+                if self._db is not None:
+                    self._db.execute("DELETE FROM plans")
+                    self._db.commit()
+                return
+
+            key = self.key(task, cwd)
+            self._memory.pop(key, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM plans WHERE key = ?", (key,))
+                self._db.commit()
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "entries": len(self._memory),
+                "hitRate": self.hits / total if total else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_planCache = None
+
+def setPlanCache(cache: PlanCache):
+    # None turns the cache off
+    global _planCache
+    _planCache = cache
+
+
+def getPlanCache() -> PlanCache:
+    return _planCache
@@ -0,0 +1,223 @@
+# Note: POSIX shells only (bash or sh)
+
+import os
+import time
+import uuid
+import queue
+import shlex
+import signal
+import threading
+import subprocess
+import concurrent.futures
+
+
+def _defaultShell() -> str:
+    return "/bin/bash" if os.path.exists("/bin/bash") else "/bin/sh"
+
+
+class ShellSession:
+    """One long-lived shell that commands are written to, so cd and exported variables carry over.
+
+    Every command is followed by a sentinel on stdout and stderr, that's how the output and the
+    exit status of each command are found. A command that times out kills the shell and everything
+    it started, the next command gets a fresh one (in the same directory if it still exists).
+    Closing the session only ends the shell, background jobs (e.g. a server started with &) keep running.
+    """
+
+    def __init__(self, shell: str = None, cwd: str = None, env: dict = None, debug: bool = False):
+        self.shell = shell if shell is not None else _defaultShell()
+        self.cwd = cwd
+        self.env = env
+        self.debug = debug
+        self.process = None
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            [self.shell],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd,
+            env=self.env,
+            start_new_session=True,
+        )
+        self._stdout = queue.Queue()
+        self._stderr = queue.Queue()
+
+        for stream, lines in ((self.process.stdout, self._stdout), (self.process.stderr, self._stderr)):
+            threading.Thread(target=self._read, args=(stream, lines), daemon=True).start()
+
+        if self.debug:
+            print(f"[DEBUG] Started shell {self.shell} (pid {self.process.pid})")
+
+    def _read(self, stream, lines: queue.Queue):
+        for line in iter(stream.readline, b""):
+            lines.put(line.decode("utf-8", errors="replace"))
+        lines.put(None)
+
+    def _kill(self, group: bool = True):
+        # The shell has its own process group, so a timed out command can be killed with everything it started
+        if self.process is None:
+            return
+
+        try:
+            if group:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+        self.process.wait()
+        self.process = None
+
+    def _collect(self, lines: queue.Queue, sentinel: str, deadline: float):
+        """The output up to the sentinel and the text after it, or None for the text when the time ran out."""
+        output = []
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return "".join(output), None
+
+            try:
+                line = lines.get(timeout=remaining)
+            except queue.Empty:
+                return "".join(output), None
+
+            if line is None:
+                return "".join(output), ""
+            if line.startswith(sentinel):
+                text = "".join(output)
+                # The sentinel starts with a newline of its own, that's not part of the output
+                return (text[:-1] if text.endswith("\n") else text), line[len(sentinel):].strip()
+
+            output.append(line)
+
+    def run(self, command: str, timeout: float = None) -> dict:
+        """Runs command and returns {"id", "command", "stdout", "stderr", "exitCode", "timedOut", "duration"}."""
+        if self.process is None or self.process.poll() is not None:
+            self._start()
+
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        sentinel = f"__dde_{uuid.uuid4().hex}__"
+
+        # eval keeps cd and exports in this shell, stdin is closed so a command can't read the sentinel
+        script = (
+            f"eval {shlex.quote(command)} < /dev/null\n"
+            f"__ddeStatus=$?\n"
+            f"printf '\\n{sentinel} %d\\n' \"$__ddeStatus\"\n"
+            f"printf '\\n{sentinel}\\n' >&2\n"
+        )
+
+        try:
+            self.process.stdin.write(script.encode("utf-8"))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            pass
+
+        stdout, status = self._collect(self._stdout, sentinel, deadline)
+        stderr, stderrDone = self._collect(self._stderr, sentinel, deadline) if status is not None else ("", None)
+
+        result = {
+            "command": command,
+            "stdout": stdout,
+            "stderr": stderr,
+            "exitCode": None,
+            "timedOut": False,
+            "duration": time.monotonic() - started,
+        }
+
+        if status is None or stderrDone is None:
+            result["timedOut"] = True
+            if self.debug:
+                print(f"[ERROR] Command timed out after {timeout}s: {command}")
+            self._restart()
+        elif status == "":
+            # The command ended the shell itself, e.g. with exit
+            self.process.wait()
+            result["exitCode"] = self.process.returncode
+            self.process = None
+        else:
+            result["exitCode"] = int(status)
+
+        return result
+
+    def _restart(self):
+        # Keep the directory the shell was in, if it can still be found
+        try:
+            self.cwd = os.readlink(f"/proc/{self.process.pid}/cwd")
+        except OSError:
+            pass
+        self._kill()
+
+    def currentDirectory(self) -> str:
+        result = self.run("pwd", timeout=10)
+        return result["stdout"].strip() if result["exitCode"] == 0 else self.cwd
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=1)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+            self._kill(group=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def runPlan(commands: list, timeout: float = None, totalTimeout: float = None, maxParallel: int = 4, debug: bool = False) -> list:
+    """Runs the commands of a plan in one shell session, in order.
+
+    Commands next to each other with "independent": true run at the same time, each in its own
+    shell that starts in the directory of the main session. timeout is per command, totalTimeout
+    for the whole plan. Commands that didn't get to run because the time ran out are timed out too.
+    """
+    results = []
+    deadline = None if totalTimeout is None else time.monotonic() + totalTimeout
+
+    def commandTimeout():
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if timeout is None:
+            return remaining
+        return timeout if remaining is None else min(timeout, remaining)
+
+    def runIndependent(cmd, cwd):
+        with ShellSession(cwd=cwd, debug=debug) as session:
+            return session.run(cmd["command"], commandTimeout())
+
+    with ShellSession(debug=debug) as session:
+        i = 0
+        while i < len(commands):
+            group = [commands[i]]
+            while commands[i].get("independent") and i + len(group) < len(commands) and commands[i + len(group)].get("independent"):
+                group.append(commands[i + len(group)])
+            i += len(group)
+
+            if deadline is not None and time.monotonic() >= deadline:
+                for cmd in group:
+                    results.append({"id": cmd.get("id"), "command": cmd["command"], "stdout": "", "stderr": "", "exitCode": None, "timedOut": True, "duration": 0.0})
+                continue
+
+            if len(group) == 1:
+                if debug:
+                    print(f"Running command {group[0].get('id')}: {group[0]['command']}")
+                result = session.run(group[0]["command"], commandTimeout())
+                results.append({"id": group[0].get("id"), **result})
+                continue
+
+            if debug:
+                print(f"Running commands {[cmd.get('id') for cmd in group]} at the same time")
+
+            cwd = session.currentDirectory()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(maxParallel, len(group)))) as pool:
+                groupResults = list(pool.map(lambda cmd: runIndependent(cmd, cwd), group))
+
+            for cmd, result in zip(group, groupResults):
+                results.append({"id": cmd.get("id"), **result})
+
+    return results
@@ -1,18 +1,55 @@
-import subprocess
 import sys
 import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from agent.Agent import Agent
 from agent.Config import ModelConfig
-from agent.CleanOutput import cleanOutput
+from agent.CleanOutput import extractJson
 from agent.LLM import runLLM
-from agent.Tool import dynamicTool
+from agent.Tool import dynamicTool, defaultAgent
+from agent.Prompt import PromptTemplate
+from agent.Tools.Shell import runPlan
+from agent.Tools.PlanCache import getPlanCache
 
 ModelConfig.setDefaultModel("llama3.1", False)
 
 debug = True
 
+_commandsSchema = {
+    "type": "object",
+    "properties": {
+        "commands": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "string"}, "command": {"type": "string"}, "independent": {"type": "boolean"}},
+                "required": ["id", "command"],
+            },
+        },
+    },
+    "required": ["commands"],
+}
+
+# The instructions are the same for every task, the steps or the task come last
+_commandsTemplate = PromptTemplate(
+    prefix="""
+        {request}
+
+        Extra instructions:
+            - You need to only generate the commands that are needed. So don't add unnecessary steps.
+            - Number the commands with their id, starting at "1".
+            - NEVER use interactive tools like nano/vim/emacs.
+            - Use shell commands like `echo` or `printf` to insert text into files.
+            - All commands run in the same shell, so a cd or export carries over to the next commands.
+            - Only set "independent" to true if the command doesn't need the other commands, doesn't change the directory or variables and can run at the same time as the commands next to it.
+
+        Follow these instructions precisely.
+    """,
+    suffix="""
+        {label}: {data}
+    """,
+)
+
 def _makeSteps(task: str, debug: bool = False):
     prompt = f"""
         You need to break down the given task into steps.
@@ -30,76 +67,94 @@ def _makeSteps(task: str, debug: bool = False):
     
     return steps
 
-def _makeCommands(steps: str, debug: bool = False):
-    prompt = f"""
-        "You have to make commands for each step only answer in usable json.
-        
-        Steps to task: {steps}
-        
-        {{
-            "commands": [
-                {{
-                    "id": "1",
-                    "command": "{{enter command here}}"
-                }},
-                {{
-                    "id": "2",
-                    "command": "{{enter command here}}"
-                }}
-            ]
-        }}
+def _makeCommands(steps: str = None, task: str = None, debug: bool = False):
+    # Without steps the commands are made straight from the task, that saves a call
+    if steps is not None:
+        prompt = _commandsTemplate.render({"request": "You have to make commands for each step."}, label="Steps to task", data=steps)
+    else:
+        prompt = _commandsTemplate.render({"request": "You have to break the task down into steps and make a command for each step."}, label="Task", data=task)
 
-        Extra instructions:
-            - You need to only generate command for the given steps. So don't add unnecessary steps. 
-            - Only Respond with valid json. Don't add anything else so no: '''json or ```
-            - NEVER use interactive tools like nano/vim/emacs.
-            - Use shell commands like `echo` or `printf` to insert text into files.
-            
-        Follow these instructions precisely."
-    """
-    
     if debug:
         print(f"[DEBUG]: prompt: {prompt}")
     
-    commands = runLLM(prompt=prompt, debug=debug)
+    commands = defaultAgent().runStructured(prompt, _commandsSchema, debug=debug)
     
     if debug:
-        if ModelConfig.getDefaultOpenAI():
-            #print(f"[DEBUG]: commands['choices'][0]['message']['content']: {commands['choices'][0]['message']['content']}")
-            print(f"[DEBUG]: commands: {commands}")
-        elif not ModelConfig.getDefaultOpenAI():
-            print(f"[DEBUG]: commands: {commands}")
+        print(f"[DEBUG]: commands: {commands}")
     
-    if ModelConfig.getDefaultOpenAI():
-        return commands.choices[0].message.content
     return commands
 
-def _runCommands(commands: str, debug: bool = False):
-    response = cleanOutput(stdout=commands, openAI=ModelConfig.getDefaultOpenAI(), debug=debug)
+def _parsePlan(commands, debug: bool = False) -> dict:
+    # commands is the plan from _makeCommands, or model output with the plan in it
+    if commands is None:
+        return None
+    return extractJson(commands, key="commands", debug=debug)
+
+def _runPlan(plan: dict, debug: bool = False, timeout: float = 120, totalTimeout: float = 600) -> list:
+    results = runPlan(plan["commands"], timeout=timeout, totalTimeout=totalTimeout, debug=debug)
+
+    if debug:
+        for result in results:
+            print(f"[OUTPUT] {result['id']} (exit {result['exitCode']}, {result['duration']:.2f}s)\n{result['stdout']}")
+
+            if result["stderr"]:
+                print(f"[ERROR]\n{result['stderr']}")
+            if result["timedOut"]:
+                print(f"[ERROR] Command {result['id']} timed out")
+
+    return results
+
+def _runCommands(commands: str, debug: bool = False, timeout: float = 120, totalTimeout: float = 600):
+    plan = _parsePlan(commands=commands, debug=debug)
     
-    if response and "commands" in response:
-        for cmd in response["commands"]:
-            try:
-                if debug:
-                    print(f"Running command {cmd['id']}: {cmd['command']}")
-                result_cmd = subprocess.run(cmd["command"], shell=True, capture_output=True, text=True)
-                if debug:
-                    print(f"[OUTPUT]\n{result_cmd.stdout}")
-                
-                    if result_cmd.stderr:
-                        print(f"[ERROR]\n{result_cmd.stderr}")
-            except Exception as e:
-                print(f"[EXCEPTION] Failed to run command {cmd['id']}: {e}")
+    if plan is not None:
+        return _runPlan(plan=plan, debug=debug, timeout=timeout, totalTimeout=totalTimeout)
     else:
         print("No valid commands found.")
+        return []
 
+def _failed(results: list) -> bool:
+    return not results or any(result["timedOut"] or result["exitCode"] != 0 for result in results)
 
+def _solve(task: str, oneShot: bool = True, debug: bool = False) -> list:
+    """Plans the task (or takes the plan from the plan cache) and runs it.
+
+    A new plan goes into the cache once all its commands succeeded, a cached plan that fails is removed from it.
+    """
+    cache = getPlanCache()
+    plan = cache.get(task) if cache is not None else None
+    cached = plan is not None
+
+    if debug and cached:
+        print(f"[DEBUG] Using the cached plan for: {task}")
+
+    if plan is None:
+        if oneShot:
+            commands = _makeCommands(task=task, debug=debug)
+        else:
+            steps = _makeSteps(task=task, debug=debug)
+            commands = _makeCommands(steps=steps, debug=debug)
+
+        plan = _parsePlan(commands=commands, debug=debug)
+        if plan is None:
+            print("No valid commands found.")
+            return []
+
+    results = _runPlan(plan=plan, debug=debug)
+
+    if cache is not None:
+        if _failed(results):
+            if cached:
+                if debug:
+                    print(f"[DEBUG] The cached plan failed, removing it: {task}")
+                cache.invalidate(task)
+        elif not cached:
+            cache.set(task, plan)
 
+    return results
      
-def terminalUse(task: str, debug: bool = False):
-    steps = _makeSteps(task=task, debug=debug)
-    commands = _makeCommands(steps=steps, debug=debug)
-    r = _runCommands(commands=commands, debug=debug)
+def terminalUse(task: str, debug: bool = False, oneShot: bool = True):
+    r = _solve(task=task, oneShot=oneShot, debug=debug)
     
     return r
 
@@ -112,9 +167,7 @@ def dynamicTerminalUse(task: str, debug: bool = False):
         Task is a string and need to be a desciption of a task that needs to be able to be broken down into smaller commands to run.
     """
     
-    steps = _makeSteps(task=task, debug=debug)
-    commands = _makeCommands(steps=steps, debug=debug)
-    r = _runCommands(commands=commands, debug=debug)
+    r = _solve(task=task, debug=debug)
     
     return r
 
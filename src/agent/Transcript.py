@@ -0,0 +1,163 @@
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+from agent.Config import ModelConfig
+from agent.Prompt import PromptTemplate
+
+_summaries = OrderedDict()
+_summariesLock = threading.Lock()
+
+_summaryTemplate = PromptTemplate(
+    prefix="""
+        You are now an AI agent.
+
+        Your task: Summarize the conversation below {limit}. Keep every fact, decision and open question that later agents need.
+
+        Only respond with the summary, nothing else.
+    """,
+    suffix="""
+        Previous summary: {summary}
+
+        New responses: {responses}
+    """,
+)
+_maxSummaries = 256
+
+_encoding = None
+
+
+def countTokens(text: str) -> int:
+    """Uses tiktoken when it's installed, else a close estimate from words and punctuation."""
+    global _encoding
+
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+
+    if _encoding:
+        return len(_encoding.encode(text))
+
+    # Long words are usually split into several tokens
+    return sum(1 + len(word) // 6 for word in re.findall(r"\w+|[^\w\s]", text))
+
+
+class Transcript:
+    """The prompt plus the responses of the agents in a chain, kept under a token budget.
+
+    The newest turns stay as they are, older turns are folded into a rolling summary.
+    Without a token budget the text is the same as the plain concatenated transcript.
+    """
+
+    def __init__(self, prompt: str, tokenBudget: int = None, keepRecent: int = 4, debug: bool = False):
+        self.prompt = prompt
+        self.tokenBudget = tokenBudget
+        self.keepRecent = max(1, keepRecent)
+        self.debug = debug
+
+        self.turns = []
+        self.summary = ""
+        self.compacted = 0
+
+    def add(self, name: str, result: str):
+        self.turns.append((name, result))
+
+    def state(self) -> dict:
+        return {"turns": [list(turn) for turn in self.turns], "summary": self.summary, "compacted": self.compacted}
+
+    def restore(self, state: dict):
+        self.turns = [tuple(turn) for turn in state["turns"]]
+        self.summary = state["summary"]
+        self.compacted = state["compacted"]
+
+    def _text(self) -> str:
+        text = self.prompt
+        if self.summary:
+            text += f"\nSummary of earlier responses: {self.summary}"
+        for name, result in self.turns[self.compacted:]:
+            text += f"\n{name} response: {result}"
+        return text
+
+    def _overBudget(self) -> bool:
+        return self.tokenBudget is not None and countTokens(self._text()) > self.tokenBudget
+
+    def _nextBatch(self) -> list:
+        # Everything but the newest turns, or one turn at a time when the newest turns alone are too big
+        remaining = len(self.turns) - self.compacted
+        if remaining > self.keepRecent:
+            return self.turns[self.compacted:len(self.turns) - self.keepRecent]
+        return self.turns[self.compacted:self.compacted + 1]
+
+    def _summaryPrompt(self, batch: list) -> str:
+        responses = "".join(f"\n{name} response: {result}" for name, result in batch)
+        limit = f"in at most {self.tokenBudget // 4} tokens" if self.tokenBudget else "concisely"
+        return _summaryTemplate.render({"limit": limit}, summary=self.summary or "none", responses=responses)
+
+    def _summaryKey(self, batch: list) -> str:
+        data = repr((ModelConfig.getDefaultModel(), self.tokenBudget, self.summary, batch))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _cachedSummary(self, key: str):
+        with _summariesLock:
+            summary = _summaries.get(key)
+            if summary is not None:
+                _summaries.move_to_end(key)
+            return summary
+
+    def _rememberSummary(self, key: str, summary: str):
+        with _summariesLock:
+            _summaries[key] = summary
+            _summaries.move_to_end(key)
+            while len(_summaries) > _maxSummaries:
+                _summaries.popitem(last=False)
+
+    def _summarizer(self):
+        from agent.Agent import Agent
+
+        return Agent(
+            name="summarizer",
+            instruction="You summarize conversations.",
+            model=ModelConfig.getDefaultModel(),
+            openAI=ModelConfig.getDefaultOpenAI(),
+            register=False,
+        )
+
+    def render(self) -> str:
+        while self._overBudget() and len(self.turns) - self.compacted > 1:
+            batch = self._nextBatch()
+            key = self._summaryKey(batch)
+
+            summary = self._cachedSummary(key)
+            if summary is None:
+                summary = self._summarizer().runModel(self._summaryPrompt(batch), self.debug).strip()
+                self._rememberSummary(key, summary)
+
+            self.summary = summary
+            self.compacted += len(batch)
+
+            if self.debug:
+                print(f"[DEBUG] Compacted {len(batch)} turns, transcript is now {countTokens(self._text())} tokens")
+
+        return self._text()
+
+    async def arender(self) -> str:
+        while self._overBudget() and len(self.turns) - self.compacted > 1:
+            batch = self._nextBatch()
+            key = self._summaryKey(batch)
+
+            summary = self._cachedSummary(key)
+            if summary is None:
+                summary = (await self._summarizer().arunModel(self._summaryPrompt(batch), self.debug)).strip()
+                self._rememberSummary(key, summary)
+
+            self.summary = summary
+            self.compacted += len(batch)
+
+            if self.debug:
+                print(f"[DEBUG] Compacted {len(batch)} turns, transcript is now {countTokens(self._text())} tokens")
+
+        return self._text()
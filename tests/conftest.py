@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from agent.Config import ModelConfig
+from agent.Cache import GuardrailCache
+from agent.RateLimit import RateLimiter
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with server.lock:
+            server.requests.append({"path": self.path, "body": body, "port": self.client_address[1]})
+            drop = server.dropNext
+            server.dropNext = False
+
+        if self.path != "/api/generate":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if server.status != 200:
+            self._sendJson({"error": "stand-in error"}, server.status)
+            return
+
+        text = server.respond(body.get("prompt", ""), body)
+
+        if body.get("stream"):
+            self._stream(text)
+            return
+
+        self._sendJson({"response": text, "done": True}, 200)
+
+        # Looks like a keep-alive response, but the connection is gone when the client reuses it
+        if drop:
+            self.close_connection = True
+
+    def _sendJson(self, data: dict, status: int):
+        data = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, text: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        words = [word + " " for word in text.split(" ")] + [""]
+        try:
+            for i, word in enumerate(words):
+                line = (json.dumps({"response": word, "done": i == len(words) - 1}) + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+                time.sleep(self.server.chunkDelay)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading
+            self.close_connection = True
+
+
+class StandInOllama(ThreadingHTTPServer):
+    """A local /api/generate that answers with respond(prompt, body), word by word when streaming.
+
+    requests has the path, body and client port of every request, so tests can see which connection was used.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.host = f"http://127.0.0.1:{self.server_address[1]}"
+        self.lock = threading.Lock()
+        self.requests = []
+        self.respond = lambda prompt, body: "Hello from the stand-in"
+        self.status = 200
+        self.chunkDelay = 0.0
+        self.dropNext = False
+
+    def ports(self) -> list:
+        with self.lock:
+            return [request["port"] for request in self.requests]
+
+
+@pytest.fixture
+def ollama():
+    server = StandInOllama()
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    host = ModelConfig.getOllamaHost()
+    ModelConfig.setOllamaHost(server.host)
+    RateLimiter.reset()
+    GuardrailCache.invalidate()
+
+    yield server
+
+    ModelConfig.setOllamaHost(host)
+    RateLimiter.reset()
+    GuardrailCache.invalidate()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,65 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from agent.Graph import checkCycles, runGraph, arunGraph
+
+
+def test_cycle():
+    with pytest.raises(ValueError, match="Tool dependency cycle: a -> b -> a"):
+        checkCycles(["a", "b"], {"a": ["b"], "b": ["a"]}, "Tool")
+
+    checkCycles(["a", "b", "c"], {"a": [], "b": ["a"], "c": ["a", "b"]}, "Tool")
+
+
+def test_dependenciesGetTheirResults():
+    dependencies = {"a": [], "b": ["a"], "c": ["a", "b"]}
+
+    results = runGraph(["a", "b", "c"], dependencies, lambda name, results: name + "".join(results.values()), 4)
+
+    assert results == {"a": "a", "b": "ba", "c": "caba"}
+
+
+def test_maxConcurrency():
+    lock = threading.Lock()
+    active = {"now": 0, "max": 0}
+
+    def task(name, results):
+        with lock:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.05)
+        with lock:
+            active["now"] -= 1
+        return name
+
+    names = [str(i) for i in range(6)]
+    runGraph(names, {name: [] for name in names}, task, 2)
+
+    assert active["max"] == 2
+
+
+def test_timeout():
+    def task(name, results):
+        time.sleep(1 if name == "slow" else 0)
+        return name
+
+    started = time.monotonic()
+    results = runGraph(["slow", "fast"], {"slow": [], "fast": []}, task, 2, timeout=0.1, onTimeout=lambda name: "timed out")
+
+    assert results == {"slow": "timed out", "fast": "fast"}
+    assert time.monotonic() - started < 0.5
+
+
+def test_async():
+    dependencies = {"a": [], "b": ["a"], "slow": []}
+
+    async def task(name, results):
+        await asyncio.sleep(1 if name == "slow" else 0)
+        return name + "".join(results.values())
+
+    results = asyncio.run(arunGraph(["a", "b", "slow"], dependencies, task, 4, timeout=0.1, onTimeout=lambda name: "timed out"))
+
+    assert results == {"a": "a", "b": "ba", "slow": "timed out"}
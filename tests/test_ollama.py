@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from agent.Ollama import OllamaClient, AsyncOllamaClient, OllamaError
+
+
+def test_generate(ollama):
+    client = OllamaClient(ollama.host)
+    ollama.respond = lambda prompt, body: f"echo {prompt}"
+
+    assert client.generate("m", "hi") == "echo hi"
+    assert ollama.requests[0]["body"]["model"] == "m"
+    assert ollama.requests[0]["body"]["stream"] is False
+
+
+def test_connectionIsReused(ollama):
+    client = OllamaClient(ollama.host)
+
+    for _ in range(3):
+        client.generate("m", "hi")
+
+    assert len(set(ollama.ports())) == 1
+
+
+def test_droppedConnectionIsRetried(ollama):
+    client = OllamaClient(ollama.host)
+    ollama.dropNext = True
+
+    assert client.generate("m", "first") == "Hello from the stand-in"
+    assert client.generate("m", "second") == "Hello from the stand-in"
+
+    # The second request went out again on a new connection
+    assert [request["body"]["prompt"] for request in ollama.requests] == ["first", "second"]
+    assert len(set(ollama.ports())) == 2
+
+
+def test_errorStatus(ollama):
+    client = OllamaClient(ollama.host)
+    ollama.status = 500
+
+    with pytest.raises(OllamaError) as error:
+        client.generate("m", "hi")
+    assert error.value.status == 500
+
+
+def test_stream(ollama):
+    client = OllamaClient(ollama.host)
+    ollama.respond = lambda prompt, body: "one two three"
+
+    chunks = list(client.generateStream("m", "hi"))
+
+    assert chunks == ["one ", "two ", "three "]
+    assert ollama.requests[0]["body"]["stream"] is True
+
+    # A stream that was read to the end gives its connection back
+    client.generate("m", "hi")
+    assert len(set(ollama.ports())) == 1
+
+
+def test_closingStreamEarly(ollama):
+    client = OllamaClient(ollama.host)
+    ollama.respond = lambda prompt, body: " ".join(["word"] * 200)
+    ollama.chunkDelay = 0.01
+
+    stream = client.generateStream("m", "hi")
+    assert next(stream) == "word "
+    stream.close()
+
+    # The rest of the stream is still on that connection, so it isn't reused
+    assert client._pool.qsize() == 0
+    assert client.generate("m", "hi") == " ".join(["word"] * 200)
+    assert len(set(ollama.ports())) == 2
+
+
+def test_asyncClient(ollama):
+    ollama.respond = lambda prompt, body: "one two"
+
+    async def main():
+        client = AsyncOllamaClient(ollama.host)
+        try:
+            text = await client.generate("m", "hi")
+            chunks = [chunk async for chunk in client.generateStream("m", "hi")]
+        finally:
+            await client.close()
+        return text, chunks
+
+    text, chunks = asyncio.run(main())
+    assert text == "one two"
+    assert chunks == ["one ", "two "]
@@ -0,0 +1,61 @@
+import uuid
+import threading
+import concurrent.futures
+
+import agent.Agent as agentModule
+from agent.Agent import Agent
+from agent.Cache import GuardrailCache
+
+
+def _respond(prompt, body):
+    if "compliance agent" in prompt:
+        return "triggered" if "blocked" in prompt else "ok"
+    return "answer"
+
+
+def _agent(**kwargs) -> Agent:
+    return Agent(name=f"speculative{uuid.uuid4().hex}", instruction="x", model="m", inputGuardrails="No secrets.", speculativeGuardrails=True, register=False, **kwargs)
+
+
+def test_speculatedAnswerIsUsed(ollama):
+    ollama.respond = _respond
+
+    assert _agent().run("hi") == "answer"
+
+    # One call for the guardrails and one for the answer, the answer isn't asked again
+    assert len(ollama.requests) == 2
+
+
+def test_verdictBeforeTheSpeculationStarted(ollama, monkeypatch):
+    # A cached ok comes back while the speculation still waits for a worker, the prompt passed so it still gets its answer
+    ollama.respond = _respond
+    agent = _agent()
+    GuardrailCache.set("input", agent.inputGuardrails, agent.model, "hi", "ok")
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    busy = threading.Event()
+    pool.submit(busy.wait, 10)
+    monkeypatch.setattr(agentModule, "_speculationPool", pool)
+
+    try:
+        assert agent.run("hi") == "answer"
+    finally:
+        busy.set()
+        pool.shutdown()
+
+
+def test_toolsOnlyRunAfterTheGuardrails(ollama):
+    ollama.respond = _respond
+    calls = []
+
+    def lookup() -> str:
+        calls.append(1)
+        return "looked up"
+
+    agent = _agent(tools=[lookup], selectiveToolUse=False)
+
+    assert agent.run("blocked prompt").startswith("Guardrails triggered")
+    assert calls == []
+
+    agent.run("fine prompt")
+    assert calls == [1]
@@ -0,0 +1,83 @@
+import uuid
+import asyncio
+import threading
+
+from agent.Agent import Agent
+from agent.RateLimit import RateLimiter
+
+
+def _guardedAgent(ollama) -> Agent:
+    # The output guardrails say ok, everything else is a long answer
+    ollama.respond = lambda prompt, body: "ok" if "compliance agent" in prompt else " ".join(["word"] * 40)
+    return Agent(name=f"streamer{uuid.uuid4().hex}", instruction="x", model="m", outputGuardrails="Nothing rude.", register=False)
+
+
+def _runWithTimeout(function, timeout: float = 10):
+    # A hang has to fail the test, not the whole run
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("value", function()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "stream hangs"
+    return result["value"]
+
+
+def test_stream(ollama):
+    ollama.respond = lambda prompt, body: "one two three"
+    agent = Agent(name=f"streamer{uuid.uuid4().hex}", instruction="x", model="m", register=False)
+
+    assert "".join(agent.stream("hi")) == "one two three "
+
+
+def test_guardedStreamWithOneSlot(ollama):
+    # The incremental guardrail check needs a slot while the stream is still open
+    RateLimiter.configure("ollama", maxConcurrency=1)
+    agent = _guardedAgent(ollama)
+
+    text = _runWithTimeout(lambda: "".join(agent.stream("hi", guardrailsInterval=20)))
+
+    assert text == " ".join(["word"] * 40) + " "
+
+
+def test_concurrentGuardedStreams(ollama):
+    # As many streams as the default ollama cap, every one of them waits on a guardrail check
+    agent = _guardedAgent(ollama)
+
+    def streams():
+        results = [None] * 4
+
+        def one(i):
+            results[i] = "".join(agent.stream(f"hi {i}", guardrailsInterval=20))
+
+        threads = [threading.Thread(target=one, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    assert _runWithTimeout(streams) == [" ".join(["word"] * 40) + " "] * 4
+
+
+def test_concurrentGuardedAsyncStreams(ollama):
+    agent = _guardedAgent(ollama)
+
+    async def main():
+        async def one(i):
+            return "".join([chunk async for chunk in agent.astream(f"hi {i}", guardrailsInterval=20)])
+
+        return await asyncio.wait_for(asyncio.gather(*[one(i) for i in range(4)]), 10)
+
+    assert asyncio.run(main()) == [" ".join(["word"] * 40) + " "] * 4
+
+
+def test_closingStreamEarlyFreesTheSlot(ollama):
+    RateLimiter.configure("ollama", maxConcurrency=1)
+    ollama.respond = lambda prompt, body: " ".join(["word"] * 40)
+    agent = Agent(name=f"streamer{uuid.uuid4().hex}", instruction="x", model="m", register=False)
+
+    stream = agent.streamModel("hi")
+    assert next(stream) == "word "
+    stream.close()
+
+    assert _runWithTimeout(lambda: agent.runModel("again")) == " ".join(["word"] * 40)